@@ -1,8 +1,12 @@
 import numpy as np
 
+import force_backends
+from neighbor_list import Neighbor_List
+
 
 class Differential_Equation:
-    def __init__(self, num_individuals, L, time_step, room, radius, weights):
+    def __init__(self, num_individuals, L, time_step, room, radius, weights, cutoff=None,
+                 navigation="floor_field", backend="auto", relaxation_time=None):
         """
             Initialize the Differential_Equation class with the provided parameters.
 
@@ -13,6 +17,15 @@ class Differential_Equation:
             - ``room``: object, represents the room in which the simulation takes place
             - ``radius``: 1D-array, radius of all individuals
             - ``weights``: 1D-array, mass or weight of all individuals
+            - ``cutoff``: float or None, distance beyond which agents do not
+                          interact with each other or with walls; None evaluates all pairs
+            - ``navigation``: string, how the desired direction is found in rooms with
+                              internal walls: "floor_field" (gradient of the room's
+                              distance-to-exit field) or "geometric" (nearest_wall/direction)
+            - ``backend``: string, the kernels of f_ag and f_wa: "numpy", "numba" (compiled,
+                           if installed), "python" or "auto" (see force_backends)
+            - ``relaxation_time``: float or None, time in which agents adapt their velocity to the
+                                   desired one (None: time_step)
 
             Attributes:
             - ``room``: object, represents the room
@@ -23,6 +36,7 @@ class Differential_Equation:
             - ``A``: float, a constant
             - ``B``: float, a constant
             - ``time_step``: float, time parameter
+            - ``relaxation_time``: float, relaxation time of the velocities
             - ``k``: float, a constant
             - ``kap``: float, a constant
             - ``L``: float, length parameter
@@ -30,6 +44,12 @@ class Differential_Equation:
             - ``number_of_walls``: integer, number of walls in the room
             - ``walls``: 3D-array, represents the walls in the room
             - ``wall_shear``: boolean, True if there are walls in the middle of the room
+            - ``neighbor_list``: object or None, cell/Verlet list used when a cutoff is set
+            - ``wall_index``: object or None, the room's grid of walls used when a cutoff is set
+            - ``floor_field``: object or None, the room's floor field used for navigation
+            - ``backend``: string, the backend of f_ag and f_wa ("auto" resolved)
+            - ``kernels``: object or None, the force kernels of the backend (None: NumPy),
+                           selected the first time they are used
         """
         self.room = room
         self.N = num_individuals
@@ -39,6 +59,7 @@ class Differential_Equation:
         self.A = 2 * 10 ** 3
         self.B = 0.08
         self.time_step = time_step
+        self.relaxation_time = time_step if relaxation_time is None else relaxation_time
         self.k = 1.2 * 10 ** 5
         self.kap = 2.4 * 10 ** 5
         self.L = L
@@ -46,6 +67,20 @@ class Differential_Equation:
         self.number_of_walls = self.room.get_num_walls()
         self.walls = self.room.walls
         self.wall_shear = self.room.wall_shear
+        self.neighbor_list = None
+        self.wall_index = None
+        if cutoff is not None:
+            self.neighbor_list = Neighbor_List(self.room, self.radius, cutoff, time_step=time_step)
+            self.wall_index = self.room.get_wall_index(cutoff)
+        self.floor_field = None
+        if self.wall_shear and navigation == "floor_field":
+            self.floor_field = self.room.get_floor_field()
+        self.backend = force_backends.resolve(backend)
+
+    @property
+    def kernels(self):
+        # The kernels of the backend; Numba is only imported the first time they are used
+        return force_backends.select(self.backend)
 
     # Checks if an agent touches another one or a wall
     def g(self, x):
@@ -156,25 +191,29 @@ class Differential_Equation:
 
         # taking the right agent vector direction
 
-    def direction(self, i, j, r):
+    def direction(self, i, j, r, r_D=None):
         """returns an 1D-array, the normalized i-agent vector direction
            parameters: ``i``,``j``: integers (agent i and wall j)
                        ``r``: 2D-array, (position of all agents)
+                       ``r_D``: 2D-array of shape (1, 2) or None, (the destination of
+                                agent i; None: the first destination)
         """
+        if r_D is None:
+            r_D = self.r_D[:1]
         wall = self.walls[j, :, :]
         wall_norm = (wall[0, :] - wall[1, :]) / np.linalg.norm(wall[0, :] - wall[1, :])
-        point = self.seg_intersect(r[:, i], self.r_D, wall[0, :], wall[1, :])
+        point = self.seg_intersect(r[:, i], r_D, wall[0, :], wall[1, :])
         t_or_f = self.is_between(wall[0, :], wall[1, :], point)
 
-        if (t_or_f == 1 and np.linalg.norm(-r[:, i] + self.r_D) + self.radius[i] > np.linalg.norm(
-                -point + self.r_D)) or (
-                np.min([np.linalg.norm(r[:, i] - wall[0, :]), np.linalg.norm(r[:, i] - wall[1, :])]) < np.linalg.norm(2 * self.radius[i]) and np.linalg.norm(-r[:, i] + self.r_D) > np.linalg.norm(-point + self.r_D)):
+        if (t_or_f == 1 and np.linalg.norm(-r[:, i] + r_D) + self.radius[i] > np.linalg.norm(
+                -point + r_D)) or (
+                np.min([np.linalg.norm(r[:, i] - wall[0, :]), np.linalg.norm(r[:, i] - wall[1, :])]) < np.linalg.norm(2 * self.radius[i]) and np.linalg.norm(-r[:, i] + r_D) > np.linalg.norm(-point + r_D)):
             # if the internal walls form corners, use this
             # e = self.e_1(r[:,i],wall,i,j)
             # if the internal walls does not form corners, that's quicker
-            e = self.nearest_path(wall, t_or_f, point, wall_norm, r[:, i], i)
+            e = self.nearest_path(wall, t_or_f, point, wall_norm, r[:, i], i, r_D)
         else:
-            e = self.e_0(r[:, i], i)
+            e = (r_D[0] - r[:, i]) / np.linalg.norm(r_D[0] - r[:, i])
         return e
 
         # take the right direction in case of wall corner points
@@ -192,14 +231,14 @@ class Differential_Equation:
         point = self.seg_intersect(r_i, self.r_D, temp_wall[0, :], temp_wall[1, :])
         t_or_f = self.is_between(temp_wall[0, :], temp_wall[1, :], point)
 
-        for k in range(all_walls.shape[0]):
+        for k in self.walls_near(temp_wall):
             if k == j:
                 continue
             check_close_corner[k, 0] = self.is_between(all_walls[k, 0, :], all_walls[k, 1, :], temp_wall[0, :])
             check_close_corner[k, 1] = self.is_between(all_walls[k, 0, :], all_walls[k, 1, :], temp_wall[1, :])
 
         if np.sum(check_close_corner) == 1:
-            for k in range(all_walls.shape[0]):
+            for k in self.walls_near(temp_wall):
                 if (check_close_corner[k, 0] == 1 and check_close_corner[k, 1] == 0) and self.is_between(
                         all_walls[k, 0, :], all_walls[k, 1, :],
                         self.seg_intersect(r_i, self.r_D, all_walls[k, 0, :], all_walls[k, 1, :])) == 1:
@@ -240,7 +279,7 @@ class Differential_Equation:
         return e
 
     # take the nearest path if one agent has to overtake a wall
-    def nearest_path(self, temp_wall, t_or_f, point, wall_norm, r_i, i):
+    def nearest_path(self, temp_wall, t_or_f, point, wall_norm, r_i, i, r_D=None):
         """returns an 1D-array, the normalized i-agent vector direction in case
            of a wall between the door and the agents
            parameters: ``i``: integers (agent i and wall j)
@@ -250,9 +289,13 @@ class Differential_Equation:
                                  door-agent-line intersect the wall j)
                        ``point``: 1D-array, (intersection point between the
                                   door-agent-line and the temp_wall-line)
+                       ``r_D``: 2D-array of shape (1, 2) or None, (the destination of
+                                agent i; None: the first destination)
         """
-        if (np.linalg.norm(self.r_D - temp_wall[0, :]) + np.linalg.norm(r_i - temp_wall[0, :])) <= (
-                np.linalg.norm(self.r_D - temp_wall[1, :]) + np.linalg.norm(r_i - temp_wall[1, :])):
+        if r_D is None:
+            r_D = self.r_D[:1]
+        if (np.linalg.norm(r_D - temp_wall[0, :]) + np.linalg.norm(r_i - temp_wall[0, :])) <= (
+                np.linalg.norm(r_D - temp_wall[1, :]) + np.linalg.norm(r_i - temp_wall[1, :])):
             # if (t_or_f == 1 and np.linalg.norm(point-r_i)<2*self.radius[i]):
             #    e =  wall_norm
             # else:
@@ -282,55 +325,279 @@ class Differential_Equation:
         return (-r + self.r_D) / np.linalg.norm(-r + self.r_D)
 
     # Finding the nearest wall that ubstruct one person
-    def nearest_wall(self, r_i):
+    def nearest_wall(self, r_i, r_D=None):
         """retrns an integer, the argument of the nearest internal wall respect
            to the agent i
            parameters: ``r_i``: 1D-array, (position of agent i)
+                       ``r_D``: 2D-array of shape (1, 2) or None, (the destination of
+                                agent i; None: the first destination)
+        """
+        if r_D is None:
+            r_D = self.r_D[:1]
+        first = self.room.first_internal_wall
+        numbers = np.arange(first, self.number_of_walls)
+        if self.wall_index is not None:
+            # Only the internal walls near the line of sight to the destination can block it
+            numbers = self.wall_index.along(r_i, r_D[0])
+            numbers = numbers[numbers >= first]
+            if len(numbers) == 0:
+                return None
+        distance = np.zeros(len(numbers))
+        for count, i in enumerate(numbers):
+            temp_wall = self.walls[i, :, :]
+            point = self.seg_intersect(r_i, r_D, temp_wall[0, :], temp_wall[1, :])
+            distance[count] = np.linalg.norm(point - r_i)
+        return numbers[np.argmin(distance)]
 
+    def walls_near(self, wall):
+        """returns a 1D-array, the numbers of the walls that may touch the ends of a wall
+           (all walls if there is no wall index)
+           parameters: ``wall``: 2D-array, (the two end points of the wall)
         """
-        all_walls = self.walls[5:, :, :]
-        distance = np.zeros((all_walls.shape[0]))
-        for i in range(all_walls.shape[0]):
-            temp_wall = all_walls[i, :, :]
-            point = self.seg_intersect(r_i, self.r_D, temp_wall[0, :], temp_wall[1, :])
-            distance[i] = np.linalg.norm(point - r_i)
-        return 5 + np.argmin(distance)
+        if self.wall_index is None:
+            return np.arange(self.number_of_walls)
+        return np.unique(self.wall_index.candidates(wall.T)[1])
 
     # Desired direction normalized for all agents
-    def e_t(self, r):
+    def e_t(self, r, index=None):
         """ returns an 1D-array, the normalized desired direction at the actual
             timestep for all agents
             parameters: ``r``: 2D-array (position of all agents)
+                        ``index``: 1D-array or None (the agents in the columns
+                                   of ``r``; None means all agents)
         """
-        e_temp = np.zeros((2, self.N))
         # If there are additional walls the desired direction doesn't have to...
         # ...be the direction of a door.
         if self.wall_shear == False:
-            for i in range(self.N):
-                e_temp[:, i] = self.e_0(r[:, i], i)
-        else:
-            for i in range(self.N):
-                j = self.nearest_wall(r[:, i])
-                e_temp[:, i] = self.direction(i, j, r)
+            return self.e_0_all(r, index)
+        if self.floor_field is not None:
+            e_temp = self.floor_field.direction(r)
+            # Agents without a free grid cell around them head straight for the door
+            lost = np.all(e_temp == 0, axis=0)
+            if np.any(lost):
+                e_temp[:, lost] = self.e_0_all(r, index)[:, lost]
+            return e_temp
+        if index is None:
+            index = np.arange(self.N)
+        # The geometric functions address agents by their number; every agent heads for its own
+        # destination, chosen as in e_0_all
+        r_all = np.zeros((2, self.N))
+        r_all[:, index] = r
+        target = self.destinations(r, index)
+        e_temp = np.zeros((2, len(index)))
+        for count, i in enumerate(index):
+            r_D = target[:, count][None, :]
+            j = self.nearest_wall(r_all[:, i], r_D)
+            if j is None:
+                # No internal wall near the way to the door
+                e_temp[:, count] = (r_D[0] - r_all[:, i]) / np.linalg.norm(r_D[0] - r_all[:, i])
+            else:
+                e_temp[:, count] = self.direction(i, j, r_all, r_D)
         return e_temp
 
+    # Desired direction normalized for all agents, straight to the door
+    def e_0_all(self, r, index=None):
+        """ returns a 2D-array, e_0 for all agents at once
+            parameters: ``r``: 2D-array (position of all agents)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        e = self.destinations(r, index) - r
+        return e / np.linalg.norm(e, axis=0)
+
+    # The destination every agent heads for
+    def destinations(self, r, index=None):
+        """ returns a 2D-array of shape (2, n), the destination of every agent in ``r``
+            parameters: ``r``: 2D-array (position of all agents)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        if index is None:
+            index = np.arange(r.shape[1])
+        if self.room.destination_cost is not None:
+            # Everybody takes the destination with the shortest way out, including the way behind it
+            way = np.linalg.norm(r[:, None, :] - self.r_D.T[:, :, None], axis=0) + self.room.destination_cost[:, None]
+            target = self.r_D[np.argmin(way, axis=0)].T
+        elif len(self.r_D) == 2:
+            # If there are two destinations, then half of the people go to each destination
+            target = np.where(index < self.N / 2, self.r_D[0][:, None], self.r_D[1][:, None])
+        elif len(self.r_D) > 2:
+            # With more destinations everybody goes to the nearest one
+            nearest = np.argmin(np.linalg.norm(r[:, None, :] - self.r_D.T[:, :, None], axis=0), axis=0)
+            target = self.r_D[nearest].T
+        else:
+            target = self.r_D.reshape(-1, 2)[0][:, None]
+        return np.broadcast_to(target, r.shape)
+
+    # Force between many agent pairs at once, vectorized form of f_ij
+    def pair_forces(self, dr, dv, rad_ij):
+        """ returns an array of shape dr.shape, the forcevectors acting on the
+            first agent of every pair (same formula as f_ij)
+            parameters: ``dr``: array of shape (2, ...) (r_i - r_j for every pair)
+                        ``dv``: array of shape (2, ...) (v_j - v_i for every pair)
+                        ``rad_ij``: array of shape dr.shape[1:] (radius sums)
+        """
+        d = np.sqrt(dr[0] ** 2 + dr[1] ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = np.where(d > 0, dr / d, 0.0)
+        t = np.stack((-n[1], n[0]))
+        dv_t = dv[0] * t[0] + dv[1] * t[1]
+        overlap = rad_ij - d
+        contact = np.maximum(overlap, 0)
+        a = self.A * np.exp(overlap / self.B) + self.k * contact
+        b = self.kap * contact * dv_t
+        return a * n + b * t
+
     # The interacting force of the agents to each other
-    def f_ag(self, r, v):
-        """ returns a 3D-array, the interacting forces between all the agents
+    def f_ag(self, r, v, index=None):
+        """ returns a 2D-array, the summed interacting forces on all the agents
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        radius = self.radius if index is None else self.radius[index]
+        if r.ndim == 2 and self.kernels is not None:
+            return self.f_ag_kernels(r, v, radius, index)
+        if self.neighbor_list is not None and r.ndim == 2:
+            return self.f_ag_neighbors(r, v, radius, index)
+        # The leading axes of r (after the x,y axis) may hold several replicas of the crowd
+        dr = r[..., :, None] - r[..., None, :]
+        dv = v[..., None, :] - v[..., :, None]
+        rad_ij = radius[..., :, None] + radius[..., None, :]
+        # On the diagonal dr is zero, so n and t vanish and an agent
+        # exerts no force on itself
+        fij = self.pair_forces(dr, dv, rad_ij)
+        return np.sum(fij, -1)
+
+    # The interacting force of the agents to each other, only for pairs inside the cutoff
+    def f_ag_neighbors(self, r, v, radius, index=None):
+        """ returns a 2D-array, the summed interacting forces on all the agents,
+            evaluated only for the pairs given by the neighbor list
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``radius``: 1D-array (radius of the agents in ``r``)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        i, j = self.neighbor_list.pairs(r, v, index)
+        fij = self.pair_forces(r[:, i] - r[:, j], v[:, j] - v[:, i], radius[i] + radius[j])
+        f_agent = np.zeros((2, r.shape[1]))
+        for c in range(2):
+            # Newton's third law: agent j feels the opposite force
+            f_agent[c] = np.bincount(i, fij[c], r.shape[1]) - np.bincount(j, fij[c], r.shape[1])
+        return f_agent
+
+    # The interacting force of the agents to each other, with the kernels of the backend
+    def f_ag_kernels(self, r, v, radius, index=None):
+        """ returns a 2D-array, the summed interacting forces on all the agents
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``radius``: 1D-array (radius of the agents in ``r``)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        r = np.ascontiguousarray(r, dtype=float)
+        v = np.ascontiguousarray(v, dtype=float)
+        radius = np.ascontiguousarray(radius, dtype=float)
+        f_agent = np.zeros((2, r.shape[1]))
+        constants = (float(self.A), float(self.B), float(self.k), float(self.kap), f_agent)
+        if self.neighbor_list is not None:
+            i, j = self.neighbor_list.pairs(r, v, index)
+            self.kernels.agent_pair_forces(r, v, radius, i, j, *constants)
+        else:
+            self.kernels.agent_forces(r, v, radius, *constants)
+        return f_agent
+
+    # The interacting force of the agents to each other, pair by pair
+    def f_ag_reference(self, r, v):
+        """ returns a 2D-array, the summed interacting forces on all the agents
+            computed with f_ij (slow reference path for f_ag)
             parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
         """
-        f_agent = np.zeros((2, self.N))
         fij = np.zeros(((2, self.N, self.N)))
         for i in range(self.N - 1):
             for j in range(self.N - 1 - i):
                 fij[:, i, j + i + 1] = self.f_ij(i, j + i + 1, r, v)
                 fij[:, j + i + 1, i] = -fij[:, i, j + i + 1]
-        f_agent = np.sum(fij, 2)
-        return f_agent
+        return np.sum(fij, 2)
+
+    # Distance between all agents and all walls
+    def wall_distances(self, r):
+        """ returns:    ``distance``: 2D-array (smallest distance between every agent and wall)
+                        ``n``, ``t``: 3D-array (normalized vectors pointing from
+                                      the walls to the agents, and their tangential vectors)
+            parameters: ``r``: 2D-array (positions of all agents)
+        """
+        room = self.room
+        # The walls are put on the last axis, after any replica and agent axes of r
+        shape = (2,) + (1,) * (r.ndim - 1) + (-1,)
+        pnt_vec = r[..., None] - room.wall_start.T.reshape(shape)
+        temp = (pnt_vec[0] * room.wall_unit[:, 0] + pnt_vec[1] * room.wall_unit[:, 1]) / room.wall_len
+        temp = np.clip(temp, 0.0, 1.0)
+        dist = pnt_vec - room.wall_vec.T.reshape(shape) * temp
+        distance = np.sqrt(dist[0] ** 2 + dist[1] ** 2)
+        n = dist / distance
+        t = np.stack((-n[1], n[0]))
+        return distance, n, t
 
     # The force of each wall acting on each agents
-    def f_wa(self, r, v):
-        """ returns a 3D-array, the interacting forces between all agents and walls
+    def f_wa(self, r, v, index=None):
+        """ returns a 2D-array, the summed forces of all walls acting on each agent
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``)
+        """
+        radius = self.radius if index is None else self.radius[index]
+        if r.ndim == 2 and self.kernels is not None:
+            return self.f_wa_kernels(r, v, radius)
+        if self.wall_index is not None and r.ndim == 2:
+            return self.f_wa_index(r, v, radius)
+        d, n, t = self.wall_distances(r)
+        overlap = radius[..., None] - d
+        contact = np.maximum(overlap, 0)
+        a = self.A * np.exp(overlap / self.B) + self.k * contact
+        b = self.kap * contact * (v[0][..., None] * t[0] + v[1][..., None] * t[1])
+        return np.sum(a * n - b * t, -1)
+
+    # The force of the walls acting on each agent, only for the walls inside the cutoff
+    def f_wa_index(self, r, v, radius):
+        """ returns a 2D-array, the summed forces of the walls acting on each agent,
+            evaluated only for the (agent, wall) pairs given by the wall index
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``radius``: 1D-array (radius of the agents in ``r``)
+        """
+        room = self.room
+        i, j = self.wall_index.candidates(r)
+        pnt_vec = r[:, i] - room.wall_start[j].T
+        temp = np.clip((pnt_vec[0] * room.wall_unit[j, 0] + pnt_vec[1] * room.wall_unit[j, 1]) / room.wall_len[j],
+                       0.0, 1.0)
+        dist = pnt_vec - room.wall_vec[j].T * temp
+        d = np.sqrt(dist[0] ** 2 + dist[1] ** 2)
+        n = dist / d
+        t = np.stack((-n[1], n[0]))
+        overlap = radius[i] - d
+        contact = np.maximum(overlap, 0)
+        a = self.A * np.exp(overlap / self.B) + self.k * contact
+        b = self.kap * contact * (v[0, i] * t[0] + v[1, i] * t[1])
+        f = a * n - b * t
+        return np.stack((np.bincount(i, f[0], r.shape[1]), np.bincount(i, f[1], r.shape[1])))
+
+    # The force of the walls acting on each agent, with the kernels of the backend
+    def f_wa_kernels(self, r, v, radius):
+        """ returns a 2D-array, the summed forces of the walls acting on each agent
+            parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
+                        ``radius``: 1D-array (radius of the agents in ``r``)
+        """
+        room = self.room
+        r = np.ascontiguousarray(r, dtype=float)
+        v = np.ascontiguousarray(v, dtype=float)
+        radius = np.ascontiguousarray(radius, dtype=float)
+        f_wall = np.zeros((2, r.shape[1]))
+        geometry = (room.wall_start, room.wall_vec, room.wall_len, room.wall_unit)
+        constants = (float(self.A), float(self.B), float(self.k), float(self.kap), f_wall)
+        if self.wall_index is not None:
+            i, j = self.wall_index.candidates(r)
+            self.kernels.wall_pair_forces(r, v, radius, i, j, *geometry, *constants)
+        else:
+            self.kernels.wall_forces(r, v, radius, *geometry, *constants)
+        return f_wall
+
+    # The force of each wall acting on each agents, pair by pair
+    def f_wa_reference(self, r, v):
+        """ returns a 2D-array, the summed forces of all walls acting on each agent
+            computed with f_iW (slow reference path for f_wa)
             parameters: ``r``,``v``: 2D-array (position and velocity of all agents)
         """
         f_wall = np.zeros((2, self.N))
@@ -341,10 +608,29 @@ class Differential_Equation:
 
     # The diff_equation of our problem
     # Calculates the acceleration of each agent
-    def f(self, r, v):
+    def f(self, r, v, active=None):
         """ returns a 2D-array
         v = the velocity at time t
-        r = the position at time t"""
-        e_temp = self.e_t(r)
-        acc = (self.v_0 * e_temp - v) / self.time_step + self.f_ag(r, v) / self.m + self.f_wa(r, v) / self.m
+        r = the position at time t
+        active = 1D-array of booleans or None, the agents still in the room.
+                 Only those are passed to the force kernels; the others get
+                 zero acceleration."""
+        if active is None:
+            e_temp = self.e_t(r)
+            acc = (self.v_0 * e_temp - v) / self.relaxation_time + self.f_ag(r, v) / self.m + self.f_wa(r, v) / self.m
+            return acc
+
+        index = np.flatnonzero(active)
+        acc = np.zeros(r.shape)
+        acc[:, index] = self.acceleration(r[:, index], v[:, index], index)
         return acc
+
+    # The diff_equation for some of the agents
+    def acceleration(self, r, v, index):
+        """ returns a 2D-array, the acceleration of the agents ``index``, feeling only each other
+            parameters: ``r``,``v``: 2D-array (position and velocity of these agents)
+                        ``index``: 1D-array (the agents in the columns of ``r``)
+        """
+        m = self.m[index]
+        return ((self.v_0[index] * self.e_t(r, index) - v) / self.relaxation_time
+                + self.f_ag(r, v, index) / m + self.f_wa(r, v, index) / m)
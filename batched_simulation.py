@@ -0,0 +1,117 @@
+import numpy as np
+
+from agent_interactions import Differential_Equation
+from ensemble import aggregate, replica_result
+from room_layout import Room
+import differential_equation_solver
+import spawn_placement
+from trajectory_sinks import Statistics_Sink
+
+
+class Batched_Differential_Equation(Differential_Equation):
+    def __init__(self, num_individuals, L, time_step, room, radius, weights, navigation="floor_field"):
+        """
+            Differential_Equation for M replicas of a crowd in the same room, advanced in lockstep.
+            The state has the shape (M, 2, N); the radii and weights have the shape (M, N).
+            All agent pairs of a replica are evaluated (no neighbor list), which suits many small crowds.
+
+            Parameters: see Differential_Equation
+        """
+        super().__init__(num_individuals, L, time_step, room, radius, weights, None, navigation)
+        if self.wall_shear and self.floor_field is None:
+            raise ValueError('Batched simulations of rooms with internal walls need navigation="floor_field".')
+
+    def e_t_batched(self, r, agents):
+        """ returns a 3D-array, the normalized desired direction of all agents of all replicas
+            parameters: ``r``: 3D-array of shape (2, M, K) (position of the agents)
+                        ``agents``: 2D-array of shape (M, K) (the agent number of every column of ``r``)
+        """
+        return self.e_t(r.reshape(2, -1), agents.reshape(-1)).reshape(r.shape)
+
+    def f(self, r, v, active=None):
+        """ returns a 3D-array of shape (M, 2, N), the acceleration of all agents of all replicas
+        v = the velocity at time t, shape (M, 2, N)
+        r = the position at time t, shape (M, 2, N)
+        active = array of booleans of shape (M, N) or None, the agents still in the room.
+                 Only those are passed to the force kernels; the others get zero acceleration."""
+        num_replicas = r.shape[0]
+        if active is None:
+            active = np.ones((num_replicas, self.N), dtype=bool)
+        # Compact the agents still in the room to the front of every replica, so the kernels only see
+        # K = the largest number of agents left in a replica. Replicas with fewer agents are padded with
+        # escaped ones, which are parked far away and don't change the forces.
+        width = int(np.max(np.count_nonzero(active, axis=-1), initial=0))
+        acc = np.zeros(r.shape)
+        if width == 0:
+            return acc
+        agents = np.argsort(~active, axis=-1, kind="stable")[:, :width]
+        replicas = np.arange(num_replicas)[:, None]
+        # The kernels of Differential_Equation take the x,y axis first
+        r_active = np.moveaxis(r[replicas, :, agents], -1, 0)
+        v_active = np.moveaxis(v[replicas, :, agents], -1, 0)
+        # The radii and weights of the compacted agents are found with the index (replicas, agents)
+        index = (replicas, agents)
+        acc_active = ((self.v_0[agents] * self.e_t_batched(r_active, agents) - v_active) / self.relaxation_time
+                      + (self.f_ag(r_active, v_active, index) + self.f_wa(r_active, v_active, index)) / self.m[index])
+        present = active[replicas, agents]
+        acc_active[:, ~present] = 0
+        acc[replicas, :, agents] = np.moveaxis(acc_active, 0, -1)
+        return acc
+
+
+class Batched_Simulation:
+    def __init__(self, num_replicas, num_individuals, num_steps, method="staggered_leap_frog", time_step=0.1,
+                 velocity_factor=1.25, room="square_room_with_1_exit", room_size=25, navigation="floor_field",
+                 seed=None):
+        # M independent replicas of the same room, each with its own random agents and positions,
+        # simulated in one (M, 2, N) array with shared room geometry
+        self.M = num_replicas  # Number of replicas
+        self.N = num_individuals  # Number of individuals/agents in each replica
+        self.num_steps = num_steps  # Number of simulation steps
+        self.time_step = time_step  # Time step for the simulation
+        self.method_name = method  # Name of the method for solving differential equations
+        self.room = Room(room, room_size)  # Room shared by all replicas
+
+        # Every replica gets its own random stream, as in ensemble.run_ensemble; the agents are drawn as in
+        # Simulation, so a replica has the same agents as Simulation(..., seed=its seed)
+        self.rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(num_replicas)]
+        variation = np.array([rng.normal(loc=1, scale=0.05, size=num_individuals) for rng in self.rngs])
+        self.radii = 0.25 * variation.reshape(self.M, self.N)  # Radii of the agents of all replicas
+        self.m = 50 * variation.reshape(self.M, self.N)  # Masses of the agents of all replicas
+        self.velocity_factor = velocity_factor  # Desired velocity of the agents
+        self.diff_equ = Batched_Differential_Equation(self.N, room_size, time_step, self.room, self.radii, self.m,
+                                                      navigation)
+
+        self.y = np.zeros((self.M, 2, self.N))  # Initial positions of the agents of all replicas
+        self.v = np.zeros((self.M, 2, self.N))  # Initial velocities of the agents of all replicas
+        self.agents_escaped = None  # Number of escaped agents of each replica at each time step, shape (M, T)
+        self.escape_step = None  # Time step at which each agent escaped, shape (M, N)
+        self.results = None  # Aggregated results of all replicas (see ensemble.aggregate)
+
+    def fill_room(self, method="lattice"):
+        # Fill the spawn zone of every replica with agents having random positions (see Simulation.fill_room)
+        if method not in spawn_placement.methods:
+            raise ValueError('Unknown placement method "' + method + '", use one of '
+                             + ', '.join(spawn_placement.methods) + '.')
+        place = spawn_placement.methods[method]
+        for count, rng in enumerate(self.rngs):
+            self.y[count] = place(self.room.get_spawn_zone(), self.radii[count], self.room.walls, rng)
+            self.v[count] = self.velocity_factor * self.diff_equ.e_t(self.y[count])
+
+    def run(self):
+        # Run all replicas in lockstep, until every replica is evacuated or num_steps is reached,
+        # and keep only their escape curves and peak accelerations
+        sink = Statistics_Sink()
+        sink.start(self.N, None, self.time_step)
+        frames = differential_equation_solver.iterate(self.y, self.v, self.diff_equ.f, self.num_steps,
+                                                      self.time_step, self.room, self.method_name,
+                                                      relaxation_time=self.diff_equ.relaxation_time)
+        for frame in differential_equation_solver.until_evacuated(frames, self.time_step):
+            sink.record(frame)
+        result = sink.finish()
+
+        self.agents_escaped = result["agents_escaped"].T
+        self.escape_step = result["escape_step"]
+        self.force_evaluations = result["force_evaluations"]
+        self.results = aggregate([replica_result(self.agents_escaped[count], result["peak_acceleration"][count],
+                                                 self.m[count], self.time_step) for count in range(self.M)])
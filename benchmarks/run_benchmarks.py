@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import differential_equation_solver
+import force_backends
+from agent_interactions import Differential_Equation
+from model_simulation import Simulation
+from room_layout import Room, layouts
+
+# Benchmarks of the force kernels, the integrator and the placement of the agents.
+# For every room layout and number of agents, a seeded Simulation is filled and the following are
+# timed on its starting state:
+# - "f_ag": forces between the agents
+# - "f_wa": forces of the walls
+# - "e_t": desired directions ("e_t_geometric": with navigation="geometric", in rooms with wall_shear)
+# - "leap_frog_step": the first time step of the staggered leap-frog method from the starting state,
+#   including the escape check (every call starts again from the same state)
+# - "fill_room": placing all agents in the spawn zone
+# Each benchmark is called once to warm up, then repeated until min_time seconds have passed; the
+# median time per call is what is compared. One more call runs under tracemalloc to measure the peak
+# memory it allocates. tracemalloc only sees memory allocated through Python and NumPy, not that of
+# compiled Numba kernels, so the peak memory of the benchmarks that run them is not reported (None)
+# with the numba backend.
+# The results are written as JSON. With --baseline, the medians are compared with a stored result
+# and the script fails (exit code 1) if a benchmark got slower by more than the tolerance.
+#
+# Examples:
+#   python benchmarks/run_benchmarks.py --output baseline.json
+#   python benchmarks/run_benchmarks.py --sizes 30 300 --baseline baseline.json --tolerance 0.2
+
+benchmark_names = ("f_ag", "f_wa", "e_t", "e_t_geometric", "leap_frog_step", "fill_room")
+compiled_benchmarks = ("f_ag", "f_wa", "leap_frog_step")  # The benchmarks that run the force kernels
+
+
+def room_size_for(num_individuals):
+    # The room grows with the crowd, so that the spawn zone has the same density for every N
+    return 25 * max(1.0, np.sqrt(num_individuals / 300))
+
+
+def cutoff_for(num_individuals, cutoff):
+    # "auto": all agent pairs up to 3000 agents, a cutoff of 2 m above (the (N, N) arrays of the
+    # dense kernels would not fit into memory)
+    if cutoff == "auto":
+        return None if num_individuals <= 3000 else 2.0
+    if cutoff == "none":
+        return None
+    return float(cutoff)
+
+
+def measure(function, min_time, max_repeats, setup=None, trace_memory=True):
+    """ returns a dictionary, the times of a benchmark (in seconds per call) and its peak memory
+        parameters: ``function``: the benchmark, called without arguments
+                    ``min_time``: float, seconds of repeated calls (at least one call)
+                    ``max_repeats``: integer, largest number of timed calls
+                    ``setup``: function or None, called without arguments before every call, not timed
+                    ``trace_memory``: boolean, measure the peak memory (None otherwise)
+    """
+    def call():
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        function()
+        return time.perf_counter() - started
+
+    call()
+    times = []
+    while not times or (sum(times) < min_time and len(times) < max_repeats):
+        times.append(call())
+
+    peak = None
+    if trace_memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        function()
+        peak = int(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "mean": float(np.mean(times)),
+            "repeats": len(times), "peak_memory": peak}
+
+
+def benchmarks_for(room_name, num_individuals, cutoff, backend, seed):
+    """ returns a dictionary, the benchmark functions for one room and number of agents, by name;
+        a benchmark that needs a setup before every call is a pair (setup, function)
+        parameters: ``room_name``: string, a layout of room_layout
+                    ``num_individuals``: integer, number of agents
+                    ``cutoff``: float or None, interaction cutoff (see Differential_Equation)
+                    ``backend``: string, force backend (see force_backends)
+                    ``seed``: integer, seed of the agents and their positions
+    """
+    room_size = room_size_for(num_individuals)
+    room = Room(room_name, room_size)
+    simulation = Simulation(num_individuals, None, method="staggered_leap_frog", room=room, room_size=room_size,
+                            cutoff=cutoff, seed=seed, backend=backend)
+    simulation.fill_room()
+    diff_equ = simulation.diff_equ
+    r = simulation.y[:, :, 0].copy()
+    v = simulation.v[:, :, 0].copy()
+
+    # Every step starts again from the starting state (r, v), so all repeats time the same step
+    stream = {}
+
+    def start_stream():
+        stream["frames"] = differential_equation_solver.iterate(r, v, diff_equ.f, None, simulation.time_step, room,
+                                                                simulation.method_name)
+        next(stream["frames"])
+
+    def leap_frog_step():
+        next(stream["frames"])
+
+    functions = {"f_ag": lambda: diff_equ.f_ag(r, v),
+                 "f_wa": lambda: diff_equ.f_wa(r, v),
+                 "e_t": lambda: diff_equ.e_t(r),
+                 "leap_frog_step": (start_stream, leap_frog_step),
+                 "fill_room": simulation.fill_room}
+    if room.wall_shear:
+        geometric = Differential_Equation(num_individuals, room_size, simulation.time_step, room, simulation.radii,
+                                          simulation.m, cutoff, "geometric", backend)
+        functions["e_t_geometric"] = lambda: geometric.e_t(r)
+    return functions
+
+
+def result_key(result):
+    return "%s|%s|%d|%s" % (result["benchmark"], result["room"], result["N"], result["cutoff"])
+
+
+def run(sizes, rooms, names, cutoff="auto", backend="auto", seed=0, min_time=0.2, max_repeats=100):
+    """ returns a list of dictionaries, one result per benchmark, room and number of agents
+        parameters: see the command line arguments
+    """
+    results = []
+    for num_individuals in sizes:
+        for room_name in rooms:
+            cut = cutoff_for(num_individuals, cutoff)
+            functions = benchmarks_for(room_name, num_individuals, cut, backend, seed)
+            used = force_backends.resolve(backend)
+            for name in names:
+                if name not in functions:
+                    continue
+                setup, function = functions[name] if isinstance(functions[name], tuple) else (None, functions[name])
+                result = {"benchmark": name, "room": room_name, "N": num_individuals, "cutoff": cut, "backend": used}
+                traced = used != "numba" or name not in compiled_benchmarks
+                result.update(measure(function, min_time, max_repeats, setup, traced))
+                results.append(result)
+                memory = "n/a" if result["peak_memory"] is None else "%.1f MB" % (result["peak_memory"] / 2 ** 20)
+                print("%-15s %-45s N=%-6d %10.3f ms  %11s" % (name, room_name, num_individuals,
+                                                              1000 * result["median"], memory), flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ returns a list of strings, the benchmarks that are slower than in the baseline by more than the tolerance
+        parameters: ``results``: list of dictionaries (see run)
+                    ``baseline``: list of dictionaries, stored results
+                    ``tolerance``: float, allowed relative slowdown (0.2: 20 % slower)
+    """
+    before = {result_key(result): result for result in baseline}
+    slower = []
+    for result in results:
+        old = before.get(result_key(result))
+        if old is None:
+            continue
+        ratio = result["median"] / old["median"]
+        if ratio > 1 + tolerance:
+            slower.append("%s: %.3f ms -> %.3f ms (%+.0f %%)" % (result_key(result), 1000 * old["median"],
+                                                                1000 * result["median"], 100 * (ratio - 1)))
+    return slower
+
+
+def machine_info(seed, backend):
+    # Where and with what the benchmarks ran, to compare results across commits
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "seed": seed, "backend": backend}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the force kernels, integrator and room filling.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[30, 300, 3000, 10000], help="numbers of agents")
+    parser.add_argument("--rooms", nargs="+", default=layouts(), help="room layouts (default: all)")
+    parser.add_argument("--benchmarks", nargs="+", default=list(benchmark_names), choices=benchmark_names)
+    parser.add_argument("--cutoff", default="auto", help='"auto", "none" or a distance in metres')
+    parser.add_argument("--backend", default="auto", help="force backend (see force_backends)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds of repeated calls per benchmark")
+    parser.add_argument("--max-repeats", type=int, default=100)
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args(arguments)
+
+    results = run(args.sizes, args.rooms, args.benchmarks, args.cutoff, args.backend, args.seed, args.min_time,
+                  args.max_repeats)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"machine": machine_info(args.seed, args.backend), "results": results}, output_file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print("Slower than the baseline by more than %d %%:" % (100 * args.tolerance))
+            print("\n".join(slower))
+            return 1
+        print("No benchmark is slower than the baseline by more than %d %%." % (100 * args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
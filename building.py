@@ -0,0 +1,528 @@
+import heapq
+import multiprocessing
+import os
+
+import numpy as np
+
+from agent_interactions import Differential_Equation
+from room_layout import Room, outline_walls
+import spawn_placement
+
+# A building is a set of rectangular zones (rooms, corridors, halls) connected by doors.
+# Every zone is simulated as a Room of its own, in local coordinates with the origin at its lower left
+# corner. Every agent walks to the door of its zone that is on its shortest way out of the building,
+# from where it stands; when it crosses a door into another zone it is handed over to that zone, and
+# when it crosses an exit it has escaped. Agents pushed across a wall are put back into their zone.
+# The zones are stepped with the leap-frog scheme of differential_equation_solver, split into groups
+# that run on worker processes. Each step has two phases:
+# - drift: every group moves its agents and reports the agents that left their zone and the agents
+#   near a door (the halo), which interact with the agents on the other side
+# - kick: every group takes the agents that entered its zones, computes the forces on its agents with
+#   the halo agents of the neighbouring zones, and updates the velocities
+# Only the halo agents and the agents changing zones are exchanged between the processes.
+
+outward = {"bottom": np.array([0.0, -1.0]), "right": np.array([1.0, 0.0]),
+           "top": np.array([0.0, 1.0]), "left": np.array([-1.0, 0.0])}
+
+
+class Zone:
+    def __init__(self, name, width, height, offset=(0, 0), obstacles=()):
+        """
+            A rectangular part of a building.
+
+            Parameters:
+            - ``name``: string, name of the zone
+            - ``width``, ``height``: float, size of the zone
+            - ``offset``: position of the lower left corner of the zone in the building
+            - ``obstacles``: list of wall segments [[x0, y0], [x1, y1]] inside the zone, in local coordinates
+
+            Attributes:
+            - ``doors``: list of dictionaries, the doors of the zone with their "side", "position"
+              (centre along the side, local), "width", "centre" (in the building) and "to" (the name of the
+              zone behind the door, None for an exit)
+            - ``door_cost``: list of floats, the shortest way out of the building behind every door
+              (infinite for doors that don't lead out)
+            - ``room``: the Room of the zone, built by Building.compile
+        """
+        self.name = name
+        self.width = width
+        self.height = height
+        self.offset = np.array(offset, dtype=float)
+        self.obstacles = [np.array(obstacle, dtype=float) for obstacle in obstacles]
+        self.doors = []
+        self.door_cost = None
+        self.room = None
+
+    def contains(self, r):
+        """ returns a 1D-array of booleans, which points (in building coordinates) are inside the zone
+            parameters: ``r``: 2D-array of shape (2, P)
+        """
+        local = r - self.offset[:, None]
+        return ((local[0] >= 0) & (local[0] <= self.width) & (local[1] >= 0) & (local[1] <= self.height))
+
+    def compile(self):
+        # Build the room of the zone: outer walls open at the doors, the obstacles, and the points
+        # 0.5 m behind the doors that lead out as destinations, with the way that remains behind them
+        walls, _ = outline_walls(self.width, [(d["side"], d["position"], d["width"]) for d in self.doors],
+                                 self.height)
+        walls += self.obstacles
+        ways_out = [d for d, cost in enumerate(self.door_cost) if np.isfinite(cost)]
+        destination = [self.doors[d]["centre"] - self.offset + 0.5 * outward[self.doors[d]["side"]]
+                       for d in ways_out]
+        spawn_zone = [[1, self.width - 1], [1, self.height - 1]]
+        door_size = min(d["width"] for d in self.doors)
+        self.room = Room.from_geometry(self.name, max(self.width, self.height), walls, destination, spawn_zone,
+                                       door_size, len(self.obstacles) > 0, len(self.obstacles),
+                                       [self.door_cost[d] for d in ways_out])
+
+
+class Building:
+    def __init__(self):
+        """
+            Zones connected by doors. Zones are added with add_zone, doors between two zones with add_door
+            and doors to the outside with add_exit; compile builds the rooms and the routes.
+        """
+        self.zones = {}
+        self.portals = []  # Centre and zones of every door: (centre, zone, other zone or None)
+
+    def add_zone(self, name, width, height, offset=(0, 0), obstacles=()):
+        # Add a rectangular zone, see Zone
+        if name in self.zones:
+            raise ValueError('There is already a zone "' + name + '".')
+        self.zones[name] = Zone(name, width, height, offset, obstacles)
+        return self.zones[name]
+
+    def add_door(self, zone_a, zone_b, position, width):
+        # Add a door of the given width between two zones that touch each other; position is the
+        # centre of the door along the shared wall, in building coordinates
+        a = self.zones[zone_a]
+        b = self.zones[zone_b]
+        for side, axis, edge_a, edge_b in (("right", 0, a.offset[0] + a.width, b.offset[0]),
+                                           ("left", 0, a.offset[0], b.offset[0] + b.width),
+                                           ("top", 1, a.offset[1] + a.height, b.offset[1]),
+                                           ("bottom", 1, a.offset[1], b.offset[1] + b.height)):
+            if np.isclose(edge_a, edge_b):
+                other = {"right": "left", "left": "right", "top": "bottom", "bottom": "top"}[side]
+                centre = np.zeros(2)
+                centre[axis] = edge_a
+                centre[1 - axis] = position
+                self.add_portal(centre, [(a, side, zone_b), (b, other, zone_a)], width)
+                return
+        raise ValueError('The zones "' + zone_a + '" and "' + zone_b + '" do not touch.')
+
+    def add_exit(self, zone, side, position, width):
+        # Add a door to the outside on a side ("left", "right", "bottom" or "top") of a zone; position is
+        # the centre of the door along that side, in building coordinates
+        z = self.zones[zone]
+        centre = z.offset + {"bottom": [position - z.offset[0], 0], "top": [position - z.offset[0], z.height],
+                             "left": [0, position - z.offset[1]], "right": [z.width, position - z.offset[1]]}[side]
+        self.add_portal(centre, [(z, side, None)], width)
+
+    def add_portal(self, centre, ends, width):
+        for zone, side, to in ends:
+            along = centre[1] - zone.offset[1] if side in ("left", "right") else centre[0] - zone.offset[0]
+            zone.doors.append({"side": side, "position": along, "width": width, "centre": centre, "to": to,
+                               "portal": len(self.portals)})
+        self.portals.append((centre, ends[0][0].name, ends[1][0].name if len(ends) > 1 else None))
+
+    def route(self):
+        # Dijkstra over the doors: the walking distance from every door to the nearest exit
+        cost = np.full(len(self.portals), np.inf)
+        queue = []
+        for p, (centre, zone, other) in enumerate(self.portals):
+            if other is None:
+                cost[p] = 0.0
+                queue.append((0.0, p))
+        heapq.heapify(queue)
+        while queue:
+            c, p = heapq.heappop(queue)
+            if c > cost[p]:
+                continue
+            centre, zone, other = self.portals[p]
+            for name in (zone, other):
+                if name is None:
+                    continue
+                for door in self.zones[name].doors:
+                    q = door["portal"]
+                    c_q = c + np.linalg.norm(door["centre"] - centre)
+                    if c_q < cost[q]:
+                        cost[q] = c_q
+                        heapq.heappush(queue, (c_q, q))
+
+        # The agents of a zone choose among its doors by their own position (see Differential_Equation.e_0_all).
+        # The way out behind a door continues through the zone on the other side, so a door into a dead end
+        # is never taken
+        for zone in self.zones.values():
+            zone.door_cost = []
+            for door in zone.doors:
+                ways = [0.0] if door["to"] is None else [
+                    np.linalg.norm(other["centre"] - door["centre"]) + cost[other["portal"]]
+                    for other in self.zones[door["to"]].doors if other["portal"] != door["portal"]]
+                zone.door_cost.append(float(min(ways, default=np.inf)))
+            if not np.isfinite(min(zone.door_cost, default=np.inf)):
+                raise ValueError('There is no way out of the zone "' + zone.name + '".')
+
+    def compile(self):
+        # Find the routes and build the rooms of all zones
+        self.route()
+        for zone in self.zones.values():
+            zone.compile()
+
+
+def office_floor(num_rooms=4, room_size=10, corridor_width=4, door_width=1.2, exit_width=2.0):
+    """ returns a Building, a row of square rooms above a corridor with an exit at both ends.
+        Every room has a door to the corridor.
+        parameters: ``num_rooms``: integer, number of rooms
+                    ``room_size``: float, width and depth of the rooms
+                    ``corridor_width``: float, width of the corridor
+                    ``door_width``, ``exit_width``: float, width of the room doors and of the exits
+    """
+    building = Building()
+    building.add_zone("corridor", num_rooms * room_size, corridor_width)
+    for i in range(num_rooms):
+        name = "room_" + str(i)
+        building.add_zone(name, room_size, room_size, offset=(i * room_size, corridor_width))
+        building.add_door(name, "corridor", (i + 0.5) * room_size, door_width)
+    building.add_exit("corridor", "left", corridor_width / 2, exit_width)
+    building.add_exit("corridor", "right", corridor_width / 2, exit_width)
+    building.compile()
+    return building
+
+
+class Zone_Group:
+    def __init__(self, zones, radii, masses, time_step, velocity_factor, cutoff, navigation, halo):
+        """
+            The zones stepped by one process, with their agents in local coordinates.
+
+            Parameters:
+            - ``zones``: list of Zone, the compiled zones of the group
+            - ``radii``, ``masses``, ``velocity_factor``: 1D-array, for all agents of the building
+            - ``time_step``, ``cutoff``, ``navigation``: see Differential_Equation
+            - ``halo``: float, distance from a door within which agents are sent to the other side
+        """
+        self.zones = zones
+        self.radii = radii
+        self.masses = masses
+        self.time_step = time_step
+        self.velocity_factor = velocity_factor
+        self.cutoff = cutoff
+        self.navigation = navigation
+        self.halo = halo
+
+    def prepare(self, agents):
+        # Set up the differential equations of the zones (in the process that steps them, so that the
+        # floor fields of all groups are computed in parallel) and put the agents into the zones.
+        # agents: dictionary, zone name -> (ids, positions in building coordinates)
+        for zone in self.zones:
+            zone.diff_equ = Differential_Equation(len(self.radii), zone.room.room_size, self.time_step, zone.room,
+                                                  self.radii, self.masses, self.cutoff, self.navigation)
+            zone.ids = np.zeros(0, dtype=int)
+            zone.y = np.zeros((2, 0))
+            zone.v = np.zeros((2, 0))
+            if zone.name in agents:
+                self.add(zone, *agents[zone.name])
+
+    def add(self, zone, ids, y, v=None):
+        # Put agents (building coordinates) into a zone; without velocities they start walking
+        # towards the next door
+        y = y - zone.offset[:, None]
+        if v is None:
+            v = self.velocity_factor[ids] * zone.diff_equ.e_t(y, ids)
+        zone.ids = np.concatenate((zone.ids, ids))
+        zone.y = np.concatenate((zone.y, y), axis=1)
+        zone.v = np.concatenate((zone.v, v), axis=1)
+
+    def drift(self, dt):
+        """ moves the agents by dt and returns a dictionary:
+            - "moves": list of (zone name, ids, y, v), the agents that crossed a door into another zone
+            - "halo": list of (zone name, ids, y, v), the agents near a door, for the zone on the other side
+            - "escaped": 1D-array, the agents that crossed an exit
+            Positions are in building coordinates.
+            parameters: ``dt``: float, time step
+        """
+        moves = []
+        halo = []
+        escaped = []
+        for zone in self.zones:
+            before = zone.y
+            zone.y = zone.y + dt * zone.v
+            outside = ((zone.y[0] < 0) | (zone.y[0] > zone.width) | (zone.y[1] < 0) | (zone.y[1] > zone.height))
+            if np.any(outside):
+                # The door each agent went through (-1: none)
+                passed = np.full(len(zone.ids), -1)
+                for d, door in enumerate(zone.doors):
+                    passed[outside & (passed < 0) & self.crossed(zone, door, before, zone.y)] = d
+                y = zone.y + zone.offset[:, None]
+                for d, door in enumerate(zone.doors):
+                    through = passed == d
+                    if not np.any(through):
+                        continue
+                    if door["to"] is None:
+                        escaped.append(zone.ids[through])
+                    else:
+                        moves.append((door["to"], zone.ids[through], y[:, through], zone.v[:, through]))
+                        # They are still next to the door, so they are also halo agents of this zone
+                        halo.append((zone.name, zone.ids[through], y[:, through], zone.v[:, through]))
+                self.push_back(zone, outside & (passed < 0))
+                keep = passed < 0
+                zone.ids = zone.ids[keep]
+                zone.y = zone.y[:, keep]
+                zone.v = zone.v[:, keep]
+            y = zone.y + zone.offset[:, None]
+            for door in zone.doors:
+                if door["to"] is None:
+                    continue
+                near = np.linalg.norm(y - door["centre"][:, None], axis=0) <= self.halo + door["width"] / 2
+                if np.any(near):
+                    halo.append((door["to"], zone.ids[near], y[:, near], zone.v[:, near]))
+        escaped = np.concatenate(escaped) if escaped else np.zeros(0, dtype=int)
+        return {"moves": moves, "halo": halo, "escaped": escaped}
+
+    def crossed(self, zone, door, before, after):
+        """ returns a 1D-array of booleans, which agents went through the opening of a door of the zone
+            parameters: ``zone``: Zone
+                        ``door``: dictionary, one of zone.doors
+                        ``before``, ``after``: 2D-array, local positions of the agents of the zone before and
+                                               after the move
+        """
+        axis = 0 if door["side"] in ("left", "right") else 1
+        edge = {"left": 0.0, "bottom": 0.0, "right": zone.width, "top": zone.height}[door["side"]]
+        direction = outward[door["side"]][axis]
+        beyond = (after[axis] - edge) * direction > 0
+        # Where the path of the agent meets the line of the side
+        step = after[axis] - before[axis]
+        fraction = np.clip((edge - before[axis]) / np.where(step != 0, step, 1), 0, 1)
+        along = before[1 - axis] + fraction * (after[1 - axis] - before[1 - axis])
+        return beyond & (np.abs(along - door["position"]) <= door["width"] / 2)
+
+    def push_back(self, zone, pushed):
+        # Reflect agents that were pushed across a wall back into their zone (at least their radius away from
+        # its sides) and stop their motion through the wall
+        if not np.any(pushed):
+            return
+        radius = self.radii[zone.ids[pushed]]
+        for axis, size in ((0, zone.width), (1, zone.height)):
+            low = np.minimum(radius, size / 2)
+            position = zone.y[axis, pushed]
+            velocity = zone.v[axis, pushed]
+            reflected = np.where(position < low, 2 * low - position, position)
+            reflected = np.where(reflected > size - low, 2 * (size - low) - reflected, reflected)
+            zone.y[axis, pushed] = np.clip(reflected, low, size - low)
+            through = ((position < low) & (velocity < 0)) | ((position > size - low) & (velocity > 0))
+            zone.v[axis, pushed] = np.where(through, 0.0, velocity)
+
+    def kick(self, dt, arrivals, ghosts, record=False):
+        """ takes the arriving agents, updates the velocities of all agents by dt times their acceleration,
+            and returns a dictionary with the number of agents in each zone ("counts") and, if record is
+            True, the ids and the positions (building coordinates) of all agents ("ids", "y")
+            parameters: ``arrivals``, ``ghosts``: dictionaries, zone name -> list of (ids, y, v)
+        """
+        for zone in self.zones:
+            for ids, y, v in arrivals.get(zone.name, []):
+                self.add(zone, ids, y, v)
+            n = len(zone.ids)
+            ids = zone.ids
+            y = zone.y
+            v = zone.v
+            others = ghosts.get(zone.name, [])
+            if others:
+                ids = np.concatenate([ids] + [g[0] for g in others])
+                y = np.concatenate([y] + [g[1] - zone.offset[:, None] for g in others], axis=1)
+                v = np.concatenate([v] + [g[2] for g in others], axis=1)
+            if n > 0:
+                # Forces on the agents of the zone, including those of the halo agents; the halo agents
+                # themselves are updated by their own zone
+                zone.v = zone.v + dt * zone.diff_equ.acceleration(y, v, ids)[:, :n]
+        result = {"counts": {zone.name: len(zone.ids) for zone in self.zones}}
+        if record:
+            result["ids"] = np.concatenate([zone.ids for zone in self.zones])
+            result["y"] = np.concatenate([zone.y + zone.offset[:, None] for zone in self.zones], axis=1)
+        return result
+
+
+def zone_worker(connection, group):
+    # Runs the commands sent by the building simulation on a group of zones in a worker process
+    while True:
+        command, args = connection.recv()
+        if command == "stop":
+            break
+        connection.send(getattr(group, command)(*args))
+    connection.close()
+
+
+class Local_Group:
+    # A group of zones stepped in this process
+    def __init__(self, group):
+        self.group = group
+
+    def send(self, command, *args):
+        self.reply = getattr(self.group, command)(*args)
+
+    def receive(self):
+        return self.reply
+
+    def close(self):
+        pass
+
+
+class Remote_Group:
+    # A group of zones stepped in a worker process
+    def __init__(self, group):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=zone_worker, args=(child, group), daemon=True)
+        self.process.start()
+        child.close()
+
+    def send(self, command, *args):
+        self.connection.send((command, args))
+
+    def receive(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.connection.send(("stop", ()))
+        self.process.join()
+
+
+# Longest stable leap-frog step (in seconds) for agents in contact: about 2 * sqrt(m / k), with the mass m
+# and the body stiffness k of Differential_Equation
+max_substep = 0.04
+
+
+class Building_Simulation:
+    def __init__(self, building, num_individuals, num_steps, time_step=0.1, velocity_factor=1.25, cutoff=2.0,
+                 navigation="floor_field", halo=None, processes=None, seed=None, substeps=None):
+        # Evacuation of a whole building. The zones are stepped in parallel on ``processes`` worker
+        # processes (None: one per core, at most one per zone; 1: everything in this process).
+        # Agents only interact within the cutoff, so zones only need the agents of their neighbours
+        # within ``halo`` (default: the cutoff) of the doors.
+        # Every time step is made of ``substeps`` leap-frog steps (None: enough to keep them below max_substep,
+        # above which agents pressed against each other start to oscillate and fly through the walls).
+        self.building = building
+        self.N = num_individuals  # Number of individuals/agents in the building
+        self.num_steps = num_steps  # Maximum number of simulation steps
+        self.time_step = time_step  # Time step for the simulation
+        self.cutoff = cutoff  # Distance beyond which agents don't interact
+        self.navigation = navigation  # How agents find the door around internal walls
+        self.halo = cutoff if halo is None else halo
+        self.processes = processes
+        if substeps is None:
+            substeps = int(np.ceil(time_step / max_substep - 1e-9))
+        self.substeps = substeps  # Leap-frog steps per time step
+        self.rng = np.random if seed is None else np.random.default_rng(seed)
+
+        # Agent information, as in Simulation
+        variation = self.rng.normal(loc=1, scale=0.05, size=num_individuals)
+        self.radii = 0.25 * variation  # Radii of agents
+        self.m = 50 * variation  # Mass of agents
+        self.velocity_factor = velocity_factor * np.ones(self.N)  # Desired velocity of agents
+
+        self.agents = {}  # Agents of every zone before the run: zone name -> (ids, positions)
+        self.agents_escaped = None  # Number of agents that have escaped at each time step
+        self.escape_step = None  # Time step at which each agent escaped (-1: still inside)
+        self.zone_counts = None  # Number of agents in each zone at each time step, in the order of building.zones
+        self.y = None  # Recorded positions (2, N, frames), nan for escaped agents
+        self.evacuation_time = None  # Time until everybody escaped (nan if somebody is left)
+
+    def fill_room(self, per_zone=None, method="lattice"):
+        # Place the agents in the spawn zones of the building's zones, by default in proportion to the
+        # area of the zones (see spawn_placement for the placement methods)
+        zones = list(self.building.zones.values())
+        if per_zone is None:
+            area = np.array([np.prod(np.diff(z.room.get_spawn_zone(), axis=1)) for z in zones])
+            per_zone = np.floor(self.N * area / np.sum(area)).astype(int)
+            per_zone[:self.N - np.sum(per_zone)] += 1
+            per_zone = dict(zip(self.building.zones, per_zone))
+        if sum(per_zone.values()) != self.N:
+            raise ValueError('The zones hold ' + str(sum(per_zone.values())) + ' agents, not ' + str(self.N) + '.')
+
+        place = spawn_placement.methods[method]
+        self.agents = {}
+        start = 0
+        for zone in zones:
+            ids = np.arange(start, start + per_zone.get(zone.name, 0))
+            start += len(ids)
+            if len(ids) == 0:
+                continue
+            y = place(zone.room.get_spawn_zone(), self.radii[ids], zone.room.walls, self.rng)
+            self.agents[zone.name] = (ids, y + zone.offset[:, None])
+
+    def start_groups(self):
+        # Split the zones into groups, one per process, and start them
+        zones = list(self.building.zones.values())
+        processes = self.processes or os.cpu_count() or 1
+        processes = max(1, min(processes, len(zones)))
+        groups = []
+        for p in range(processes):
+            group = Zone_Group(zones[p::processes], self.radii, self.m, self.time_step,
+                               self.velocity_factor, self.cutoff, self.navigation, self.halo)
+            groups.append(Local_Group(group) if processes == 1 else Remote_Group(group))
+        for group in groups:
+            group.send("prepare", self.agents)
+        for group in groups:
+            group.receive()
+        self.group_of = {zone.name: p % processes for p, zone in enumerate(zones)}
+        return groups
+
+    def exchange(self, groups, drift, kick, record):
+        # One drift and kick phase of all groups; returns the escaped agents and the kick results
+        for group in groups:
+            group.send("drift", drift)
+        arrivals = [{} for _ in groups]
+        ghosts = [{} for _ in groups]
+        escaped = []
+        for group in groups:
+            out = group.receive()
+            escaped.append(out["escaped"])
+            for key, target in (("moves", arrivals), ("halo", ghosts)):
+                for name, ids, y, v in out[key]:
+                    target[self.group_of[name]].setdefault(name, []).append((ids, y, v))
+        for group, arriving, near in zip(groups, arrivals, ghosts):
+            group.send("kick", kick, arriving, near, record)
+        return np.concatenate(escaped), [group.receive() for group in groups]
+
+    def run(self, every=None):
+        # Run until everybody escaped or num_steps is reached. With every, the positions of all agents are
+        # recorded every ``every`` steps in self.y
+        zones = list(self.building.zones)
+        self.escape_step = np.full(self.N, -1)
+        agents_escaped = []
+        zone_counts = []
+        frames = []
+        escaped_so_far = 0
+        groups = self.start_groups()
+        try:
+            # Leap-frog: kick the velocities half a step ahead of the positions
+            h = self.time_step / self.substeps
+            escaped, results = self.exchange(groups, 0.0, 0.5 * h, every is not None)
+            for k in range(self.num_steps):
+                if k > 0:
+                    escaped = []
+                    for sub in range(self.substeps):
+                        out, results = self.exchange(groups, h, h, every is not None and k % every == 0
+                                                     and sub == self.substeps - 1)
+                        escaped.append(out)
+                    escaped = np.concatenate(escaped)
+                self.escape_step[escaped] = k
+                escaped_so_far += len(escaped)
+                agents_escaped.append(escaped_so_far)
+                counts = {}
+                for result in results:
+                    counts.update(result["counts"])
+                zone_counts.append([counts[name] for name in zones])
+                if "ids" in results[0]:
+                    frame = np.full((2, self.N), np.nan)
+                    for result in results:
+                        frame[:, result["ids"]] = result["y"]
+                    frames.append(frame)
+                if escaped_so_far == self.N:
+                    break
+        finally:
+            for group in groups:
+                group.close()
+
+        self.agents_escaped = np.array(agents_escaped, dtype=float)
+        self.zone_counts = np.array(zone_counts)
+        self.y = np.stack(frames, axis=2) if frames else None
+        everyone_out = np.flatnonzero(self.agents_escaped >= self.N)
+        self.evacuation_time = everyone_out[0] * self.time_step if len(everyone_out) else np.nan
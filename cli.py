@@ -0,0 +1,159 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+# Command line interface of the simulation (run.py).
+# All options can also be given in a JSON config file (--config), with the option names as keys and
+# dashes written as underscores, e.g. {"room": "square_room_with_2_exits", "num_individuals": 100}.
+# Options given on the command line override the config file.
+# As the original run.py, a plain run shows the graphs and the run in a window afterwards (--show). Once
+# another output (--output, --summary, --profile, --trace, --export, --live) or --headless is given,
+# nothing is drawn unless asked for, and pygame and matplotlib are not imported, so the command also
+# runs on headless machines.
+#
+# Examples:
+#   python run.py
+#   python run.py --headless
+#   python run.py --room square_room_with_2_exits -n 200 --steps 3000 --seed 1 --summary result.json
+#   python run.py --config experiment.json --output runs/experiment --export runs/experiment.mp4 --every 5
+
+
+def build_parser():
+    """ returns an argparse.ArgumentParser, the options of the command line """
+    from room_layout import layouts
+    from spawn_placement import methods as placement_methods
+    import differential_equation_solver
+
+    parser = argparse.ArgumentParser(description="Simulate the evacuation of a room.")
+    parser.add_argument("--config", help="JSON file with options (the command line overrides it)")
+
+    simulation = parser.add_argument_group("simulation")
+    simulation.add_argument("--room", default="square_room_with_1_exit_1_additional_wall",
+                            help="room layout (" + ", ".join(layouts()) + ") or the path of a JSON layout")
+    simulation.add_argument("--room-size", type=float, default=25, help="size of the room in metres")
+    simulation.add_argument("-n", "--num-individuals", type=int, default=30, help="number of agents")
+    simulation.add_argument("--steps", type=int, default=1000,
+                            help="number of time steps (with --until-evacuated only an upper limit)")
+    simulation.add_argument("--method", default="staggered_leap_frog",
+                            choices=list(differential_equation_solver.methods) + ["adaptive"])
+    simulation.add_argument("--time-step", type=float, default=0.1)
+    simulation.add_argument("--relaxation-time", type=float,
+                            help="time in which agents reach their desired velocity (default: the time step)")
+    simulation.add_argument("--velocity-factor", type=float, default=1.25)
+    simulation.add_argument("--seed", type=int, help="seed of the random numbers (default: not reproducible)")
+    simulation.add_argument("--placement", default="lattice", choices=list(placement_methods))
+    simulation.add_argument("--cutoff", type=float, help="interaction cutoff in metres (default: all pairs)")
+    simulation.add_argument("--navigation", default="floor_field", choices=["floor_field", "geometric"])
+    simulation.add_argument("--backend", default="auto", help="force backend: auto, numpy, numba or python")
+    simulation.add_argument("--force-processes", type=int, default=1, help="processes computing the forces")
+    simulation.add_argument("--until-evacuated", action="store_true",
+                            help="stop as soon as everybody escaped")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", help="directory to store the trajectory in (see trajectory_store)")
+    output.add_argument("--keep-forces", action="store_true",
+                        help="also store the accelerations of the agents with --output")
+    output.add_argument("--every", type=int, default=1, help="keep or render one frame out of EVERY")
+    output.add_argument("--summary", help="JSON file for the summary of the run")
+    output.add_argument("--profile", help="JSON file for the per-phase profile of the run")
+    output.add_argument("--trace", help="Chrome trace file of the run")
+    output.add_argument("--export", help="render to a video file (e.g. run.mp4) or a directory of PNG frames")
+    output.add_argument("--scale", type=float, default=1.0, help="resolution factor of --export")
+    output.add_argument("--show", action="store_true",
+                        help="show the graphs and the run in a window afterwards (the default without other outputs)")
+    output.add_argument("--headless", action="store_true", help="don't show anything, only print the summary")
+    output.add_argument("--live", action="store_true", help="show the run in a window while it runs")
+    output.add_argument("--sim-size", type=int, default=600, help="size of the room on the screen in pixels")
+    output.add_argument("--wait-time", type=int, default=10, help="milliseconds between frames of --show")
+    return parser
+
+
+def parse_arguments(arguments=None):
+    """ returns an argparse.Namespace, the options from the config file and the command line
+        parameters: ``arguments``: list of strings or None (None: sys.argv)
+    """
+    parser = build_parser()
+    args = parser.parse_args(arguments)
+    if args.config:
+        with open(args.config) as config_file:
+            config = json.load(config_file)
+        known = {action.dest for action in parser._actions}
+        unknown = [key for key in config if key.replace("-", "_") not in known]
+        if unknown:
+            parser.error("unknown options in " + args.config + ": " + ", ".join(unknown))
+        # The config file replaces the defaults, so the command line still overrides it
+        parser.set_defaults(**{key.replace("-", "_"): value for key, value in config.items()})
+        args = parser.parse_args(arguments)
+    # Without any other output, the run is shown, as by the original run.py
+    outputs = (args.output, args.summary, args.profile, args.trace, args.export, args.live, args.headless)
+    if not any(outputs):
+        args.show = True
+    return args
+
+
+def summary(simulation):
+    """ returns a dictionary, the main results of a run (JSON serializable) """
+    safety = simulation.safety
+    crushed = safety["first_crush_step"] >= 0
+    return {"room": simulation.room_name, "num_individuals": simulation.N, "method": simulation.method_name,
+            "time_step": simulation.time_step, "steps": int(simulation.results["steps"]),
+            "stop_reason": simulation.results["stop_reason"],
+            "escaped": int(np.count_nonzero(simulation.escape_step >= 0)),
+            "evacuation_time": None if np.isnan(simulation.evacuation_time) else float(simulation.evacuation_time),
+            "crushed": int(np.count_nonzero(crushed)),
+            "first_crush_time": None if np.isnan(safety["first_crush_time"]) else float(safety["first_crush_time"]),
+            "peak_force": float(np.max(safety["peak_force"], initial=0.0)),
+            "force_evaluations": int(simulation.force_evaluations)}
+
+
+def main(arguments=None):
+    """ runs a simulation with the options of the command line, returns the exit code """
+    args = parse_arguments(arguments)
+    from model_simulation import Simulation
+    from trajectory_sinks import Discard_Sink, Full_Sink
+    from trajectory_store import Store_Sink
+
+    profile = "trace" if args.trace else bool(args.profile)
+    try:
+        simulation = Simulation(args.num_individuals, args.steps, method=args.method, time_step=args.time_step,
+                                velocity_factor=args.velocity_factor, room=args.room, room_size=args.room_size,
+                                cutoff=args.cutoff, navigation=args.navigation, seed=args.seed,
+                                backend=args.backend, force_processes=args.force_processes, profile=profile,
+                                relaxation_time=args.relaxation_time)
+        simulation.fill_room(args.placement)
+    except ValueError as error:
+        print("error: " + str(error), file=sys.stderr)
+        return 2
+
+    # The positions are only kept if they are stored or rendered afterwards
+    if args.output:
+        sink = Store_Sink(args.output, simulation.room_name, simulation.L, simulation.radii, simulation.m,
+                          every=args.every, keep_forces=args.keep_forces)
+    elif args.show or args.export:
+        sink = Full_Sink(every=args.every, keep_forces=False)
+    else:
+        sink = Discard_Sink()
+    until_evacuated = args.until_evacuated or None
+    if args.live:
+        simulation.show_live(args.sim_size, sink=sink, until_evacuated=until_evacuated)
+    else:
+        simulation.run(sink, until_evacuated=until_evacuated)
+
+    result = summary(simulation)
+    print(json.dumps(result, indent=1))
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            json.dump(result, summary_file, indent=1)
+    if args.profile:
+        simulation.profiler.to_json(args.profile)
+    if args.trace:
+        simulation.profiler.to_chrome_trace(args.trace)
+
+    if args.export:
+        # The kept frames are already decimated by --every
+        simulation.export(args.export, every=1, sim_size=args.sim_size, scale=args.scale)
+    if args.show:
+        simulation.show(args.wait_time, args.sim_size)
+    return 0
@@ -1,8 +1,23 @@
+import itertools
+import time
+
 import numpy as np
 
+from trajectory_sinks import Full_Sink
+
 
-# Define a function named leap_frog that simulates the motion of agents in a room_type
-# The function takes the following parameters:
+# Each integration method is a pair of functions:
+# - a start function, which prepares the state before the first step
+# - a step function, which advances the state by one time step dt
+# Both take and return the state as a dictionary with the positions "y", the velocities "v"
+# and the accelerations "a" of the agents, and return the number of evaluations of f they made.
+# The generator iterate runs such a pair and yields the state after each step; iterate_adaptive runs
+# velocity Verlet (with the relaxation of the velocities integrated exactly) with steps of its own
+# length, which shrink only while agents are in contact, and interpolates the states at the reporting times.
+# The functions leap_frog, velocity_verlet, rk4 and adaptive below run a method for number_of_steps
+# steps and return the whole trajectory, as (positions, escaped agents per step, accelerations);
+# integrate_results also returns the escape step of every agent and the number of evaluations of f.
+# They take the following parameters:
 # - init_position: Initial positions of the agents (a NumPy array)
 # - init_velocity: Initial velocities of the agents (a NumPy array)
 # - f: A function that represents the forces acting on the agents
@@ -10,49 +25,382 @@ import numpy as np
 # - dt: Time step size for the simulation
 # - room_type: An object representing the room_type and agent destinations
 
-def leap_frog(init_position, init_velocity, f, number_of_steps, dt, room_type):
-    escaped_counter = 0  # Initialize a variable to keep track of the number of escaped agents
 
-    # Create an array to store the number of agents that have escaped at each time step
-    agents_escaped = np.zeros(number_of_steps)
+def leap_frog_start(state, f, dt, active):
+    # Kick the velocities half a time step ahead of the positions
+    state["a"] = f(state["y"], state["v"], active=active)
+    state["v"] = state["v"] + 0.5 * dt * state["a"]
+    return 1
+
+
+def leap_frog_step(state, f, dt, active):
+    # The update of the original leap_frog: the velocity is corrected with the force at the new
+    # positions and a predicted velocity, which needs the force at the current state first
+    y, v = state["y"], state["v"]
+    state["y"] = y + dt * v
+    a = f(y, v, active=active)
+    state["a"] = f(state["y"], v + dt * a, active=active)
+    state["v"] = v + dt * state["a"]
+    return 2
+
+
+def staggered_leap_frog_step(state, f, dt, active):
+    # Leap-frog with the velocities half a time step ahead of the positions (see leap_frog_start):
+    # the force is evaluated at the new positions with the half-step velocities, so f is evaluated
+    # only once per step
+    state["y"] = state["y"] + dt * state["v"]
+    state["a"] = f(state["y"], state["v"], active=active)
+    state["v"] = state["v"] + dt * state["a"]
+    return 1
+
+
+def velocity_verlet_start(state, f, dt, active):
+    state["a"] = f(state["y"], state["v"], active=active)
+    return 1
+
+
+def velocity_verlet_step(state, f, dt, active):
+    y, v, a = state["y"], state["v"], state["a"]
+    v_half = v + 0.5 * dt * a
+    state["y"] = y + dt * v_half
+    # The force depends on the velocity, so it is evaluated with the half-step velocity
+    state["a"] = f(state["y"], v_half, active=active)
+    state["v"] = v_half + 0.5 * dt * state["a"]
+    return 1
+
+
+def relaxed_verlet_step(state, f, dt, active, relaxation_time):
+    # Velocity Verlet for v' = g - v / relaxation_time, where g = f + v / relaxation_time (the desired
+    # velocity over the relaxation time and the forces) is taken as constant during the step. The
+    # relaxation of the velocities is then integrated exactly, so the step is not limited by the
+    # relaxation time; with a very long relaxation time this is velocity_verlet_step.
+    y, v = state["y"], state["v"]
+    g = state["a"] + v / relaxation_time
+    decay = np.exp(-dt / relaxation_time)
+    gain = relaxation_time * (1 - decay)
+    state["y"] = y + gain * v + relaxation_time * (dt - gain) * g
+    v_predicted = decay * v + gain * g
+    g_new = f(state["y"], v_predicted, active=active) + v_predicted / relaxation_time
+    state["v"] = decay * v + gain * 0.5 * (g + g_new)
+    state["a"] = g_new - state["v"] / relaxation_time
+    return 1
+
+
+def step_error(before, after, h, relaxation_time=None):
+    # Estimate of the position error of a step of velocity_verlet_step or relaxed_verlet_step: the
+    # positions are moved with the acceleration (g) before the step, so the error grows with its change
+    if relaxation_time is None:
+        return h ** 2 / 6 * np.max(np.abs(after["a"] - before["a"]), initial=0.0)
+    change = after["a"] - before["a"] + (after["v"] - before["v"]) / relaxation_time
+    weight = relaxation_time * (h - relaxation_time * (1 - np.exp(-h / relaxation_time))) / 3
+    return weight * np.max(np.abs(change), initial=0.0)
+
 
-    # Create arrays to store the positions (y), velocities (v), and accelerations (a) of the agents at each time step
-    y = np.zeros((init_position.shape[0], init_position.shape[1], number_of_steps))
-    v = np.zeros((init_position.shape[0], init_position.shape[1], number_of_steps))
-    a = np.zeros((init_position.shape[0], init_position.shape[1], number_of_steps))
+def rk4_start(state, f, dt, active):
+    state["a"] = f(state["y"], state["v"], active=active)
+    return 1
+
+
+def rk4_step(state, f, dt, active):
+    # Classic Runge-Kutta of order 4 for the system y' = v, v' = f(y, v);
+    # the first stage reuses the acceleration of the previous step
+    y, v = state["y"], state["v"]
+    k1_y, k1_v = v, state["a"]
+    k2_y = v + 0.5 * dt * k1_v
+    k2_v = f(y + 0.5 * dt * k1_y, k2_y, active=active)
+    k3_y = v + 0.5 * dt * k2_v
+    k3_v = f(y + 0.5 * dt * k2_y, k3_y, active=active)
+    k4_y = v + dt * k3_v
+    k4_v = f(y + dt * k3_y, k4_y, active=active)
+    state["y"] = y + dt / 6 * (k1_y + 2 * k2_y + 2 * k3_y + k4_y)
+    state["v"] = v + dt / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v)
+    state["a"] = f(state["y"], state["v"], active=active)
+    return 4
+
+
+# The integration methods that can be selected with Simulation(method=...)
+methods = {
+    "leap_frog": (leap_frog_start, leap_frog_step),
+    "staggered_leap_frog": (leap_frog_start, staggered_leap_frog_step),
+    "velocity_verlet": (velocity_verlet_start, velocity_verlet_step),
+    "rk4": (rk4_start, rk4_step),
+}
+
+
+def iterate(init_position, init_velocity, f, number_of_steps, dt, room_type, method="staggered_leap_frog", profiler=None,
+            relaxation_time=None):
+    # Generator that runs an integration method and yields the state after every time step
+    # (forever if number_of_steps is None), as a dictionary with the keys:
+    # - "step": the index of the time step
+    # - "y", "v", "a": the positions, velocities and accelerations of all agents
+    # - "active": which agents are still in the room
+    # - "escaped": the number of agents that have escaped so far
+    # - "escape_step": the time step at which each agent escaped (-1: not escaped)
+    # - "evaluations": the number of evaluations of f so far
+    # Only the current state is kept in memory; the arrays of a yielded frame are not changed later,
+    # except "active" and "escape_step", which are updated in place.
+    # With a profiler (see profiling), the steps and the escape checks are timed.
+    # relaxation_time: the relaxation time of f, if known; the adaptive method integrates it exactly.
+    if method == "adaptive":
+        yield from iterate_adaptive(init_position, init_velocity, f, number_of_steps, dt, room_type,
+                                    profiler=profiler, relaxation_time=relaxation_time)
+        return
+    start, step = methods[method]
+    escape_check = check_escaped
+    if profiler is not None:
+        step = profiler.timed("step", step)
+        escape_check = profiler.timed("escape", check_escaped)
+
+    # Agents still in the room, and the time step at which each agent escaped (-1: not escaped)
+    active, escape_step = escape_arrays(init_position)
 
     # Initialize the initial positions and velocities at the first time step
-    y[:, :, 0] = init_position
-    v[:, :, 0] += 0.5 * dt * f(y[:, :, 0], v[:, :, 0])
+    state = {"y": np.array(init_position, dtype=float), "v": np.array(init_velocity, dtype=float),
+             "active": active, "escape_step": escape_step, "escaped": np.zeros(active.shape[:-1], dtype=int),
+             "step": 0}
+    state["evaluations"] = start(state, f, dt, active)
+    yield state
 
     # Iterate through time steps from 0 to number_of_steps - 1
-    for k in range(number_of_steps - 1):
-        # Update agent positions using the leap-frog integration scheme
-        y[:, :, k + 1] = y[:, :, k] + dt * v[:, :, k]
+    for k in step_range(number_of_steps):
+        state = dict(state)
+        state["evaluations"] += step(state, f, dt, active)
 
-        # Calculate accelerations at the current time step
-        a[:, :, k] = f(y[:, :, k], v[:, :, k])
+        # Check if any agent has reached its destination in the room_type
+        escaped = escape_check(state, room_type, active)
+        state["escaped"] = state["escaped"] + np.count_nonzero(escaped, axis=-1)
+        escape_step[escaped] = k + 1
+        state["step"] = k + 1
+        yield state
 
-        # Update agent velocities using the leap-frog integration scheme
-        v[:, :, k + 1] = v[:, :, k] + dt * f(y[:, :, k + 1], v[:, :, k] + dt * a[:, :, k])
 
-        # Check if any agent has reached its destination in the room_type
-        for i in range(y.shape[1]):
-            destination = np.zeros(len(room_type.get_destination()))
-            for count, des in enumerate(room_type.get_destination()):
-                # Calculate the distance of each agent to the destinations
-                destination[count] = np.linalg.norm(y[:, i, k + 1] - des)
-            # Find the minimum distance to determine if an agent has reached its destination
-            distance = np.amin(destination)
-
-            # If the distance is less than 0.1, consider the agent to have reached its destination
-            if distance < 0.1:
-                # Randomly reposition the agent far from the destinations
-                y[:, i, k + 1] = 10 ** 6 * np.random.rand(2)
-                escaped_counter += 1  # Increment the count of escaped agents
-
-        # Store the count of escaped agents at the current time step
-        agents_escaped[k + 1] = escaped_counter
-
-    # Return the updated positions, the count of escaped agents at each time step, and the accelerations
-    return y, agents_escaped, a
+def iterate_adaptive(init_position, init_velocity, f, number_of_steps, dt, room_type, tolerance=1e-2,
+                     max_substeps=64, max_step=None, profiler=None, relaxation_time=None):
+    # Velocity Verlet with an adaptive step h that is independent of the reporting interval dt.
+    # With the relaxation time of f, the relaxation of the velocities towards the desired ones is
+    # integrated exactly (relaxed_verlet_step); otherwise it limits the step to about the relaxation time.
+    # The local position error of a step is estimated from the change of the acceleration (see
+    # step_error), which is large only while agents press against each other or the walls, or turn
+    # sharply. A step whose error exceeds the
+    # tolerance (in metres) is repeated with a smaller h (down to dt / max_substeps), and h grows again
+    # when contacts are sparse, up to max_step (default: 10 * dt), so one step may cover several frames.
+    # The frames are still yielded at the fixed reporting times k * dt: the positions in between two
+    # steps are interpolated with cubic Hermite polynomials, the velocities and accelerations linearly.
+    # An agent escapes at the first reporting time after the step in which it passed a destination.
+    min_step = dt / max_substeps
+    max_step = 10 * dt if max_step is None else max_step
+    active, escape_step = escape_arrays(init_position)
+    step = velocity_verlet_step
+    if relaxation_time is not None:
+        def step(state, f, h, active):
+            return relaxed_verlet_step(state, f, h, active, relaxation_time)
+    escape_check = check_escaped
+    if profiler is not None:
+        step = profiler.timed("step", step)
+        escape_check = profiler.timed("escape", check_escaped)
+
+    state = {"y": np.array(init_position, dtype=float), "v": np.array(init_velocity, dtype=float),
+             "active": active, "escape_step": escape_step, "escaped": np.zeros(active.shape[:-1], dtype=int),
+             "step": 0}
+    state["evaluations"] = velocity_verlet_start(state, f, dt, active)
+    yield state
+    escaped = state["escaped"]
+    h = dt
+    t = 0.0  # Time of state
+    previous, previous_t = state, t
+
+    for k in step_range(number_of_steps):
+        report = (k + 1) * dt
+        while t < report * (1 - 1e-12):
+            h = min(max(h, min_step), max_step)
+            trial = dict(state)
+            trial["evaluations"] += step(trial, f, h, active)
+            error = step_error(state, trial, h, relaxation_time)
+            if error > tolerance and h > min_step * (1 + 1e-9):
+                # Reject the step and try again with a smaller one
+                state["evaluations"] = trial["evaluations"]
+                h = max(0.5 * h, min_step, 0.9 * h * (tolerance / error) ** (1 / 3))
+                continue
+            # Keep the state before the step to interpolate the frames inside it, and the state after it
+            # before the escaped agents are taken out
+            previous, previous_t = state, t
+            state = trial
+            reached = {"y": state["y"].copy(), "v": state["v"].copy(), "a": state["a"].copy()}
+            t += h
+            # Grow the step again when the error allows it, at most by a factor of 2
+            h = h * min(2.0, 0.9 * (tolerance / max(error, 1e-300)) ** (1 / 3))
+
+            escaped_now = escape_check(state, room_type, active, previous["y"])
+            escape_step[escaped_now] = int(np.ceil(t / dt - 1e-9))
+
+        # An agent that escaped in a step longer than dt is only counted, parked and inactive from the
+        # frame of its escape_step on; in the frames before, it is interpolated like the others
+        counted = (escape_step >= 0) & (escape_step <= k + 1)
+        frame = interpolate(previous, previous_t, reached, t, report, counted)
+        escaped = escaped + np.count_nonzero(escape_step == k + 1, axis=-1)
+        frame.update({"active": ~counted, "escape_step": np.where(counted, escape_step, -1), "escaped": escaped,
+                      "step": k + 1, "evaluations": state["evaluations"]})
+        yield frame
+
+
+def interpolate(before, t_before, after, t_after, t, gone):
+    # The state at time t between two steps of a method: cubic Hermite interpolation of the positions
+    # from the positions and velocities at both ends, linear interpolation of the velocities and
+    # accelerations. The agents that are gone (escaped) are parked far from the room.
+    if t >= t_after * (1 - 1e-12):
+        y, v, a = after["y"].copy(), after["v"].copy(), after["a"].copy()
+    else:
+        h = t_after - t_before
+        s = (t - t_before) / h
+        y = ((2 * s ** 3 - 3 * s ** 2 + 1) * before["y"] + (s ** 3 - 2 * s ** 2 + s) * h * before["v"]
+             + (3 * s ** 2 - 2 * s ** 3) * after["y"] + (s ** 3 - s ** 2) * h * after["v"])
+        v = (1 - s) * before["v"] + s * after["v"]
+        a = (1 - s) * before["a"] + s * after["a"]
+    if np.any(gone):
+        remove_escaped(y, v, gone)
+        np.moveaxis(a, -2, 0)[:, gone] = 0
+    return {"y": y, "v": v, "a": a}
+
+
+def step_range(number_of_steps):
+    # The indices of the steps after the first frame; without a number of steps, they never end
+    if number_of_steps is None:
+        return itertools.count()
+    return range(number_of_steps - 1)
+
+
+def until_evacuated(frames, dt, wall_clock_limit=None, stall_time=None):
+    # Generator that passes the frames of iterate on and stops after the frame in which
+    # - every agent has escaped ("evacuated"),
+    # - the run has taken more than wall_clock_limit seconds of real time ("wall_clock"), or
+    # - nobody escaped for stall_time seconds of simulated time ("stalled").
+    # The reason is stored in the last frame as "stop_reason". If the frames end first
+    # (the number of steps was reached), no reason is set.
+    started = time.perf_counter()
+    last_escape = 0
+    escaped_before = None
+    for frame in frames:
+        if escaped_before is None or np.any(frame["escaped"] != escaped_before):
+            last_escape = frame["step"]
+            escaped_before = frame["escaped"]
+
+        if not np.any(frame["active"]):
+            frame["stop_reason"] = "evacuated"
+        elif wall_clock_limit is not None and time.perf_counter() - started > wall_clock_limit:
+            frame["stop_reason"] = "wall_clock"
+        elif stall_time is not None and (frame["step"] - last_escape) * dt >= stall_time:
+            frame["stop_reason"] = "stalled"
+        yield frame
+        if "stop_reason" in frame:
+            return
+
+
+def integrate_results(init_position, init_velocity, f, number_of_steps, dt, room_type, method="staggered_leap_frog"):
+    # Run a method and keep the whole trajectory in memory. Returns the dictionary of Full_Sink:
+    # the positions "y", the count of escaped agents at each time step "agents_escaped", the
+    # accelerations "forces", the time step at which each agent escaped "escape_step", and the number
+    # of evaluations of f "force_evaluations"
+    sink = Full_Sink()
+    sink.start(init_position.shape[1], number_of_steps, dt)
+    for frame in iterate(init_position, init_velocity, f, number_of_steps, dt, room_type, method):
+        sink.record(frame)
+    return sink.finish()
+
+
+def integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, method):
+    # Run a method and return the positions, the count of escaped agents at each time step and the accelerations
+    result = integrate_results(init_position, init_velocity, f, number_of_steps, dt, room_type, method)
+    return result["y"], result["agents_escaped"], result["forces"]
+
+
+def leap_frog(init_position, init_velocity, f, number_of_steps, dt, room_type):
+    return integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, "leap_frog")
+
+
+def staggered_leap_frog(init_position, init_velocity, f, number_of_steps, dt, room_type):
+    return integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, "staggered_leap_frog")
+
+
+def velocity_verlet(init_position, init_velocity, f, number_of_steps, dt, room_type):
+    return integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, "velocity_verlet")
+
+
+def rk4(init_position, init_velocity, f, number_of_steps, dt, room_type):
+    return integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, "rk4")
+
+
+def adaptive(init_position, init_velocity, f, number_of_steps, dt, room_type):
+    return integrate(init_position, init_velocity, f, number_of_steps, dt, room_type, "adaptive")
+
+
+# The initial escape bookkeeping for a state of shape (2, N) or (M, 2, N)
+def escape_arrays(init_position):
+    """ returns: ``active``: array of booleans (every agent is still in the room)
+                 ``escape_step``: integer array (-1 for every agent)
+        with the shape of init_position without its x,y axis
+        parameters: ``init_position``: array of shape (..., 2, N) (initial positions)
+    """
+    shape = init_position.shape[:-2] + init_position.shape[-1:]
+    return np.ones(shape, dtype=bool), np.full(shape, -1)
+
+
+# Find the agents that reached a destination and take them out of the room
+def check_escaped(state, room_type, active, previous=None):
+    """ returns a 1D-array of booleans, the agents that escaped in this step
+        (they are removed from ``state`` and from ``active`` in place)
+        parameters: ``state``: dictionary (positions "y", velocities "v", accelerations "a")
+                    ``room_type``: object (the room with the destinations)
+                    ``active``: 1D-array of booleans (the agents still in the room)
+                    ``previous``: array or None, the positions before the step; if given, an agent
+                                  also escapes if it passed a destination during the step
+    """
+    escaped = active & (escape_distance(state["y"], room_type, previous) < escape_radius)
+    if np.any(escaped):
+        remove_escaped(state["y"], state["v"], escaped)
+        np.moveaxis(state["a"], -2, 0)[:, escaped] = 0
+        active &= ~escaped
+    return escaped
+
+
+# An agent has escaped once it is this close to a destination (in metres). The destinations lie 0.5 m
+# beyond the doors, so an agent escapes as it goes through a door (as in building), instead of when it
+# reaches the point behind it, around which a crowd can jam for good
+escape_radius = 0.5
+
+
+# Distance of every agent to its nearest destination
+def escape_distance(position, room_type, previous=None):
+    """ returns an array of shape (..., N), the distance of each agent to the nearest destination
+        parameters: ``position``: array of shape (..., 2, N) (position of all agents)
+                    ``room_type``: object (the room with the destinations)
+                    ``previous``: array of shape (..., 2, N) or None (position before the step: the
+                                  distance of the path from ``previous`` to ``position`` is returned)
+    """
+    destination = room_type.get_destination().T[:, :, None]
+    end = position[..., :, None, :]
+    if previous is None:
+        return np.min(np.linalg.norm(end - destination, axis=-3), axis=-2)
+    start = previous[..., :, None, :]
+    path = end - start
+    length = np.sum(path ** 2, axis=-3)
+    along = np.sum((destination - start) * path, axis=-3) / np.where(length > 0, length, 1)
+    closest = start + np.clip(along, 0, 1)[..., None, :, :] * path
+    return np.min(np.linalg.norm(closest - destination, axis=-3), axis=-2)
+
+
+# Take the escaped agents out of the room
+def remove_escaped(position, velocity, escaped):
+    """ moves the escaped agents far away from the room and stops them,
+        returns an integer, the number of escaped agents
+        parameters: ``position``,``velocity``: array of shape (..., 2, N) (state of all agents,
+                                                changed in place)
+                    ``escaped``: array of booleans of shape (..., N) (the agents that escaped)
+    """
+    num_escaped = np.count_nonzero(escaped)
+    # Park the agents far from the room, 10 m apart in a row by their number, so they don't feel each other
+    # and the run stays reproducible (the x,y axis is moved to the front, so this also works for
+    # replicas of shape (M, 2, N))
+    agent = np.nonzero(escaped)[-1]
+    np.moveaxis(position, -2, 0)[:, escaped] = np.array([10 ** 6 + 10.0 * agent, np.full(num_escaped, 10 ** 6)])
+    np.moveaxis(velocity, -2, 0)[:, escaped] = 0
+    return num_escaped
@@ -2,9 +2,7 @@ import numpy as np
 import pygame
 import matplotlib.pyplot as plt
 
-# Example positions for test purposes
-movement_data = np.random.randint(20, 700, (2, 5, 5))
-objects_pos = np.random.randint(100, 700, (2, 10))
+from frame_renderer import Frame_Renderer
 
 
 def display_events(movement_data, room, wait_time, radii, sim_size, agents_escaped):
@@ -20,21 +18,12 @@ def display_events(movement_data, room, wait_time, radii, sim_size, agents_escap
         sim_size (int): The size of the image on the screen.
         agents_escaped (numpy.ndarray): Number of agents that have escaped at each time step.
     """
-    # Colors
-    background_color = (250, 250, 250)  # Grey
-    people_color = (250, 0, 0)  # Red
-    destination_color = (0, 128, 0)  # Green
-    object_color = (0, 0, 0)  # Black
-
-    # Variables for initializing Pygame
-    normalizer = int(sim_size / room.get_room_size())  # The ratio (size of image) / (size of actual room)
-    map_size = (room.get_room_size() * normalizer + 100, room.get_room_size() * normalizer + 100)
+    # The walls and destinations are drawn only once, see frame_renderer
+    renderer = Frame_Renderer(room, radii, sim_size)
+    map_size = renderer.size
     wait_time = wait_time
     wait_time_after_sim = 3000
-    movement_data_dim = movement_data.shape
-    num_persons = movement_data_dim[1]
-    num_time_iterations = movement_data_dim[2]
-    num_walls = room.get_num_walls()
+    num_time_iterations = movement_data.shape[2]
 
     pygame.init()
     simulate = False
@@ -58,31 +47,7 @@ def display_events(movement_data, room, wait_time, radii, sim_size, agents_escap
                     if event.type == pygame.QUIT:
                         pygame.quit()
 
-                worldmap.fill(background_color)
-
-                for person in range(num_persons):
-                    pygame.draw.circle(worldmap, people_color,
-                                       ((normalizer * movement_data[0, person, t] + 50).astype(int),
-                                        (normalizer * movement_data[1, person, t] + 50).astype(int)),
-                                       int(normalizer * radii[person]), 0)
-
-                for wall in range(num_walls):
-                    pygame.draw.lines(worldmap, object_color, True,
-                                      normalizer * room.get_wall(wall) + 50, 2)
-
-                for des in room.get_destination():
-                    pygame.draw.circle(worldmap, destination_color,
-                                       ((normalizer * des[0] + 50).astype(int),
-                                        (normalizer * des[1] + 50).astype(int)),
-                                       7, 0)
-
-                strf = "Number of People Escaped: " + str(int(agents_escaped[t]))
-                text = font.render(strf, True, (0, 0, 0))
-                worldmap.blit(text, (10, 10))
-
-                strd = "Number of People: " + str(num_persons)
-                textd = font.render(strd, True, (0, 0, 0))
-                worldmap.blit(textd, (400, 10))
+                worldmap.blit(renderer.render(movement_data[:, :, t], agents_escaped[t]), (0, 0))
 
                 pygame.display.update()
                 pygame.time.wait(wait_time)
@@ -94,29 +59,74 @@ def display_events(movement_data, room, wait_time, radii, sim_size, agents_escap
 
 
 
-def display_graph(agents_escaped, acceleration, mass):
-    """Draws three graphs related to the simulation:
-    1. The number of people who escaped the room at each time step.
-    2. The number of people who experienced a force higher than "tol" and therefore died.
-    3. The forces one random agent experiences.
+def display_live(buffer, room, radii, sim_size, fps=30, abort=None):
+    """Displays a simulation while it runs, from the frames a solver thread publishes (see live_view).
+    The newest frame is drawn at the display rate; frames the display has no time for are skipped,
+    so the solver never waits for the display.
 
     Args:
-        agents_escaped (numpy.ndarray): Number of people who escaped at each time step.
-        acceleration (numpy.ndarray): Acceleration data for each person at each time step.
-        mass (numpy.ndarray): Mass of each person.
+        buffer (live_view.Frame_Buffer): Where the solver publishes its frames.
+        room (Room): Instance of the room. Used to draw the walls.
+        radii (numpy.ndarray): The radii of the individuals.
+        sim_size (int): The size of the image on the screen.
+        fps (int): Number of frames drawn per second, at most.
+        abort (threading.Event): Set when the window is closed or Escape is pressed, to stop the solver.
+
+    Returns:
+        int: The number of frames that were skipped.
     """
-    tol = 700  # Force at which people die (in Newton)
+    renderer = Frame_Renderer(room, radii, sim_size)
+    wait_time_after_sim = 3000
+
+    pygame.init()
+    font = pygame.font.Font(None, 32)
+    worldmap = pygame.display.set_mode(renderer.size)
+    clock = pygame.time.Clock()
+    shown = 0
+    skipped = 0
+
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                if abort is not None:
+                    abort.set()
+                pygame.quit()
+                return skipped
 
-    _, num_persons, num_steps = np.shape(acceleration)
-    forces_new = np.zeros((num_persons, num_steps - 1))
-    num_dead = np.zeros(num_steps - 1)
+        # Read the flag first: if the solver finished before, the newest frame is its last one
+        finished = buffer.finished
+        count, frame = buffer.latest()
+        if count > shown:
+            worldmap.blit(renderer.render(frame["y"], frame["escaped"]), (0, 0))
+            pygame.display.update()
+            skipped += count - shown - 1
+            shown = count
+        elif finished:
+            break
+        clock.tick(fps)
 
-    # Get force by multiplying the acceleration with the mass
-    for person in range(num_persons):
-        for t in range(num_steps - 1):
-            forces_new[person, t] = np.linalg.norm(acceleration[:, person, t]) * mass[person]
-            if forces_new[person, t] > tol:
-                num_dead[t] += 1
+    text = font.render('Simulation Completed', True, (0, 0, 0))
+    worldmap.blit(text, (100, 100))
+    pygame.display.update()
+    pygame.time.wait(wait_time_after_sim)
+    pygame.quit()
+    return skipped
+
+
+def display_graph(metrics):
+    """Draws three graphs related to the simulation:
+    1. The number of people who escaped the room at each time step.
+    2. The number of people who experienced a force higher than the threshold and therefore died.
+    3. The forces one agent experiences.
+
+    Args:
+        metrics (dict): Safety metrics of the run, accumulated during the run by
+            safety_metrics.Safety_Metrics or recomputed from a stored trajectory with
+            safety_metrics.from_trajectory.
+    """
+    agents_escaped = metrics["agents_escaped"]
+    num_dead = metrics["crushed"]
+    tracked_force = metrics["tracked_force"]
 
     f = plt.figure(figsize=(10, 10))
     f.subplots_adjust(hspace=0.3)
@@ -128,14 +138,33 @@ def display_graph(agents_escaped, acceleration, mass):
     f1.set_title("Escape Scenario")
 
     f2 = f.add_subplot(3, 1, 2)
-    f2.plot(range(num_steps - 1), num_dead, 'r')
+    f2.plot(range(len(num_dead)), num_dead, 'r')
     f2.set_ylabel("Number of Dead people")
     f2.set_xlabel("Timestep")
 
     f3 = f.add_subplot(3, 1, 3)
-    chosen_agent = int(num_persons / 2)
-    f3.plot(range(num_steps - 1), forces_new[chosen_agent, :], 'b')
-    f3.set_ylabel("Forces on Agent")
+    f3.plot(range(len(tracked_force)), tracked_force, 'b')
+    f3.axhline(metrics["threshold"], color='r', linestyle='--')
+    f3.set_ylabel("Forces on Agent " + str(metrics["tracked_agent"]))
     f3.set_xlabel("Timestep")
 
     plt.show()
+
+
+def display_stored(path, wait_time, sim_size):
+    """Displays a run stored with trajectory_store. The frames are read lazily from disk.
+    The graphs of the safety metrics are only drawn if the accelerations were stored.
+
+    Args:
+        path (str): Directory of the stored run.
+        wait_time (int): Time that the simulation waits between each time step.
+        sim_size (int): The size of the image on the screen.
+    """
+    from safety_metrics import from_trajectory
+    from trajectory_store import open_trajectory
+
+    stored = open_trajectory(path)
+    mass = stored.masses if stored.masses is not None else 50 * np.ones(stored.N)
+    if stored.forces is not None:
+        display_graph(from_trajectory(stored.forces, mass, stored.dt, stored.agents_escaped))
+    display_events(stored.y, stored.get_room(), wait_time, stored.radii, sim_size, stored.agents_escaped)
@@ -0,0 +1,104 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from safety_metrics import crush_force
+from trajectory_sinks import Statistics_Sink
+
+
+def run_replica(simulation_args, seed):
+    """ returns a dictionary, the compact results of one seeded simulation:
+        - ``agents_escaped``: 1D-array, number of escaped agents at each time step
+        - ``evacuation_time``: float, time until all agents escaped (nan if they did not)
+        - ``escaped``: integer, number of agents that escaped during the run
+        - ``crushed``: integer, number of agents that felt a force above crush_force
+        - ``peak_force``: float, the largest force any agent felt
+        parameters: ``simulation_args``: dictionary, the arguments of Simulation
+                    ``seed``: the seed of the replica (integer or numpy SeedSequence)
+    """
+    from model_simulation import Simulation
+
+    simulation = Simulation(seed=seed, **simulation_args)
+    simulation.fill_room()
+    # Stop as soon as everybody escaped; num_steps is only the upper limit
+    simulation.run(Statistics_Sink(), until_evacuated=True)
+
+    return replica_result(simulation.agents_escaped, simulation.results["peak_acceleration"], simulation.m,
+                          simulation.time_step)
+
+
+def replica_result(agents_escaped, peak_acceleration, mass, time_step):
+    """ returns a dictionary, the compact results of one replica (see run_replica)
+        parameters: ``agents_escaped``: 1D-array, number of escaped agents at each time step
+                    ``peak_acceleration``: 1D-array, the largest acceleration of each agent
+                    ``mass``: 1D-array, mass of each agent
+                    ``time_step``: float, time between two steps
+    """
+    everyone_out = np.flatnonzero(agents_escaped >= len(mass))
+    evacuation_time = everyone_out[0] * time_step if len(everyone_out) else np.nan
+    peak_force = peak_acceleration * mass
+    return {"agents_escaped": agents_escaped,
+            "evacuation_time": evacuation_time,
+            "escaped": int(agents_escaped[-1]),
+            "crushed": int(np.count_nonzero(peak_force > crush_force)),
+            "peak_force": float(np.max(peak_force))}
+
+
+def summarize(values):
+    """ returns a dictionary, mean, standard deviation, percentiles and the 95% confidence
+        interval of the mean of the finite values
+        parameters: ``values``: 1D-array
+    """
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return {"mean": np.nan, "std": np.nan, "p5": np.nan, "p50": np.nan, "p95": np.nan,
+                "ci95": (np.nan, np.nan), "count": 0}
+    mean = np.mean(finite)
+    std = np.std(finite, ddof=1) if len(finite) > 1 else 0.0
+    half_width = 1.96 * std / np.sqrt(len(finite))
+    p5, p50, p95 = np.percentile(finite, [5, 50, 95])
+    return {"mean": mean, "std": std, "p5": p5, "p50": p50, "p95": p95,
+            "ci95": (mean - half_width, mean + half_width), "count": len(finite)}
+
+
+def run_ensemble(num_replicas, seed=None, processes=None, **simulation_args):
+    """ returns a dictionary, the aggregated results of ``num_replicas`` simulations:
+        - ``replicas``: list, the results of run_replica for every replica
+        - ``evacuation_time``, ``escaped``, ``crushed``, ``peak_force``: summaries (see summarize)
+        - ``escape_curve``: dictionary, mean and 5/50/95 percentiles of the escaped agents per step
+        - ``evacuated_fraction``: float, fraction of the replicas in which everybody escaped
+        parameters: ``num_replicas``: integer, number of replicas
+                    ``seed``: integer or None, the seed of the whole ensemble. Every replica gets
+                              its own independent random stream spawned from it
+                    ``processes``: integer or None, number of worker processes
+                                   (None: one per core, 1: run in this process)
+                    ``simulation_args``: the arguments of Simulation (num_individuals, num_steps, room, ...)
+    """
+    seeds = np.random.SeedSequence(seed).spawn(num_replicas)
+    if processes == 1:
+        replicas = [run_replica(simulation_args, s) for s in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            replicas = list(pool.map(run_replica, [simulation_args] * num_replicas, seeds))
+
+    return aggregate(replicas)
+
+
+def aggregate(replicas):
+    """ returns a dictionary, the aggregated results of the replicas (see run_ensemble)
+        parameters: ``replicas``: list of dictionaries, the results of run_replica
+    """
+    # Replicas that stopped early keep their final count for the remaining steps
+    length = max(len(r["agents_escaped"]) for r in replicas)
+    curves = np.array([np.pad(r["agents_escaped"], (0, length - len(r["agents_escaped"])), mode="edge")
+                       for r in replicas])
+    p5, p50, p95 = np.percentile(curves, [5, 50, 95], axis=0)
+    evacuation_time = np.array([r["evacuation_time"] for r in replicas])
+    return {"replicas": replicas,
+            "evacuation_time": summarize(evacuation_time),
+            "evacuated_fraction": np.mean(np.isfinite(evacuation_time)),
+            "escaped": summarize([r["escaped"] for r in replicas]),
+            "crushed": summarize([r["crushed"] for r in replicas]),
+            "peak_force": summarize([r["peak_force"] for r in replicas]),
+            "escape_curve": {"mean": np.mean(curves, axis=0), "p5": p5, "p50": p50, "p95": p95}}
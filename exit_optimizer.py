@@ -0,0 +1,252 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+
+import numpy as np
+
+from ensemble import replica_result, summarize
+from room_layout import parametric_room
+from trajectory_sinks import Statistics_Sink
+
+# The parameters of a candidate layout, with their default search ranges (as fractions of the room size,
+# except for num_exits):
+# - door_position: centre of the doors along their side
+# - door_width: width of every door
+# - obstacle_x, obstacle_y: centre of a vertical obstacle wall
+# - obstacle_length: length of the obstacle wall (0: no obstacle)
+# - num_exits: number of doors; the doors are put on the left, right, bottom and top side in that order
+default_space = {
+    "door_position": (0.2, 0.8),
+    "door_width": (0.04, 0.1),
+    "obstacle_x": (0.15, 0.4),
+    "obstacle_y": (0.3, 0.7),
+    "obstacle_length": (0.0, 0.4),
+    "num_exits": (1, 2),
+}
+
+exit_sides = ("left", "right", "bottom", "top")
+candidate_rooms = {}  # Rooms of the candidates built so far, by parameters and room size
+
+
+def build_layout(params, room_size):
+    """ returns a Room, the parametric room described by a candidate. The rooms are cached, so all
+        replicas of a candidate in a process share its walls, wall index and floor field.
+        parameters: ``params``: dictionary, the parameters of the candidate (see default_space)
+                    ``room_size``: float, size of the room
+    """
+    key = (tuple(sorted(params.items())), float(room_size))
+    if key not in candidate_rooms:
+        candidate_rooms[key] = compile_candidate(params, room_size)
+    return candidate_rooms[key]
+
+
+def compile_candidate(params, room_size):
+    # Build the room of a candidate (see build_layout)
+    num_exits = int(round(params["num_exits"]))
+    position = params["door_position"] * room_size
+    width = params["door_width"] * room_size
+    doors = [(side, position, width) for side in exit_sides[:num_exits]]
+
+    obstacles = []
+    length = params["obstacle_length"] * room_size
+    if length > 0.5:
+        x = params["obstacle_x"] * room_size
+        y = params["obstacle_y"] * room_size
+        obstacles.append([[x, max(y - length / 2, 0.5)], [x, min(y + length / 2, room_size - 0.5)]])
+    return parametric_room(room_size, doors, obstacles, name="candidate")
+
+
+def evaluate_replica(params, room_size, simulation_args, seed, max_steps):
+    """ returns a dictionary, the compact results (see ensemble.run_replica) of one replica of a
+        candidate, run for at most ``max_steps`` steps
+    """
+    from model_simulation import Simulation
+
+    args = dict(simulation_args, num_steps=max_steps)
+    simulation = Simulation(room=build_layout(params, room_size), room_size=room_size, seed=seed, **args)
+    simulation.fill_room()
+    simulation.run(Statistics_Sink(), until_evacuated=True)
+    return replica_result(simulation.agents_escaped, simulation.results["peak_acceleration"], simulation.m,
+                          simulation.time_step)
+
+
+def grid_sampler(space, points_per_axis):
+    """ returns a list of candidates, the full grid over the space """
+    axes = []
+    for name, (low, high) in space.items():
+        if name == "num_exits":
+            axes.append(np.arange(low, high + 1))
+        else:
+            axes.append(np.linspace(low, high, points_per_axis))
+    return [dict(zip(space, values)) for values in itertools.product(*axes)]
+
+
+def random_sampler(space, num_candidates, rng, mean=None, std=None):
+    """ returns a list of candidates drawn uniformly from the space, or from a normal distribution
+        (clipped to the space) if a mean and a standard deviation per parameter are given
+    """
+    candidates = []
+    for _ in range(num_candidates):
+        candidate = {}
+        for name, (low, high) in space.items():
+            if mean is None:
+                value = rng.uniform(low, high)
+            else:
+                value = np.clip(rng.normal(mean[name], std[name]), low, high)
+            candidate[name] = int(round(value)) if name == "num_exits" else float(value)
+        candidates.append(candidate)
+    return candidates
+
+
+def score(replicas, time_budget, num_individuals):
+    """ returns a 1D-array, the score of each replica: its evacuation time, or, if it was not
+        evacuated within its time budget, the budget plus a penalty for the agents left in the room
+        parameters: ``time_budget``: float, or 1D-array with the time budget of each replica
+    """
+    budgets = np.broadcast_to(np.asarray(time_budget, dtype=float), (len(replicas),))
+    scores = []
+    for r, budget in zip(replicas, budgets):
+        if np.isfinite(r["evacuation_time"]):
+            scores.append(r["evacuation_time"])
+        else:
+            scores.append(budget * (2 - r["escaped"] / num_individuals))
+    return np.array(scores)
+
+
+class Exit_Optimizer:
+    def __init__(self, simulation_args, room_size=25, space=None, num_replicas=8, first_round=2,
+                 prune_factor=1.5, processes=None, seed=None):
+        """
+            Searches door and obstacle placements for the fastest and safest evacuation.
+
+            Every candidate is simulated in ``num_replicas`` seeded replicas on a process pool.
+            The first ``first_round`` replicas of each candidate are run first; a candidate whose
+            mean score is then worse than ``prune_factor`` times the best mean so far is not
+            simulated further. A replica also stops as soon as it has run for ``prune_factor`` times
+            the best mean score. The score of a replica is its evacuation time, or its time budget
+            plus a penalty for the agents left if it was stopped before everybody escaped (see score).
+
+            Parameters:
+            - ``simulation_args``: dictionary, arguments of Simulation (num_individuals, num_steps, ...);
+                                   num_steps is the longest a replica may run
+            - ``room_size``: float, size of the room
+            - ``space``: dictionary, search range of each parameter (default: default_space)
+            - ``num_replicas``: integer, number of replicas per candidate
+            - ``first_round``: integer, number of replicas run before a candidate can be pruned
+            - ``prune_factor``: float, how much worse than the best a candidate may be
+            - ``processes``: integer or None, number of worker processes (1: run in this process)
+            - ``seed``: integer or None, seed of the search and of all replicas
+        """
+        self.simulation_args = dict(simulation_args)
+        self.room_size = room_size
+        self.space = dict(default_space if space is None else space)
+        self.num_replicas = num_replicas
+        self.first_round = min(first_round, num_replicas)
+        self.prune_factor = prune_factor
+        self.processes = processes
+        self.rng = np.random.default_rng(seed)
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.time_step = self.simulation_args.get("time_step", 0.1)
+        self.max_steps = self.simulation_args.pop("num_steps", None)
+        if self.max_steps is None:
+            raise ValueError('The simulation arguments need "num_steps", the number of steps after which '
+                             'a replica is stopped.')
+        self.N = self.simulation_args["num_individuals"]
+        self.best_time = np.inf
+        self.evaluated = []  # Results of all evaluated candidates
+
+    def step_budget(self):
+        # Replicas stop once they are clearly slower than the best candidate so far
+        if np.isfinite(self.best_time):
+            return min(self.max_steps, int(np.ceil(self.prune_factor * self.best_time / self.time_step)) + 1)
+        return self.max_steps
+
+    def run_replicas(self, pool, jobs):
+        # jobs: list of (candidate, seed); returns the results in the same order
+        budget = self.step_budget()
+        args = [(params, self.room_size, self.simulation_args, seed, budget) for params, seed in jobs]
+        if pool is None:
+            return [evaluate_replica(*a) for a in args], budget
+        return list(pool.map(evaluate_replica, *zip(*args))), budget
+
+    def evaluate(self, candidates, pool=None):
+        """ simulates the candidates (with pruning) and returns their results, see report """
+        seeds = [self.seed_sequence.spawn(self.num_replicas) for _ in candidates]
+
+        # First round for all candidates
+        jobs = [(params, s) for params, candidate_seeds in zip(candidates, seeds)
+                for s in candidate_seeds[:self.first_round]]
+        results, budget = self.run_replicas(pool, jobs)
+        replicas = [results[i * self.first_round:(i + 1) * self.first_round] for i in range(len(candidates))]
+        # The time budget of every replica: the second round may run with a smaller one
+        budgets = [[budget * self.time_step] * self.first_round for _ in candidates]
+        for r, b in zip(replicas, budgets):
+            self.best_time = min(self.best_time, np.mean(score(r, b, self.N)))
+
+        # Remaining replicas only for the candidates that are not clearly worse than the best
+        keep = [i for i, r in enumerate(replicas)
+                if np.mean(score(r, budgets[i], self.N)) <= self.prune_factor * self.best_time]
+        jobs = [(candidates[i], s) for i in keep for s in seeds[i][self.first_round:]]
+        if jobs:
+            results, budget = self.run_replicas(pool, jobs)
+            rest = self.num_replicas - self.first_round
+            for count, i in enumerate(keep):
+                replicas[i] = replicas[i] + results[count * rest:(count + 1) * rest]
+                budgets[i] = budgets[i] + [budget * self.time_step] * rest
+
+        evaluated = []
+        for params, r, b in zip(candidates, replicas, budgets):
+            scores = score(r, b, self.N)
+            self.best_time = min(self.best_time, np.mean(scores))
+            evacuation_time = np.array([x["evacuation_time"] for x in r])
+            evaluated.append({"params": params,
+                              "replicas": len(r),
+                              "pruned": len(r) < self.num_replicas,
+                              "score": summarize(scores),
+                              "evacuation_time": summarize(evacuation_time),
+                              "evacuated_fraction": np.mean(np.isfinite(evacuation_time)),
+                              "crushed": summarize([x["crushed"] for x in r])})
+        self.evaluated += evaluated
+        return evaluated
+
+    def search(self, sampler="random", num_candidates=20, points_per_axis=3, generations=3, elite=0.25):
+        """ returns a dictionary, see report
+            parameters: ``sampler``: string, "grid", "random" or "cem" (cross-entropy method: every
+                                     generation samples around the elite of the previous one)
+                        ``num_candidates``: integer, candidates per generation (random and cem)
+                        ``points_per_axis``: integer, grid points per parameter (grid)
+                        ``generations``: integer, number of generations (cem)
+                        ``elite``: float, fraction of a generation that is kept as elite (cem)
+        """
+        pool = None if self.processes == 1 else ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            if sampler == "grid":
+                self.evaluate(grid_sampler(self.space, points_per_axis), pool)
+            elif sampler == "random":
+                self.evaluate(random_sampler(self.space, num_candidates, self.rng), pool)
+            elif sampler == "cem":
+                mean = None
+                std = None
+                for _ in range(generations):
+                    results = self.evaluate(random_sampler(self.space, num_candidates, self.rng, mean, std), pool)
+                    results.sort(key=lambda x: x["score"]["mean"])
+                    best = results[:max(2, int(elite * len(results)))]
+                    mean = {name: np.mean([x["params"][name] for x in best]) for name in self.space}
+                    std = {name: max(np.std([x["params"][name] for x in best]), 0.02 * (high - low))
+                           for name, (low, high) in self.space.items()}
+            else:
+                raise ValueError('Unknown sampler "' + sampler + '", use "grid", "random" or "cem".')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return self.report()
+
+    def report(self, top=5):
+        """ returns a dictionary with the ``top`` candidates by mean score ("by_time") and by mean crush
+            count ("by_crushed"), among those simulated with all replicas. Every candidate has its
+            "score" (evacuation times with the penalty of the replicas that were stopped, see score),
+            its raw "evacuation_time" (only of the evacuated replicas), "evacuated_fraction" and "crushed".
+        """
+        complete = [x for x in self.evaluated if not x["pruned"]]
+        by_time = sorted(complete, key=lambda x: x["score"]["mean"])
+        by_crushed = sorted(complete, key=lambda x: (x["crushed"]["mean"], x["score"]["mean"]))
+        return {"by_time": by_time[:top], "by_crushed": by_crushed[:top], "evaluated": len(self.evaluated)}
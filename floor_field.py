@@ -0,0 +1,229 @@
+import hashlib
+import heapq
+import os
+import warnings
+
+import numpy as np
+
+
+class Floor_Field:
+    def __init__(self, walls, destination, room_size, resolution=0.2, cost=None):
+        """
+            Static floor field of a room: the walking distance from every grid cell
+            to the nearest exit, computed once with Dijkstra around the walls.
+
+            The desired direction of an agent is the negative gradient of this
+            distance, interpolated bilinearly at the agent's position. This works for
+            any number of internal walls and exits, and for rooms of any shape: the grid
+            covers the walls and exits plus a margin.
+
+            Cells closer to a wall than the cell diagonal are blocked, so a door or gap
+            narrower than about three cells is closed on the grid. A ValueError is raised
+            if an exit has no free cell next to it, and a warning is given if free cells
+            cannot reach any exit; use a finer resolution in both cases.
+
+            Parameters:
+            - ``walls``: 3D-array, the wall segments of the room
+            - ``destination``: 2D-array, the positions of the exits
+            - ``room_size``: float, size of the room (the grid itself follows the walls)
+            - ``resolution``: float, side length of one grid cell
+            - ``cost``: 1D-array or None, distance added at every destination (the way that
+                        remains behind it); None: 0 for all
+
+            Attributes:
+            - ``resolution``: float, side length of one grid cell
+            - ``cost``: 1D-array, distance added at every destination
+            - ``origin``: 1D-array, position of the grid cell (0, 0)
+            - ``shape``: tuple, number of grid cells along x and y
+            - ``free``: 2D-array, True for cells that are not blocked by a wall
+            - ``distance``: 2D-array, walking distance from each cell to the nearest exit
+            - ``gradient``: 3D-array, normalized direction of steepest descent in each cell
+        """
+        self.walls = np.asarray(walls, dtype=float)
+        self.destination = np.asarray(destination, dtype=float)
+        self.resolution = resolution
+        self.cost = np.zeros(len(self.destination)) if cost is None else np.asarray(cost, dtype=float)
+
+        margin = 1.0
+        points = np.concatenate((self.walls.reshape(-1, 2), self.destination.reshape(-1, 2)))
+        self.origin = points.min(axis=0) - margin
+        extent = points.max(axis=0) + margin - self.origin
+        self.shape = tuple(int(n) for n in np.ceil(extent / resolution).astype(int) + 1)
+
+        self.free = self.free_cells()
+        self.distance = self.dijkstra()
+        unreachable = np.count_nonzero(self.free & ~np.isfinite(self.distance))
+        if unreachable:
+            warnings.warn(str(unreachable) + " free cells of the floor field cannot reach an exit (a door or gap "
+                          "may be closed at resolution " + str(resolution) + " m); agents there walk straight "
+                          "to the door. Use a finer resolution.")
+        self.free &= np.isfinite(self.distance)
+        self.gradient = self.descent_direction()
+
+    def cell_centers(self):
+        """ returns a 3D-array, the x,y position of every grid cell """
+        x = self.origin[0] + self.resolution * np.arange(self.shape[0])
+        y = self.origin[1] + self.resolution * np.arange(self.shape[1])
+        return np.stack(np.meshgrid(x, y, indexing='ij'))
+
+    def free_cells(self):
+        """ returns a 2D-array, True for the cells that are far enough from every wall.
+            A cell is blocked if it is closer to a wall than the cell diagonal, so a wall
+            is always at least one blocked cell thick and the four cells around an
+            agent never lie on both sides of a wall.
+        """
+        centers = self.cell_centers().reshape(2, -1)
+        free = np.ones(centers.shape[1], dtype=bool)
+        for wall in self.walls:
+            line_vec = wall[1] - wall[0]
+            pnt_vec = centers - wall[0][:, None]
+            temp = np.clip(line_vec.dot(pnt_vec) / line_vec.dot(line_vec), 0.0, 1.0)
+            dist = np.linalg.norm(pnt_vec - line_vec[:, None] * temp, axis=0)
+            free &= dist > np.sqrt(2) * self.resolution
+        return free.reshape(self.shape)
+
+    def dijkstra(self):
+        """ returns a 2D-array, the walking distance of every free cell to the nearest exit
+            (infinite for blocked or unreachable cells)
+        """
+        nx, ny = self.shape
+        free = self.free.ravel()
+        distance = np.full(nx * ny, np.inf)
+        heap = []
+
+        # Seed the cells around each destination with their straight distance to it,
+        # plus the way that remains behind the destination
+        centers = self.cell_centers().reshape(2, -1)
+        for des, cost in zip(self.destination, self.cost):
+            to_des = np.linalg.norm(centers - des[:, None], axis=0)
+            to_des[~free] = np.inf
+            seeds = np.flatnonzero(to_des <= 1.5 * self.resolution)
+            to_des += cost
+            if len(seeds) == 0:
+                raise ValueError("The exit at " + str(des.tolist()) + " has no free cell of the floor field next "
+                                 "to it: it is too close to a wall at resolution " + str(self.resolution)
+                                 + " m. Use a finer resolution.")
+            for cell in seeds:
+                if to_des[cell] < distance[cell]:
+                    distance[cell] = to_des[cell]
+                    heapq.heappush(heap, (to_des[cell], cell))
+
+        straight = self.resolution
+        diagonal = np.sqrt(2) * self.resolution
+        steps = ((1, 0, straight), (-1, 0, straight), (0, 1, straight), (0, -1, straight),
+                 (1, 1, diagonal), (1, -1, diagonal), (-1, 1, diagonal), (-1, -1, diagonal))
+        while heap:
+            d, cell = heapq.heappop(heap)
+            if d > distance[cell]:
+                continue
+            i, j = divmod(cell, ny)
+            for di, dj, cost in steps:
+                ni = i + di
+                nj = j + dj
+                if ni < 0 or ni >= nx or nj < 0 or nj >= ny:
+                    continue
+                neighbour = ni * ny + nj
+                if not free[neighbour]:
+                    continue
+                # Diagonal moves must not cut the corner of a wall
+                if di != 0 and dj != 0 and not (free[ni * ny + j] and free[i * ny + nj]):
+                    continue
+                if d + cost < distance[neighbour]:
+                    distance[neighbour] = d + cost
+                    heapq.heappush(heap, (d + cost, neighbour))
+        return distance.reshape(self.shape)
+
+    def descent_direction(self):
+        """ returns a 3D-array, the normalized negative gradient of the distance in every
+            free cell, using one-sided differences next to blocked cells
+        """
+        gradient = np.zeros((2,) + self.shape)
+        distance = np.where(self.free, self.distance, 0.0)
+        for axis in range(2):
+            forward = np.zeros(self.shape, dtype=bool)
+            backward = np.zeros(self.shape, dtype=bool)
+            d_forward = np.zeros(self.shape)
+            d_backward = np.zeros(self.shape)
+            inner = [slice(None), slice(None)]
+            outer = [slice(None), slice(None)]
+            inner[axis] = slice(None, -1)
+            outer[axis] = slice(1, None)
+            inner = tuple(inner)
+            outer = tuple(outer)
+            forward[inner] = self.free[inner] & self.free[outer]
+            d_forward[inner] = distance[outer] - distance[inner]
+            backward[outer] = self.free[inner] & self.free[outer]
+            d_backward[outer] = distance[outer] - distance[inner]
+            num = forward.astype(int) + backward.astype(int)
+            gradient[axis] = (d_forward * forward + d_backward * backward) / np.maximum(num, 1) / self.resolution
+
+        norm = np.linalg.norm(gradient, axis=0)
+        norm[norm == 0] = 1
+        gradient = -gradient / norm
+        gradient[:, ~self.free] = 0
+        return gradient
+
+    def direction(self, r):
+        """ returns a 2D-array, the normalized desired direction of all agents, or
+            zero where no free grid cell surrounds an agent
+            parameters: ``r``: 2D-array (position of all agents)
+        """
+        x = (r - self.origin[:, None]) / self.resolution
+        x[0] = np.clip(x[0], 0, self.shape[0] - 1.001)
+        x[1] = np.clip(x[1], 0, self.shape[1] - 1.001)
+        i = np.floor(x).astype(int)
+        s = x - i
+
+        e = np.zeros(r.shape)
+        for di, dj in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            ci = i[0] + di
+            cj = i[1] + dj
+            # Blocked cells have a zero gradient and do not contribute
+            w = (s[0] if di else 1 - s[0]) * (s[1] if dj else 1 - s[1])
+            e += w * self.gradient[:, ci, cj]
+
+        norm = np.linalg.norm(e, axis=0)
+        found = norm > 1e-9
+        e[:, found] /= norm[found]
+        return e
+
+
+def layout_key(walls, destination, room_size, resolution, cost=None):
+    """ returns a string, a hash of the room layout, the destination costs and the grid resolution """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(walls, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(destination, dtype=float).tobytes())
+    h.update(np.array([room_size, resolution], dtype=float).tobytes())
+    if cost is not None:
+        h.update(np.ascontiguousarray(cost, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def load_floor_field(walls, destination, room_size, resolution=0.2, cache_dir=None, cost=None):
+    """ returns a Floor_Field, read from ``cache_dir`` if that layout was computed before.
+        Without ``cache_dir`` the field is always computed.
+    """
+    if cache_dir is None:
+        return Floor_Field(walls, destination, room_size, resolution, cost)
+
+    path = os.path.join(cache_dir, 'floor_field_' + layout_key(walls, destination, room_size, resolution, cost)
+                        + '.npz')
+    if os.path.exists(path):
+        field = Floor_Field.__new__(Floor_Field)
+        with np.load(path) as data:
+            field.walls = data['walls']
+            field.destination = data['destination']
+            field.cost = data['cost'] if 'cost' in data else np.zeros(len(field.destination))
+            field.resolution = float(data['resolution'])
+            field.origin = data['origin']
+            field.free = data['free']
+            field.distance = data['distance']
+            field.gradient = data['gradient']
+        field.shape = field.free.shape
+        return field
+
+    field = Floor_Field(walls, destination, room_size, resolution, cost)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, walls=field.walls, destination=field.destination, cost=field.cost, resolution=field.resolution,
+             origin=field.origin, free=field.free, distance=field.distance, gradient=field.gradient)
+    return field
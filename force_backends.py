@@ -0,0 +1,221 @@
+import importlib.util
+import math
+import types
+
+import numpy as np
+
+# Numba takes a while to import, so it is only imported when the kernels are compiled
+numba_installed = importlib.util.find_spec("numba") is not None
+
+# The force kernels of Differential_Equation can run on different backends:
+# - "numpy": the vectorized NumPy kernels of Differential_Equation (always available)
+# - "numba": the loops below, compiled to machine code by Numba (if it is installed). They run
+#   through the agent pairs and agent-wall pairs once, without the (N, N) and (N, W) temporary arrays.
+#   Compiled kernels are cached on disk, and warm_up compiles them before the first time step.
+# - "python": the same loops, interpreted; very slow, but useful to check the kernels without Numba
+# "auto" picks "numba" if it is installed and "numpy" otherwise.
+# Numba takes about half a second to import and to load the cached kernels, so Differential_Equation
+# only selects the kernels when it first needs them (replicas of shape (M, 2, N) never do).
+# All kernels take the positions and velocities as (2, N) arrays and add the forces to ``out``.
+
+
+def agent_forces(r, v, radius, A, B, k, kap, out):
+    # Interacting forces of all agent pairs (same formula as Differential_Equation.f_ij)
+    n = r.shape[1]
+    for i in range(n):
+        for j in range(i + 1, n):
+            agent_pair_force(r, v, radius, A, B, k, kap, i, j, out)
+
+
+def agent_pair_forces(r, v, radius, pairs_i, pairs_j, A, B, k, kap, out):
+    # Interacting forces of the given agent pairs (from the neighbor list)
+    for p in range(len(pairs_i)):
+        agent_pair_force(r, v, radius, A, B, k, kap, pairs_i[p], pairs_j[p], out)
+
+
+def agent_pair_force(r, v, radius, A, B, k, kap, i, j, out):
+    dx = r[0, i] - r[0, j]
+    dy = r[1, i] - r[1, j]
+    d = math.sqrt(dx * dx + dy * dy)
+    if d == 0.0:
+        return
+    nx = dx / d
+    ny = dy / d
+    tx = -ny
+    ty = nx
+    dv_t = (v[0, j] - v[0, i]) * tx + (v[1, j] - v[1, i]) * ty
+    overlap = radius[i] + radius[j] - d
+    contact = overlap if overlap > 0.0 else 0.0
+    a = A * math.exp(overlap / B) + k * contact
+    b = kap * contact * dv_t
+    fx = a * nx + b * tx
+    fy = a * ny + b * ty
+    # Newton's third law: agent j feels the opposite force
+    out[0, i] += fx
+    out[1, i] += fy
+    out[0, j] -= fx
+    out[1, j] -= fy
+
+
+def wall_forces(r, v, radius, wall_start, wall_vec, wall_len, wall_unit, A, B, k, kap, out):
+    # Forces of all walls on all agents (same formula as Differential_Equation.f_iW)
+    for i in range(r.shape[1]):
+        for w in range(wall_start.shape[0]):
+            wall_force(r, v, radius, wall_start, wall_vec, wall_len, wall_unit, A, B, k, kap, i, w, out)
+
+
+def wall_pair_forces(r, v, radius, agents, walls, wall_start, wall_vec, wall_len, wall_unit, A, B, k, kap, out):
+    # Forces of the given (agent, wall) pairs (from the wall index)
+    for p in range(len(agents)):
+        wall_force(r, v, radius, wall_start, wall_vec, wall_len, wall_unit, A, B, k, kap, agents[p], walls[p], out)
+
+
+def wall_force(r, v, radius, wall_start, wall_vec, wall_len, wall_unit, A, B, k, kap, i, w, out):
+    px = r[0, i] - wall_start[w, 0]
+    py = r[1, i] - wall_start[w, 1]
+    temp = (px * wall_unit[w, 0] + py * wall_unit[w, 1]) / wall_len[w]
+    if temp < 0.0:
+        temp = 0.0
+    elif temp > 1.0:
+        temp = 1.0
+    dx = px - wall_vec[w, 0] * temp
+    dy = py - wall_vec[w, 1] * temp
+    d = math.sqrt(dx * dx + dy * dy)
+    nx = dx / d
+    ny = dy / d
+    tx = -ny
+    ty = nx
+    overlap = radius[i] - d
+    contact = overlap if overlap > 0.0 else 0.0
+    a = A * math.exp(overlap / B) + k * contact
+    b = kap * contact * (v[0, i] * tx + v[1, i] * ty)
+    out[0, i] += a * nx - b * tx
+    out[1, i] += a * ny - b * ty
+
+
+kernel_names = ("agent_pair_force", "agent_forces", "agent_pair_forces", "wall_force", "wall_forces",
+                "wall_pair_forces")
+python_kernels = types.SimpleNamespace(**{name: globals()[name] for name in kernel_names})
+compiled_kernels = None
+warmed_up = False
+
+
+def compile_kernels():
+    # Compile the kernels with Numba (cached on disk, so later runs only load them). The kernels call
+    # each other by their global names, so the compiled versions are copies of the Python functions
+    # with a namespace of their own, in which these names are the compiled kernels; the Python kernels
+    # of this module stay interpreted.
+    global compiled_kernels
+    if compiled_kernels is None:
+        import numba
+        # (the module name lets Numba load the kernels from its cache in later runs)
+        namespace = {"__name__": __name__, "math": math}
+        for name in kernel_names:
+            function = globals()[name]
+            copy = types.FunctionType(function.__code__, namespace, name, function.__defaults__)
+            namespace[name] = numba.njit(cache=True)(copy)
+        compiled_kernels = types.SimpleNamespace(**{name: namespace[name] for name in kernel_names})
+    return compiled_kernels
+
+
+def warm_up(kernels):
+    # Run every kernel once on a tiny room, so the compilation is not part of the first time step
+    global warmed_up
+    if warmed_up:
+        return
+    r = np.array([[1.0, 1.4], [1.0, 1.1]])
+    v = np.zeros((2, 2))
+    radius = np.array([0.25, 0.25])
+    walls = np.array([[0.0, 0.0], [1.0, 0.0]]), np.array([[0.0, 2.0], [2.0, 0.0]])
+    wall_len = np.linalg.norm(walls[1], axis=1)
+    wall_unit = walls[1] / wall_len[:, None]
+    pairs = np.array([0]), np.array([1])
+    out = np.zeros((2, 2))
+    kernels.agent_forces(r, v, radius, 1.0, 1.0, 1.0, 1.0, out)
+    kernels.agent_pair_forces(r, v, radius, pairs[0], pairs[1], 1.0, 1.0, 1.0, 1.0, out)
+    kernels.wall_forces(r, v, radius, walls[0], walls[1], wall_len, wall_unit, 1.0, 1.0, 1.0, 1.0, out)
+    kernels.wall_pair_forces(r, v, radius, pairs[0], pairs[0], walls[0], walls[1], wall_len, wall_unit,
+                             1.0, 1.0, 1.0, 1.0, out)
+    warmed_up = True
+
+
+def available():
+    """ returns a list, the names of the backends that can be used here """
+    return ["numpy", "python"] + (["numba"] if numba_installed else [])
+
+
+def resolve(backend="auto"):
+    """ returns a string, the backend that ``backend`` stands for ("numpy", "numba" or "python"),
+        without importing or compiling anything
+        parameters: ``backend``: string, "auto", "numpy", "numba" or "python"
+    """
+    if backend == "auto":
+        backend = "numba" if numba_installed else "numpy"
+    if backend == "numba" and not numba_installed:
+        raise ValueError('The "numba" backend needs the numba package, use backend="numpy" instead.')
+    if backend not in ("numpy", "numba", "python"):
+        raise ValueError('Unknown backend "' + str(backend) + '", use one of: auto, ' + ', '.join(available()) + '.')
+    return backend
+
+
+def select(backend="auto"):
+    """ returns the kernels of a backend (None for "numpy", which uses the kernels of Differential_Equation)
+        parameters: ``backend``: string, "auto", "numpy", "numba" or "python"
+    """
+    backend = resolve(backend)
+    if backend == "numpy":
+        return None
+    if backend == "python":
+        return python_kernels
+    kernels = compile_kernels()
+    warm_up(kernels)
+    return kernels
+
+
+def check_parity(room="square_room_with_1_exit", num_individuals=50, room_size=25, cutoff=None, seed=0,
+                 tolerance=1e-9):
+    """ returns a dictionary, for every available backend the largest difference of the accelerations
+        from those of the "numpy" backend, relative to the largest acceleration, for the same random state.
+        An AssertionError is raised if a backend differs by more than ``tolerance``, or if the "python"
+        backend does not run interpreted.
+        parameters: ``room``: string or Room, the room of the state
+                    ``num_individuals``: integer, number of agents
+                    ``room_size``: float, size of the room
+                    ``cutoff``: float or None, see Differential_Equation (tests the neighbor list and wall index)
+                    ``seed``: integer, seed of the random state
+                    ``tolerance``: float, largest allowed relative difference
+    """
+    from agent_interactions import Differential_Equation
+    from room_layout import Room
+    import spawn_placement
+
+    # The "python" backend is only a reference if neither it nor the kernels it calls are compiled
+    for name in kernel_names:
+        kernel = getattr(python_kernels, name)
+        called = [kernel.__globals__[other] for other in kernel.__code__.co_names
+                  if other in kernel_names and other in kernel.__globals__]
+        if not all(isinstance(function, types.FunctionType) for function in [kernel] + called):
+            raise AssertionError('The "python" kernel ' + name + ' calls compiled code.')
+
+    rng = np.random.default_rng(seed)
+    room = room if isinstance(room, Room) else Room(room, room_size)
+    radii = 0.25 * rng.normal(1, 0.05, num_individuals)
+    masses = 50 * radii / 0.25
+    # A crowded state: the agents are placed without overlaps and then pushed together a bit
+    r = spawn_placement.jittered_lattice(room.get_spawn_zone(), radii, room.walls, rng)
+    r = r + rng.normal(0, 0.1, r.shape)
+    v = rng.normal(0, 1, r.shape)
+
+    accelerations = {}
+    for backend in available():
+        diff_equ = Differential_Equation(num_individuals, room_size, 0.1, room, radii, masses, cutoff,
+                                         backend=backend)
+        accelerations[backend] = diff_equ.f(r, v)
+    scale = np.max(np.abs(accelerations["numpy"]))
+    differences = {backend: float(np.max(np.abs(a - accelerations["numpy"])) / scale)
+                   for backend, a in accelerations.items()}
+    failed = [backend for backend, difference in differences.items() if not difference <= tolerance]
+    if failed:
+        raise AssertionError("The accelerations of the backends " + ", ".join(failed) + " differ from the NumPy "
+                             "backend: " + ", ".join("%s %.3g" % (b, differences[b]) for b in failed) + ".")
+    return differences
@@ -0,0 +1,138 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pygame
+
+# Offscreen rendering of a simulation, without a window, e.g. on a headless server.
+# The walls and destinations are drawn once onto a background surface. Every frame is that background
+# with the agents blitted on top, from one pre-drawn sprite per radius in pixels, and the counters are
+# only rendered again when their text changes. The frames are not played back in real time: export
+# writes them as a PNG sequence, or pipes them into ffmpeg to encode a video (MP4 or any other format
+# ffmpeg knows from the file suffix).
+
+# Colors
+background_color = (250, 250, 250)  # Grey
+people_color = (250, 0, 0)  # Red
+destination_color = (0, 128, 0)  # Green
+object_color = (0, 0, 0)  # Black
+
+
+class Frame_Renderer:
+    def __init__(self, room, radii, sim_size=600, scale=1.0):
+        """
+            Draws the frames of a simulation onto an offscreen surface, as display_events shows them.
+
+            Parameters:
+            - ``room``: Room, the room of the simulation (walls and destinations)
+            - ``radii``: 1D-array, radius of all agents
+            - ``sim_size``: integer, size of the room on the image in pixels
+            - ``scale``: float, factor on the resolution of the image (e.g. 0.5 for half the pixels)
+        """
+        pygame.font.init()
+        self.normalizer = sim_size * scale / room.get_room_size()  # Pixels per metre
+        self.margin = 50 * scale
+        size = int(round(room.get_room_size() * self.normalizer + 2 * self.margin))
+        size += size % 2  # Even sizes, as video encoders need them
+        self.size = (size, size)
+        self.num_persons = len(radii)
+
+        # Static layer: the walls and destinations, drawn only once
+        self.background = pygame.Surface(self.size)
+        self.background.fill(background_color)
+        line_width = max(1, int(round(2 * scale)))
+        for wall in range(room.get_num_walls()):
+            pygame.draw.lines(self.background, object_color, True, self.to_pixels(room.get_wall(wall)), line_width)
+        for des in room.get_destination():
+            pygame.draw.circle(self.background, destination_color, self.to_pixels(des), max(1, int(round(7 * scale))))
+
+        # One sprite per radius in pixels
+        self.pixel_radii = np.maximum(np.rint(self.normalizer * np.asarray(radii)).astype(int), 1)
+        self.sprites = {}
+        for radius in np.unique(self.pixel_radii).tolist():
+            sprite = pygame.Surface((2 * radius + 1, 2 * radius + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, people_color, (radius, radius), radius)
+            self.sprites[radius] = sprite
+
+        self.font = pygame.font.Font(None, max(8, int(round(32 * scale))))
+        self.labels = {}
+        self.frame = pygame.Surface(self.size)
+
+    def to_pixels(self, points):
+        # Pixel coordinates of points in metres
+        return (self.normalizer * np.asarray(points) + self.margin).tolist()
+
+    def label(self, text):
+        # Rendered text, cached because the counters rarely change
+        if text not in self.labels:
+            self.labels[text] = self.font.render(text, True, (0, 0, 0))
+        return self.labels[text]
+
+    def render(self, position, agents_escaped=None):
+        """ returns a pygame Surface, the frame with the agents at ``position`` (it is reused by the next call)
+            parameters: ``position``: 2D-array of shape (2, N), positions of all agents
+                        ``agents_escaped``: integer or None, number of escaped agents shown in the corner
+        """
+        self.frame.blit(self.background, (0, 0))
+
+        # Agents that escaped (or left the image) are not drawn
+        pixels = self.normalizer * np.asarray(position) + self.margin
+        visible = np.all((pixels >= 0) & (pixels < self.size[0]), axis=0)
+        radius = self.pixel_radii[visible]
+        corner = np.rint(pixels[:, visible]).astype(int) - radius
+        self.frame.blits([(self.sprites[r], (x, y)) for r, x, y in zip(radius.tolist(), corner[0].tolist(),
+                                                                       corner[1].tolist())], doreturn=False)
+
+        if agents_escaped is not None:
+            self.frame.blit(self.label("Number of People Escaped: " + str(int(agents_escaped))), (10, 10))
+            self.frame.blit(self.label("Number of People: " + str(self.num_persons)),
+                            (int(self.size[0] / 2), 10))
+        return self.frame
+
+
+def export(movement_data, room, radii, path, agents_escaped=None, every=1, sim_size=600, scale=1.0, fps=30,
+           ffmpeg=None):
+    """ renders every ``every``-th frame of a simulation offscreen and writes them to ``path``,
+        returns an integer, the number of frames written
+        parameters: ``movement_data``: 3D-array of shape (2, N, number of frames), the positions of all agents
+                                       (may be the memory map of a stored run)
+                    ``room``: Room, the room of the simulation
+                    ``radii``: 1D-array, radius of all agents
+                    ``path``: string, a video file (e.g. "run.mp4", encoded by ffmpeg) or, without a suffix,
+                              a directory for a PNG sequence (frame_00000.png, ...)
+                    ``agents_escaped``: 1D-array or None, number of escaped agents in every frame
+                    ``every``: integer, frame decimation (keep one frame out of ``every``)
+                    ``sim_size``, ``scale``: see Frame_Renderer
+                    ``fps``: integer, frames per second of the video
+                    ``ffmpeg``: string or None, the ffmpeg executable (None: found on the PATH)
+    """
+    renderer = Frame_Renderer(room, radii, sim_size, scale)
+    frames = range(0, movement_data.shape[2], every)
+
+    if not os.path.splitext(path)[1]:
+        os.makedirs(path, exist_ok=True)
+        for count, t in enumerate(frames):
+            frame = renderer.render(movement_data[:, :, t], None if agents_escaped is None else agents_escaped[t])
+            pygame.image.save(frame, os.path.join(path, "frame_%05d.png" % count))
+        return len(frames)
+
+    ffmpeg = ffmpeg or shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise ValueError('Video export needs ffmpeg: install it, pass its path with ffmpeg=..., '
+                         'or give a directory to export PNG frames.')
+    command = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", "%dx%d" % renderer.size, "-r", str(fps), "-i", "-", "-pix_fmt", "yuv420p",
+               "-preset", "ultrafast", path]
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for t in frames:
+            frame = renderer.render(movement_data[:, :, t], None if agents_escaped is None else agents_escaped[t])
+            encoder.stdin.write(pygame.image.tobytes(frame, "RGB"))
+    finally:
+        encoder.stdin.close()
+        error = encoder.stderr.read()
+        encoder.wait()
+    if encoder.returncode != 0:
+        raise RuntimeError("ffmpeg could not encode " + path + ": " + error.decode(errors="replace"))
+    return len(frames)
@@ -0,0 +1,109 @@
+import threading
+
+# Live view of a simulation while the solver is still running.
+# The solver runs in a background thread and publishes every frame into a Frame_Buffer, a small ring
+# buffer that overwrites its oldest frame and never waits for the display. The display loop
+# (display_model.display_live) picks the newest frame at its own rate and skips the frames it had no
+# time for. Closing the window or pressing Escape aborts the run after the current time step.
+# Publishing a frame copies nothing: the arrays of a frame are not changed after it is yielded
+# (see differential_equation_solver.iterate).
+
+
+class Frame_Buffer:
+    def __init__(self, capacity=4):
+        """
+            Bounded ring buffer between the solver thread (publish) and the display (latest).
+
+            Parameters:
+            - ``capacity``: integer, number of frames kept; older frames are overwritten
+
+            Attributes:
+            - ``published``: integer, number of frames published so far
+            - ``finished``: boolean, the solver has published its last frame
+        """
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.published = 0
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def publish(self, frame):
+        # Store a frame in the next slot; the lock is only held for the assignment, so the solver never
+        # waits for the display
+        with self.lock:
+            self.slots[self.published % self.capacity] = frame
+            self.published += 1
+
+    def latest(self):
+        """ returns the number of frames published so far and the newest frame (None if there is none yet) """
+        with self.lock:
+            if self.published == 0:
+                return 0, None
+            return self.published, self.slots[(self.published - 1) % self.capacity]
+
+    def close(self):
+        # Called by the solver thread after the last frame
+        self.finished = True
+
+
+class Live_Sink:
+    def __init__(self, buffer, sink):
+        """
+            Trajectory sink (see trajectory_sinks) that publishes the positions of every frame to a
+            Frame_Buffer and passes the frame on to another sink.
+
+            Parameters:
+            - ``buffer``: Frame_Buffer, where the frames are published
+            - ``sink``: the sink that keeps the results of the run
+        """
+        self.buffer = buffer
+        self.sink = sink
+
+    def start(self, num_individuals, number_of_steps, dt):
+        self.sink.start(num_individuals, number_of_steps, dt)
+
+    def record(self, frame):
+        self.buffer.publish({"step": frame["step"], "y": frame["y"], "escaped": frame["escaped"]})
+        self.sink.record(frame)
+
+    def finish(self):
+        return self.sink.finish()
+
+
+def run_live(simulation, sim_size, fps=30, capacity=4, sink=None, **run_args):
+    """ runs a simulation in a background thread and shows it while it runs,
+        returns an integer, the number of frames the display skipped
+        parameters: ``simulation``: Simulation, filled (see Simulation.fill_room)
+                    ``sim_size``: integer, size of the room on the screen in pixels
+                    ``fps``: integer, display rate in frames per second
+                    ``capacity``: integer, size of the Frame_Buffer
+                    ``sink``: the sink of the run (None: the default sink of Simulation.run)
+                    ``run_args``: further arguments of Simulation.run (until_evacuated, wall_clock_limit, ...)
+    """
+    from display_model import display_live
+    from trajectory_sinks import Full_Sink
+
+    buffer = Frame_Buffer(capacity)
+    abort = threading.Event()
+    errors = []
+
+    def solve():
+        try:
+            simulation.run(Live_Sink(buffer, Full_Sink(keep_forces=False) if sink is None else sink),
+                           abort=abort, **run_args)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            buffer.close()
+
+    solver = threading.Thread(target=solve, daemon=True)
+    solver.start()
+    try:
+        skipped = display_live(buffer, simulation.room, simulation.radii, sim_size, fps, abort)
+    finally:
+        # The solver stops after its current step if the display was closed early
+        abort.set()
+        solver.join()
+    if errors:
+        raise errors[0]
+    return skipped
@@ -1,24 +1,37 @@
+import contextlib
+
 import numpy as np
-import sys
 
 from agent_interactions import Differential_Equation
-from display_model import display_events
-from display_model import display_graph
 from room_layout import Room
 import differential_equation_solver
+from parallel_forces import Shared_Forces
+from profiling import Phase_Profiler
+import safety_metrics
+from safety_metrics import Safety_Metrics
+import spawn_placement
+from trajectory_sinks import Full_Sink
+from trajectory_store import Store_Sink
 # from differential_equation_solver import leap_frog
 
 class Simulation:
-    def __init__(self, num_individuals, num_steps, method="leap_frog", time_step=0.1, velocity_factor=1.25, room="square_room_with_1_exit", room_size=25):
+    def __init__(self, num_individuals, num_steps, method="staggered_leap_frog", time_step=0.1, velocity_factor=1.25, room="square_room_with_1_exit", room_size=25, cutoff=None, navigation="floor_field", seed=None, backend="auto", force_processes=1, profile=False, relaxation_time=None):
         # Initialization of simulation parameters and agent characteristics
+        # Random numbers come from NumPy's global generator, or from an own generator if a seed is given
+        self.rng = np.random if seed is None else np.random.default_rng(seed)
         std_deviation = 0.05  # Standard deviation used for generating variation in agent size and weight
-        variation = np.random.normal(loc=1, scale=std_deviation, size=(1, num_individuals))
+        variation = self.rng.normal(loc=1, scale=std_deviation, size=(1, num_individuals))
 
         # Constants
         self.L = room_size  # Size of the simulation room
         self.N = num_individuals  # Number of individuals/agents in the simulation
         self.time_step = time_step  # Time step for the simulation
-        self.num_steps = num_steps  # Number of simulation steps
+        # Time in which agents adapt their velocity to the desired one (None: time_step)
+        self.relaxation_time = time_step if relaxation_time is None else relaxation_time
+        self.num_steps = num_steps  # Number of simulation steps (None: until everybody escaped)
+        self.cutoff = cutoff  # Distance beyond which agents don't interact (None: all pairs)
+        self.navigation = navigation  # How agents find the door around internal walls ("floor_field" or "geometric")
+        self.force_processes = force_processes  # Processes computing the forces (more than 1 needs a cutoff)
 
         # Agent information
         self.radii = 0.25 * (np.ones(self.N) * variation).squeeze()  # Radii of agents
@@ -29,67 +42,166 @@ class Simulation:
         #self.velocity_factor = random_velocity_factor * np.ones(self.N)  # Update self.velocity_factor with the random velocity factor for all elements
         self.velocity_factor = velocity_factor * np.ones(self.N)  # Desired velocity of agents
 
-        self.forces = 0  # Forces acting on agents during simulation
+        self.forces = None  # Accelerations of the agents during simulation (only kept if the sink keeps them)
+        self.safety = None  # Safety metrics of the last run, accumulated while it ran (see safety_metrics)
         self.agents_escaped = None  # Number of agents that have escaped the room
-        self.v = np.zeros((2, self.N, self.num_steps))  # Velocities of agents
-        self.y = np.zeros((2, self.N, self.num_steps))  # Positions of agents
-
-        self.room = Room(room, room_size)  # Definition of the simulation room
-        self.method = getattr(differential_equation_solver, method)  # Method for solving differential equations
-        self.diff_equ = Differential_Equation(self.N, self.L, self.time_step, self.room, self.radii, self.m)  # Differential equation for agent interactions
+        self.escape_step = None  # Time step at which each agent escaped (-1: still inside)
+        self.force_evaluations = 0  # Number of evaluations of the differential equation during the run
+        self.evacuation_time = None  # Time until everybody escaped (nan if somebody is left)
+        self.v = np.zeros((2, self.N, 1))  # Initial velocities of agents (the run stores the trajectory)
+        self.y = np.zeros((2, self.N, 1))  # Initial positions of agents
+        self.results = None  # Everything the sink of the last run kept
+        # Per-phase timing of the runs (see profiling): profile=True, or "trace" to also keep a timeline
+        self.profiler = Phase_Profiler(trace=profile == "trace") if profile else None
+
+        # Definition of the simulation room; a Room instance can be shared between simulations
+        self.room = room if isinstance(room, Room) else Room(room, room_size)
+        self.room_name = self.room.name  # Name of the room layout
+        self.set_method(method)  # Name of the method for solving differential equations
+        self.diff_equ = Differential_Equation(self.N, self.L, self.time_step, self.room, self.radii, self.m, self.cutoff,
+                                              self.navigation, backend, self.relaxation_time)  # Differential equation for agent interactions
 
     def set_steps(self, steps):
         # Set the number of simulation steps
         self.num_steps = steps
 
     def set_method(self, method):
-        # Set the method for solving differential equations
-        self.method = getattr(differential_equation_solver, method)
-
-    def dont_touch(self, i, x):
-        # Check if an agent touches another agent
-        for j in range(i - 1):
-            if np.linalg.norm(x - self.y[:, j, 0]) < 3 * self.radii[i]:
-                return True
-        return False
-
-    def fill_room(self):
-        # Fill the spawn zone with agents having random positions
-        spawn = self.room.get_spawn_zone()
-        len_right = spawn[0, 1] - spawn[0, 0]
-        len_left = spawn[1, 1] - spawn[1, 0]
-        max_len = max(len_left, len_right)
-
-        # Check if the area is too small for the agents to fit in
-        area_people = 0
-        for i in range(self.N):
-            area_people += 4 * self.radii[i] ** 2
-        if area_people >= 0.7 * max_len ** 2:
-            sys.exit('Too many people! Please change the size of the room/spawn-zone or the number of people.')
-
-        # Check if the agent touches another agent/wall and if so, give it a new random position in the spawn-zone
-        for i in range(self.N):
-            # The pedestrians don't touch the wall
-            x = len_right * np.random.rand() + spawn[0, 0]
-            y = len_left * np.random.rand() + spawn[1, 0]
-            pos = [x, y]
-
-            # The pedestrians don't touch each other
-            while self.dont_touch(i, x):
-                x = len_right * np.random.rand() + spawn[0, 0]
-                y = len_left * np.random.rand() + spawn[1, 0]
-                pos = [x, y]
-            self.y[:, i, 0] = pos
+        # Set the method for solving differential equations (a key of differential_equation_solver.methods,
+        # or "adaptive"); run passes the name on to differential_equation_solver.iterate
+        if method not in differential_equation_solver.methods and method != "adaptive":
+            raise ValueError('Unknown method "' + method + '", use one of '
+                             + ', '.join(list(differential_equation_solver.methods) + ["adaptive"]) + '.')
+        self.method_name = method
+
+    @property
+    def method(self):
+        # The function of differential_equation_solver that runs the method (leap_frog, rk4, ...)
+        return getattr(differential_equation_solver, self.method_name)
+
+    @method.setter
+    def method(self, method):
+        # Takes the name of a method or its function, as set_method
+        self.set_method(method if isinstance(method, str) else method.__name__)
+
+    def fill_room(self, method="lattice"):
+        # Give the agents random positions in the spawn zone, without touching each other or a wall.
+        # method: "lattice" (randomly jittered lattice, the fastest) or "poisson" (Poisson-disk sampling),
+        # see spawn_placement. A ValueError is raised if the agents cannot fit into the spawn zone.
+        if method not in spawn_placement.methods:
+            raise ValueError('Unknown placement method "' + method + '", use one of '
+                             + ', '.join(spawn_placement.methods) + '.')
+        place = spawn_placement.methods[method]
+        self.y[:, :, 0] = place(self.room.get_spawn_zone(), self.radii, self.room.walls, self.rng)
 
         self.v[:, :, 0] = self.velocity_factor * self.diff_equ.e_t(self.y[:, :, 0])
 
-    def run(self):
-        # Run the simulation by calling the method of integration with the starting positions, differential equation,
-        # number of steps, and delta t = time_step
-        self.y, self.agents_escaped, self.forces = self.method(self.y[:, :, 0], self.v[:, :, 0], self.diff_equ.f,
-                                                               self.num_steps, self.time_step, self.room)
+    def stream(self, f=None):
+        # Generator of the simulation state after every time step, starting from the positions
+        # given by fill_room. Only the current state is kept in memory.
+        # f: the acceleration function (default: self.diff_equ.f)
+        f = self.diff_equ.f if f is None else f
+        return differential_equation_solver.iterate(self.y[:, :, 0], self.v[:, :, 0], f,
+                                                    self.num_steps, self.time_step, self.room, self.method_name,
+                                                    self.profiler, self.relaxation_time)
 
-    def show(self, wait_time, sim_size):
-        # Display the simulation in pygame
-        display_graph(self.agents_escaped, self.forces, self.m)
+    def run(self, sink=None, until_evacuated=None, wall_clock_limit=None, stall_time=None, abort=None):
+        # Run the simulation by calling the method of integration with the starting positions, differential equation,
+        # number of steps, and delta t = time_step.
+        # The sink decides what is kept of each time step (see trajectory_sinks); by default the whole
+        # trajectory is stored in self.y and self.agents_escaped, but not the accelerations: the safety
+        # metrics (escape curve, crushed agents, peak forces, ...) are accumulated in self.safety instead.
+        # With until_evacuated (the default if num_steps is None), the run stops as soon as everybody
+        # escaped, after wall_clock_limit seconds of real time, or when nobody escaped for stall_time
+        # seconds; num_steps is then only an upper limit, and the stored trajectory grows in chunks.
+        # abort: threading.Event or None; once it is set, the run stops after the current step ("aborted").
+        # With profiling switched on, the phases of the run are timed in self.profiler (see profiling).
+        if until_evacuated is None:
+            until_evacuated = self.num_steps is None or wall_clock_limit is not None or stall_time is not None
+        if sink is None:
+            sink = Full_Sink(keep_forces=False)
+        metrics = Safety_Metrics(self.m)
+
+        # With several force processes, the forces are computed strip by strip in shared memory
+        forces = None
+        if self.force_processes != 1:
+            forces = Shared_Forces(self.diff_equ, self.force_processes, self.profiler)
+        f = self.diff_equ.f if forces is None else forces
+
+        def keep(frame):
+            sink.record(frame)
+            metrics.record(frame)
+
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.attach(self.diff_equ)
+            profiler.start_run()
+            f = profiler.timed("forces", f)
+            keep = profiler.timed("sink", keep)
+        try:
+            frames = self.stream(f)
+            if until_evacuated:
+                frames = differential_equation_solver.until_evacuated(frames, self.time_step, wall_clock_limit,
+                                                                      stall_time)
+                sink.start(self.N, None, self.time_step)
+                metrics.start(self.N, None, self.time_step)
+            else:
+                sink.start(self.N, self.num_steps, self.time_step)
+                metrics.start(self.N, self.num_steps, self.time_step)
+            for frame in frames:
+                if abort is not None and abort.is_set():
+                    frame["stop_reason"] = "aborted"
+                keep(frame)
+                if profiler is not None:
+                    profiler.record(frame)
+                if "stop_reason" in frame:
+                    break
+        finally:
+            if forces is not None:
+                forces.close()
+            if profiler is not None:
+                profiler.finish_run()
+                profiler.detach(self.diff_equ)
+        self.results = sink.finish()
+        self.safety = metrics.finish()
+
+        for name in ("y", "agents_escaped", "forces", "escape_step", "force_evaluations"):
+            if name in self.results:
+                setattr(self, name, self.results[name])
+        if np.all(self.escape_step >= 0):
+            self.evacuation_time = np.max(self.escape_step, initial=0) * self.time_step
+        else:
+            self.evacuation_time = np.nan
+
+    def run_to_disk(self, path, every=1, dtype=np.float64, keep_forces=False):
+        # Run the simulation and write every ``every``-th frame straight to the stored run ``path``
+        # (see trajectory_store). Afterwards self.y is a memory map of the stored run, and so is
+        # self.forces if the accelerations are kept (keep_forces), otherwise it is None.
+        self.run(Store_Sink(path, self.room_name, self.L, self.radii, self.m, every=every, dtype=dtype,
+                            keep_forces=keep_forces))
+
+    def export(self, path, every=1, sim_size=600, scale=1.0, fps=30):
+        # Render the stored trajectory offscreen, without a display, to a video file (e.g. "run.mp4",
+        # encoded by ffmpeg) or to a directory of PNG frames; see frame_renderer.export.
+        # every: frame decimation, scale: factor on the resolution
+        from frame_renderer import export
+        with self.profiler.phase("render") if self.profiler is not None else contextlib.nullcontext():
+            return export(self.y, self.room, self.radii, path, self.agents_escaped, every, sim_size, scale, fps)
+
+    def show_live(self, sim_size, fps=30, **run_args):
+        # Run the simulation in a background thread and display it while it runs (see live_view);
+        # closing the window or pressing Escape aborts the run. run_args are passed on to run.
+        from live_view import run_live
+        return run_live(self, sim_size, fps, **run_args)
+
+    def show(self, wait_time, sim_size, recompute=False):
+        # Display the simulation in pygame, after the graphs of the safety metrics.
+        # With recompute, the metrics are computed again from the stored accelerations (self.forces,
+        # kept by run_to_disk or a sink with keep_forces) instead of using those of the run.
+        # Pygame and matplotlib are only imported here, so headless runs don't need them.
+        from display_model import display_events, display_graph
+
+        metrics = self.safety
+        if recompute and self.forces is not None:
+            metrics = safety_metrics.from_trajectory(self.forces, self.m, self.time_step, self.agents_escaped)
+        display_graph(metrics)
         display_events(self.y, self.room, wait_time, self.radii, sim_size, self.agents_escaped)
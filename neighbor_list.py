@@ -0,0 +1,161 @@
+import numpy as np
+
+
+class Neighbor_List:
+    def __init__(self, room, radius, cutoff=2.0, skin=None, time_step=0.1, rebuild_every=5):
+        """
+            Cell list / Verlet list of the agent pairs that are close enough to interact.
+
+            The room's bounding box is divided into square cells that are at least
+            ``cutoff + skin`` wide, so every pair closer than that lies in the same
+            or in neighbouring cells. The resulting pair list is kept and reused
+            until some agent has moved more than half the skin since it was built.
+
+            By default the skin follows the speed of the agents: at every build it is set
+            to 2 * v_max * time_step * rebuild_every (between 0.1 m and the cutoff), so the
+            fastest agent needs about ``rebuild_every`` steps to use up half of it.
+            The pairs are kept by agent number, so agents leaving the room (a smaller
+            set of agents, see Differential_Equation.acceleration) don't force a rebuild.
+
+            Parameters:
+            - ``room``: object, the room in which the agents move
+            - ``radius``: 1D-array, radius of all individuals
+            - ``cutoff``: float, distance beyond which agents do not interact
+            - ``skin``: float or None, extra distance kept in the list so it can be reused
+                        (None: from the speed of the agents, see above)
+            - ``time_step``: float, time step of the simulation (for the automatic skin)
+            - ``rebuild_every``: integer, steps the automatic skin should last at the largest speed
+
+            Attributes:
+            - ``cutoff``: float, interaction cutoff distance
+            - ``skin``: float, width of the Verlet skin of the current list
+            - ``cell_size``: float, side length of one cell
+            - ``num_cells``: integer, number of cells along each axis
+            - ``origin``: 1D-array, lower left corner of the cell grid
+            - ``builds``: integer, how many times the list has been rebuilt
+        """
+        self.cutoff = cutoff
+        self.fixed_skin = skin
+        self.time_step = time_step
+        self.rebuild_every = rebuild_every
+        self.min_cell = 2 * np.max(radius)
+        self.N = len(radius)
+
+        # The grid covers the room plus a margin for the destinations outside the doors
+        self.room_size = room.get_room_size()
+        self.margin = 1.0
+        self.origin = np.array([-self.margin, -self.margin])
+        self.set_skin(0.5 if skin is None else skin)
+
+        self.r_ref = np.zeros((2, self.N))
+        self.built = np.zeros(self.N, dtype=bool)  # The agents the list was built for
+        self.pairs_i = np.zeros(0, dtype=int)
+        self.pairs_j = np.zeros(0, dtype=int)
+        self.builds = 0
+
+    def set_skin(self, skin):
+        # Cells at least as wide as the list range
+        self.skin = skin
+        self.list_range = self.cutoff + skin
+        self.cell_size = max(self.list_range, self.min_cell)
+        self.num_cells = max(1, int(np.ceil((self.room_size + 2 * self.margin) / self.cell_size)))
+
+    def cell_index(self, r):
+        """ returns two 1D-arrays, the cell coordinates of every agent
+            parameters: ``r``: 2D-array (position of all agents)
+        """
+        c = np.floor((r - self.origin[:, None]) / self.cell_size).astype(int)
+        # Agents outside the grid are put in the border cells
+        c = np.clip(c, 0, self.num_cells - 1)
+        return c[0], c[1]
+
+    def build(self, r, v=None, index=None):
+        """ rebuilds the pair list from scratch with a cell list
+            parameters: ``r``: 2D-array (position of the agents)
+                        ``v``: 2D-array or None (velocity of the agents, for the automatic skin)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``; None: all)
+        """
+        index = np.arange(r.shape[1]) if index is None else index
+        if self.fixed_skin is None and v is not None and v.shape[1]:
+            v_max = np.sqrt(np.max(v[0] ** 2 + v[1] ** 2))
+            self.set_skin(float(np.clip(2 * v_max * self.time_step * self.rebuild_every, 0.1, self.cutoff)))
+
+        num_agents = r.shape[1]
+        cx, cy = self.cell_index(r)
+        cell = cx * self.num_cells + cy
+
+        # Sort the agents by cell, so the agents of one cell are contiguous
+        order = np.argsort(cell, kind='stable')
+        count = np.bincount(cell, minlength=self.num_cells ** 2)
+        start = np.cumsum(count) - count
+
+        agents = np.arange(num_agents)
+        pairs_i = []
+        pairs_j = []
+        # Half of the neighbouring cells, so that every pair of cells is visited once
+        for ox, oy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            nx = cx + ox
+            ny = cy + oy
+            inside = (nx >= 0) & (nx < self.num_cells) & (ny >= 0) & (ny < self.num_cells)
+            i = agents[inside]
+            neighbour = nx[inside] * self.num_cells + ny[inside]
+            n_count = count[neighbour]
+
+            # Every agent i is paired with each agent in its neighbouring cell
+            i = np.repeat(i, n_count)
+            offset = np.arange(len(i)) - np.repeat(np.cumsum(n_count) - n_count, n_count)
+            j = order[np.repeat(start[neighbour], n_count) + offset]
+            if ox == 0 and oy == 0:
+                keep = i < j
+                i = i[keep]
+                j = j[keep]
+            pairs_i.append(i)
+            pairs_j.append(j)
+
+        i = np.concatenate(pairs_i)
+        j = np.concatenate(pairs_j)
+        d = np.linalg.norm(r[:, i] - r[:, j], axis=0)
+        keep = d < self.list_range
+        # The pairs are stored by agent number
+        self.pairs_i = index[i[keep]]
+        self.pairs_j = index[j[keep]]
+        self.built[:] = False
+        self.built[index] = True
+        self.r_ref[:, index] = r
+        self.builds += 1
+
+    def update(self, r, v=None, index=None):
+        """ rebuilds the pair list if some agent moved more than half the skin, or if
+            agents are there that the list was not built for
+            parameters: see build
+        """
+        index = np.arange(r.shape[1]) if index is None else index
+        if self.builds == 0 or not np.all(self.built[index]):
+            self.build(r, v, index)
+            return
+        displacement = np.max(np.sum((r - self.r_ref[:, index]) ** 2, axis=0), initial=0.0)
+        if displacement > (0.5 * self.skin) ** 2:
+            self.build(r, v, index)
+
+    def pairs(self, r, v=None, index=None):
+        """ returns two 1D-arrays, the agents i and j of every pair closer than the cutoff,
+            as columns of ``r``
+            parameters: ``r``: 2D-array (position of the agents)
+                        ``v``: 2D-array or None (velocity of the agents, for the automatic skin)
+                        ``index``: 1D-array or None (the agents in the columns of ``r``; None: all)
+        """
+        self.update(r, v, index)
+        i = self.pairs_i
+        j = self.pairs_j
+        if index is not None:
+            # Column of every agent in r (-1: not there, e.g. escaped since the build)
+            column = np.full(self.N, -1)
+            column[index] = np.arange(len(index))
+            i = column[i]
+            j = column[j]
+            present = (i >= 0) & (j >= 0)
+            i = i[present]
+            j = j[present]
+        d = np.linalg.norm(r[:, i] - r[:, j], axis=0)
+        keep = d < self.cutoff
+        return i[keep], j[keep]
@@ -0,0 +1,169 @@
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from profiling import Phase_Profiler
+
+# Force evaluation for very large crowds on several cores.
+# The positions, velocities, accelerations and active flags of all agents are kept in shared memory
+# buffers. The room is cut into vertical strips with (about) the same number of agents, one per worker
+# process. Every worker computes the acceleration of the agents in its strip, seeing also the agents
+# within the cutoff of the strip, and writes it straight into the shared acceleration buffer; only a
+# short message per step goes through the pipes, no arrays are pickled.
+# Shared_Forces is a callable with the signature of Differential_Equation.f, so it can be passed to
+# the integration methods of differential_equation_solver unchanged.
+# An exception in a worker is sent back with its traceback and raised again in the main process, and a
+# worker that dies is noticed, so the main process never waits forever for a strip.
+# With a profiler, every worker times its own phases (e_t, f_ag, f_wa, ...) and sends the totals of
+# each step back with its reply; they are summed over the workers (see profiling).
+
+
+def strip_worker(connection, diff_equ, buffers, num_individuals, strip, profile=False):
+    # Computes the accelerations of the agents in one strip whenever the main process asks for it.
+    # Replies ("done", timings) after every step, timings being None or the (time, calls) of the phases
+    # of the step, or ("error", traceback) if the step failed.
+    try:
+        profiler = Phase_Profiler() if profile else None
+        if profiler is not None:
+            profiler.attach(diff_equ)
+        arrays = attach(buffers, num_individuals)
+        reach = diff_equ.neighbor_list.cutoff
+        while True:
+            command = connection.recv()
+            if command == "stop":
+                break
+            r, v, acc, active, bounds = arrays
+            low, high = bounds[strip], bounds[strip + 1]
+            x = r[0]
+            owned = np.flatnonzero(active & (x >= low) & (x < high))
+            halo = np.flatnonzero(active & ((x < low) | (x >= high)) & (x >= low - reach) & (x < high + reach))
+            index = np.concatenate((owned, halo))
+            if len(owned):
+                acc[:, owned] = diff_equ.acceleration(r[:, index], v[:, index], index)[:, :len(owned)]
+            timings = None
+            if profiler is not None:
+                timings = (profiler.time, profiler.calls)
+                profiler.time, profiler.calls = {}, {}
+            connection.send(("done", timings))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    connection.close()
+
+
+def attach(buffers, num_individuals):
+    # NumPy views of the shared buffers: positions, velocities, accelerations, active flags, strip bounds
+    r, v, acc, active, bounds = buffers
+    return (np.ndarray((2, num_individuals), dtype=float, buffer=r.buf),
+            np.ndarray((2, num_individuals), dtype=float, buffer=v.buf),
+            np.ndarray((2, num_individuals), dtype=float, buffer=acc.buf),
+            np.ndarray(num_individuals, dtype=bool, buffer=active.buf),
+            np.ndarray(bounds.size // 8, dtype=float, buffer=bounds.buf))
+
+
+class Shared_Forces:
+    def __init__(self, diff_equ, processes=None, profiler=None):
+        """
+            The acceleration of all agents (Differential_Equation.f), computed by worker processes that
+            each take one vertical strip of the room.
+
+            Use it as a context manager, or call close() at the end, to stop the workers and free the
+            shared memory.
+
+            Parameters:
+            - ``diff_equ``: Differential_Equation with a cutoff (agents further apart do not interact,
+                            which is what lets a strip be computed from the agents near it)
+            - ``processes``: integer or None, number of worker processes (None: one per core)
+            - ``profiler``: Phase_Profiler or None, gets the phases timed in the workers
+
+            A RuntimeError is raised if a worker fails or stops, with the traceback of the worker.
+        """
+        if diff_equ.neighbor_list is None:
+            raise ValueError('Parallel force evaluation needs a Differential_Equation with a cutoff.')
+        self.diff_equ = diff_equ
+        self.N = diff_equ.N
+        self.processes = processes or multiprocessing.cpu_count()
+        self.profiler = profiler
+
+        sizes = (16 * self.N, 16 * self.N, 16 * self.N, self.N, 8 * (self.processes + 1))
+        self.buffers = [shared_memory.SharedMemory(create=True, size=max(size, 1)) for size in sizes]
+        self.r, self.v, self.acc, self.active, self.bounds = attach(self.buffers, self.N)
+
+        self.connections = []
+        self.workers = []
+        for strip in range(self.processes):
+            connection, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=strip_worker, daemon=True,
+                                             args=(child, diff_equ, self.buffers, self.N, strip,
+                                                   profiler is not None))
+            worker.start()
+            child.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def __call__(self, r, v, active=None):
+        """ returns a 2D-array, the acceleration of all agents (see Differential_Equation.f) """
+        self.r[:] = r
+        self.v[:] = v
+        self.active[:] = True if active is None else active
+        self.acc[:] = 0
+
+        # Strips with the same number of active agents
+        x = self.r[0, self.active]
+        if len(x):
+            self.bounds[:] = np.quantile(x, np.linspace(0, 1, self.processes + 1))
+        self.bounds[0] = -np.inf
+        self.bounds[-1] = np.inf
+
+        for connection in self.connections:
+            try:
+                connection.send("step")
+            except OSError:
+                pass  # The worker stopped, receive reports it
+        # Wait for every worker before raising, so no reply is left in a pipe
+        failures = []
+        for strip, (connection, worker) in enumerate(zip(self.connections, self.workers)):
+            reply = self.receive(connection, worker)
+            if reply[0] != "done":
+                failures.append('Force worker of strip ' + str(strip) + ' failed:\n' + reply[1])
+            elif reply[1] is not None and self.profiler is not None:
+                self.profiler.add_totals(*reply[1])
+        if failures:
+            raise RuntimeError('\n'.join(failures))
+        # The buffer is overwritten by the next call
+        return self.acc.copy()
+
+    @staticmethod
+    def receive(connection, worker, interval=0.5):
+        # The reply of a worker; ("error", message) if the worker stopped without replying
+        while not connection.poll(interval):
+            if not worker.is_alive():
+                break
+        try:
+            return connection.recv()
+        except (EOFError, OSError):
+            return ("error", 'the worker process stopped (exit code ' + str(worker.exitcode) + ').')
+
+    def close(self):
+        # Stop the workers and free the shared memory
+        for connection, worker in zip(self.connections, self.workers):
+            try:
+                connection.send("stop")
+            except OSError:
+                pass  # The worker already stopped
+            worker.join()
+            connection.close()
+        self.connections = []
+        self.workers = []
+        del self.r, self.v, self.acc, self.active, self.bounds
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()
+        self.buffers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
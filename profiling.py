@@ -0,0 +1,145 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Per-phase timing of a simulation run, switched on with Simulation(profile=True).
+# The phases are timed by wrapping the functions that implement them, only while a profiled run is
+# going on; without a profiler nothing is wrapped, so a run costs the same as before.
+# The phases of a run are:
+# - "step": one step of the integration method, including the force evaluations
+# - "forces": one evaluation of the differential equation (the accelerations of all agents)
+# - "e_t", "direction": the desired directions (direction: per agent, with geometric navigation)
+# - "f_ag", "f_wa": the forces between the agents and of the walls
+# - "escape": the check which agents reached a door
+# - "sink": keeping the results of a frame
+# - "render": drawing or exporting the run (Simulation.show, Simulation.export)
+# Phases are nested: "step" contains "forces", which contains "e_t", "f_ag" and "f_wa".
+# With profile="trace", every call is also kept on a timeline that can be exported in the Chrome trace
+# format (to open in chrome://tracing or Perfetto).
+# With several force processes (Simulation(force_processes=...)), "forces" is the wall time of the
+# parallel evaluation, while the phases inside it are timed in the workers and summed over them, so they
+# can add up to more than "forces"; the calls in the workers are not on the timeline.
+
+# The methods of Differential_Equation that are timed, by phase
+diff_equ_phases = ("e_t", "direction", "f_ag", "f_wa")
+
+
+class Phase_Profiler:
+    def __init__(self, trace=False):
+        """
+            Cumulative time and number of calls of every phase of a run, and per-step statistics.
+
+            Parameters:
+            - ``trace``: boolean, also keep every call with its start time (for to_chrome_trace)
+
+            Attributes:
+            - ``time``, ``calls``: dictionaries, seconds spent in and number of calls of every phase
+            - ``force_evaluations``: list, evaluations of the differential equation in every step
+            - ``active``: list, agents still in the room after every step
+            - ``wall_time``: float, seconds spent in profiled runs
+        """
+        self.trace = trace
+        self.time = {}
+        self.calls = {}
+        self.events = []
+        self.force_evaluations = []
+        self.active = []
+        self.step_times = []
+        self.wall_time = 0.0
+        self.origin = time.perf_counter()
+        self.last_evaluations = 0
+
+    def add(self, name, started, ended):
+        # Count one call of a phase
+        self.time[name] = self.time.get(name, 0.0) + ended - started
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.trace:
+            self.events.append((name, started, ended, threading.get_ident()))
+
+    def add_totals(self, times, calls):
+        # Add the time and calls of phases timed elsewhere (in the workers of parallel_forces)
+        for name in times:
+            self.time[name] = self.time.get(name, 0.0) + times[name]
+            self.calls[name] = self.calls.get(name, 0) + calls[name]
+
+    def timed(self, name, function):
+        """ returns a function that calls ``function`` and counts the call as the phase ``name`` """
+        def timed_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, started, time.perf_counter())
+        return timed_function
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Count a block of code as a call of the phase ``name``
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.perf_counter())
+
+    def attach(self, diff_equ):
+        # Time the methods of a Differential_Equation, by shadowing them with timed instance attributes
+        for name in diff_equ_phases:
+            setattr(diff_equ, name, self.timed(name, getattr(diff_equ, name)))
+
+    def detach(self, diff_equ):
+        # Remove the timed methods again
+        for name in diff_equ_phases:
+            diff_equ.__dict__.pop(name, None)
+
+    def start_run(self):
+        self.run_started = time.perf_counter()
+        self.last_evaluations = 0
+
+    def record(self, frame):
+        # Per-step statistics of a frame of differential_equation_solver.iterate
+        self.force_evaluations.append(frame["evaluations"] - self.last_evaluations)
+        self.last_evaluations = frame["evaluations"]
+        self.active.append(int(np.count_nonzero(frame["active"])))
+        self.step_times.append(time.perf_counter())
+
+    def finish_run(self):
+        self.wall_time += time.perf_counter() - self.run_started
+
+    def report(self):
+        """ returns a dictionary, the profile of the runs so far:
+            - ``phases``: for every phase the total time (s), the number of calls and the mean time per call (s)
+            - ``steps``: integer, number of recorded frames
+            - ``wall_time``: float, seconds spent in the runs
+            - ``steps_per_second``: float, frames per second of run time
+            - ``force_evaluations_per_step``, ``active_per_step``: lists, one value per frame
+        """
+        phases = {name: {"time": self.time[name], "calls": self.calls[name],
+                         "mean": self.time[name] / self.calls[name]}
+                  for name in sorted(self.time, key=self.time.get, reverse=True)}
+        steps = len(self.active)
+        return {"phases": phases, "steps": steps, "wall_time": self.wall_time,
+                "steps_per_second": steps / self.wall_time if self.wall_time > 0 else float("nan"),
+                "force_evaluations_per_step": list(self.force_evaluations),
+                "active_per_step": list(self.active)}
+
+    def to_json(self, path):
+        # Write the report as JSON
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=1)
+
+    def to_chrome_trace(self, path):
+        # Write the timeline in the Chrome trace format: one complete event per call of a phase, and a
+        # counter with the active agents per step. Needs a profiler with trace=True.
+        if not self.trace:
+            raise ValueError('The timeline is only kept with Simulation(profile="trace").')
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "ts": 1e6 * (started - self.origin), "dur": 1e6 * (ended - started),
+                   "pid": pid, "tid": tid} for name, started, ended, tid in self.events]
+        events += [{"name": "active agents", "ph": "C", "ts": 1e6 * (at - self.origin), "pid": pid,
+                    "args": {"active": active}} for at, active in zip(self.step_times, self.active)]
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
@@ -1,93 +1,76 @@
+import hashlib
+import json
+import os
+
 # Import the NumPy library to work with numerical operations and arrays
 import numpy as np
 
+# The room layouts are described in JSON files. The built-in layouts are in the rooms directory next to
+# this file; a layout can also be loaded from any other file by passing its path instead of a name.
+# All lengths are fractions of the room size, so one file describes the layout for every room size:
+# - "door_size": width of the exits
+# - "doors": list of {"side": "left"/"right"/"bottom"/"top", "position": centre of the door along that side,
+#   "width": optional, width of this door instead of door_size}; the outer walls are left open there
+# - "obstacles": optional, list of wall segments [[x0, y0], [x1, y1]] inside the room
+# - "destinations": optional, the positions the agents walk to (by default 0.5 m in front of every door)
+# - "spawn_zone": [[x_min, x_max], [y_min, y_max]], where the agents are placed
+# - "wall_shear": optional, True if the agents have to walk around walls (by default: if there are obstacles)
+# Positions that are partly absolute (like 1 m away from a wall) are given as {"fraction": ..., "metres": ...};
+# the position is then fraction * room size + metres.
+
+layout_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rooms")
+compiled_rooms = {}  # Compiled geometry of the loaded layouts, by content hash of the file and the room size
+
+
+def layouts():
+    # Get the names of the built-in room layouts
+    return sorted(name[:-len(".json")] for name in os.listdir(layout_dir) if name.endswith(".json"))
+
+
 # Define a class named Room that represents different room configurations
 class Room:
     def __init__(self, room, room_size):
-        # Initialize the Room object with a given room type and room size
-
-        self.room_size = room_size  # Store the room size
-
-        if room == "square_room_with_1_exit":
-            # Configuration for a square room with a single exit
-            self.wall_shear = False  # No walls in this configuration
-            self.door_size = room_size / 20  # Width of the exit
-            self.destination = np.array([[-0.5, room_size / 2]])  # Position of the destination
-            self.number_of_walls = 5  # Number of walls in the room.
-            self.walls = np.array([[[0, 0], [0, room_size / 2 - self.door_size / 2]],  # Wall coordinates
-                                  [[0, room_size / 2 + self.door_size / 2], [0, room_size]],  
-                                  [[0, room_size], [room_size, room_size]],             
-                                  [[room_size, room_size], [room_size, 0]],             
-                                  [[room_size, 0], [0, 0]]])                 
-                                  
-            self.spawn_zone = np.array([[room_size / 2, room_size - 1], [1, room_size - 1]])  # Agent spawn zone
-
-        if room == "square_room_with_1_exit_1_additional_wall":
-            # Configuration for a square room with one exit and an additional wall
-            self.wall_shear = True  # Walls are present in this configuration
-            self.door_size = room_size / 15  # Width of the exit
-            self.destination = np.array([[-0.5, room_size / 2]])  # Position of the destination
-            self.number_of_walls = 6  # Number of walls in the room
-            self.walls = np.array([[[0, 0], [0, room_size / 2 - self.door_size / 2]],  # Wall coordinates
-                                  [[0, room_size / 2 + self.door_size / 2], [0, room_size]],  
-                                  [[0, room_size], [room_size, room_size]],             
-                                  [[room_size, room_size], [room_size, 0]],             
-                                  [[room_size, 0], [0, 0]],                             
-                                  [[room_size / 4, room_size * 0.3], [room_size / 4, room_size * 0.7]]])  # Wall coordinates
-                                  
-            self.spawn_zone = np.array([[room_size / 2, room_size - 1], [1, room_size - 1]])  # Agent spawn zone
-
-        if room == "square_room_with_2_exits":
-            # Configuration for a square room with a single exit
-            self.wall_shear = False  # No walls in this configuration
-            self.door_size = room_size / 15  # Width of the exit
-            self.destination = np.array([[-0.5, self.room_size / 2], [self.room_size + 0.5, self.room_size / 2]])  # Positions of the destinations
-            self.number_of_walls = 6  # Number of walls in the room
-            self.walls = np.array([[[0, 0], [0, self.room_size / 2 - self.door_size / 2]],  # Wall coordinates
-                                   [[0, self.room_size / 2 + self.door_size / 2], [0, self.room_size]],
-                                   [[0, self.room_size], [self.room_size, self.room_size]],
-                                   [[self.room_size, self.room_size],
-                                    [self.room_size, self.room_size / 2 + self.door_size / 2]],
-                                   [[self.room_size, self.room_size / 2 - self.door_size / 2],
-                                    [self.room_size, 0]],
-                                   [[self.room_size, 0], [0, 0]]])
-
-            self.spawn_zone = np.array([[1, room_size - 1], [1, room_size - 1]])  # Agent spawn zone
-
-        if room == "square_room_with_2_exits_1_additional_wall_1":
-            # Configuration for a square room with one exit and an additional wall
-            self.wall_shear = True  # Walls are present in this configuration
-            self.door_size = room_size / 15  # Width of the exit
-            self.destination = np.array([[-0.5, room_size / 2]])  # Position of the destination
-            #self.destination = np.array([[room_size + 0.5, room_size / 2], [-0.5, room_size / 2]])
-            self.number_of_walls = 7  # Number of walls in the room
-            self.walls = np.array([[[0, 0], [0, self.room_size / 2 - self.door_size / 2]],  # Wall coordinates
-                                   [[0, self.room_size / 2 + self.door_size / 2], [0, self.room_size]],
-                                   [[0, self.room_size], [self.room_size, self.room_size]],
-                                   [[self.room_size, self.room_size], [self.room_size, self.room_size / 2 + self.door_size / 2]],
-                                   [[self.room_size, self.room_size / 2 - self.door_size / 2], [self.room_size, 0]],
-                                   [[self.room_size, 0], [0, 0]],
-                                   [[self.room_size / 4, self.room_size * 0.3], [self.room_size / 4, self.room_size * 0.7]]])
-
-            self.spawn_zone = np.array([[room_size / 2, room_size - 1], [1, room_size - 1]])   # Agent spawn zone
-
-        if room == "square_room_with_2_exits_1_additional_wall_2":
-            # Configuration for a square room with one exit and an additional wall
-            self.wall_shear = True  # Walls are present in this configuration
-            self.door_size = room_size / 15  # Width of the exit
-            #self.destination = np.array([[-0.5, room_size / 2]])  # Position of the destination
-            #self.destination = np.array([[room_size + 0.5, room_size / 2]])
-            self.destination = np.array([[-0.5, self.room_size / 2], [self.room_size + 0.5, self.room_size / 2]])
-            self.number_of_walls = 7  # Number of walls in the room
-            self.walls = np.array([[[0, 0], [0, self.room_size / 2 - self.door_size / 2]],  # Wall coordinates
-                                   [[0, self.room_size / 2 + self.door_size / 2], [0, self.room_size]],
-                                   [[0, self.room_size], [self.room_size, self.room_size]],
-                                   [[self.room_size, self.room_size], [self.room_size, self.room_size / 2 + self.door_size / 2]],
-                                   [[self.room_size, self.room_size / 2 - self.door_size / 2], [self.room_size, 0]],
-                                   [[self.room_size, 0], [0, 0]],
-                                   [[self.room_size / 4, self.room_size * 0.3], [self.room_size / 4, self.room_size * 0.7]]])
-
-            self.spawn_zone = np.array([[room_size / 2, room_size - 1], [1, room_size - 1]])   # Agent spawn zone
+        # Initialize the Room object with a given room layout (the name of a built-in layout or the path
+        # of a layout file) and room size. The geometry is only compiled the first time a layout is used.
+        template = load_layout(room, room_size)
+        # The geometry arrays, wall indices and floor fields are shared with the cached room, so the floor
+        # field of a layout is only computed once per process
+        self.__dict__.update(template.__dict__)
+        self.name = room  # Store the name of the room layout
+
+    @classmethod
+    def from_geometry(cls, name, room_size, walls, destination, spawn_zone, door_size, wall_shear, internal_walls=0,
+                      destination_cost=None):
+        # Create a room from explicit geometry instead of one of the named configurations.
+        # The last internal_walls walls are inside the room, the others are its outer walls.
+        # destination_cost: optional, the remaining way (in metres) from every destination to the way out, e.g.
+        # for the zones of a building; every agent then heads for the destination with the shortest way in total
+        room = cls.__new__(cls)
+        room.room_size = room_size
+        room.name = name
+        room.wall_shear = wall_shear  # True if there are walls in the middle of the room
+        room.door_size = door_size
+        room.destination = np.array(destination, dtype=float).reshape(-1, 2)
+        room.destination_cost = None if destination_cost is None else np.array(destination_cost, dtype=float)
+        room.walls = np.array(walls, dtype=float).reshape(-1, 2, 2)
+        room.number_of_walls = len(room.walls)
+        room.first_internal_wall = room.number_of_walls - internal_walls  # Index of the first wall inside the room
+        room.spawn_zone = np.array(spawn_zone, dtype=float)
+        room.compile_walls()
+        room.floor_fields = {}
+        room.wall_indices = {}
+        return room
+
+    def compile_walls(self):
+        # Precompute start points, direction vectors, lengths, unit vectors and unit normals
+        # of all wall segments, so that the force kernels don't re-derive them every step
+        self.walls = np.asarray(self.walls, dtype=float)
+        self.wall_start = self.walls[:, 0, :]  # Start point of each wall, shape (W, 2)
+        self.wall_vec = self.walls[:, 1, :] - self.walls[:, 0, :]  # Direction vector of each wall
+        self.wall_len = np.linalg.norm(self.wall_vec, axis=1)  # Length of each wall
+        self.wall_unit = self.wall_vec / self.wall_len[:, None]  # Unit vector along each wall
+        self.wall_normal = np.stack((-self.wall_unit[:, 1], self.wall_unit[:, 0]), axis=1)  # Unit normal of each wall
+        self.wall_box = np.stack((self.walls.min(axis=1), self.walls.max(axis=1)), axis=1)  # [min, max] corner of each wall
 
     def get_wall(self, n):
         # Get the coordinates of the nth wall
@@ -108,3 +91,114 @@ class Room:
     def get_destination(self):
         # Get the positions of the destination(s) in the room
         return self.destination
+
+    def get_floor_field(self, resolution=0.2, cache_dir=None):
+        # Get the distance-to-exit floor field of the room, computed once per resolution
+        # (and stored in cache_dir, if given, keyed by the layout and the resolution)
+        if resolution not in self.floor_fields:
+            from floor_field import load_floor_field
+            self.floor_fields[resolution] = load_floor_field(self.walls, self.destination, self.room_size,
+                                                             resolution, cache_dir, self.destination_cost)
+        return self.floor_fields[resolution]
+
+    def get_wall_index(self, cutoff):
+        # Get the spatial index of the walls for the given interaction cutoff, built once per cutoff
+        if cutoff not in self.wall_indices:
+            from wall_index import Wall_Index
+            self.wall_indices[cutoff] = Wall_Index(self.walls, cutoff)
+        return self.wall_indices[cutoff]
+
+
+def outline_walls(room_size, doors, height=None):
+    # Get the outer walls of a square room, left open at the doors, and the points 0.5 m in front of the doors.
+    # - doors: list of (side, position, width), side is "left", "right", "bottom" or "top" and
+    #   position is the centre of the door along that side
+    # - height: height of a rectangular room whose width is room_size (None: square room)
+    if height is None:
+        height = room_size
+    corners = {"bottom": ([0, 0], [room_size, 0]), "right": ([room_size, 0], [room_size, height]),
+               "top": ([room_size, height], [0, height]), "left": ([0, height], [0, 0])}
+    outward = {"bottom": [0, -1], "right": [1, 0], "top": [0, 1], "left": [-1, 0]}
+
+    walls = []
+    destination = []
+    for side, (start, end) in corners.items():
+        start = np.array(start, dtype=float)
+        end = np.array(end, dtype=float)
+        length = np.linalg.norm(end - start)
+        direction = (end - start) / length
+        # Distances along the side where a door interrupts the wall, measured from the side's start point
+        gaps = []
+        for door_side, position, width in doors:
+            if door_side not in corners:
+                raise ValueError('Unknown side "' + str(door_side) + '", use "left", "right", "bottom" or "top".')
+            if door_side != side:
+                continue
+            along = position if side in ("bottom", "right") else length - position
+            gaps.append((along - width / 2, along + width / 2))
+            centre = start + direction * along
+            destination.append(centre + 0.5 * np.array(outward[side]))
+        pos = 0.0
+        for gap_start, gap_end in sorted(gaps):
+            if gap_start > pos:
+                walls.append([start + direction * pos, start + direction * gap_start])
+            pos = max(pos, gap_end)
+        if pos < length:
+            walls.append([start + direction * pos, end])
+    return walls, destination
+
+
+def parametric_room(room_size, doors, obstacles=(), spawn_zone=None, name="parametric"):
+    # Build a square room from parameters instead of a named configuration.
+    # - doors: list of (side, position, width), see outline_walls
+    # - obstacles: list of internal wall segments [[x0, y0], [x1, y1]]
+    # - spawn_zone: [[x_min, x_max], [y_min, y_max]], by default the right half of the room
+    walls, destination = outline_walls(room_size, doors)
+    for obstacle in obstacles:
+        walls.append(obstacle)
+    if spawn_zone is None:
+        spawn_zone = [[room_size / 2, room_size - 1], [1, room_size - 1]]
+    door_size = min(width for _, _, width in doors)
+    return Room.from_geometry(name, room_size, walls, destination, spawn_zone, door_size, len(obstacles) > 0,
+                              len(obstacles))
+
+
+def scaled(value, room_size):
+    # Get the lengths of a layout file in metres: plain values are fractions of the room size,
+    # {"fraction": ..., "metres": ...} adds an absolute part
+    if isinstance(value, dict):
+        return np.array(value["fraction"], dtype=float) * room_size + np.array(value.get("metres", 0), dtype=float)
+    return np.array(value, dtype=float) * room_size
+
+
+def compile_layout(layout, room, room_size):
+    # Build the room described by the contents of a layout file (see the top of this file)
+    try:
+        door_size = layout["door_size"] * room_size
+        doors = [(door["side"], door["position"] * room_size, door.get("width", layout["door_size"]) * room_size)
+                 for door in layout["doors"]]
+        spawn_zone = scaled(layout["spawn_zone"], room_size)
+    except KeyError as error:
+        raise ValueError('The room layout "' + room + '" has no ' + str(error) + '.')
+    walls, destination = outline_walls(room_size, doors)
+    obstacles = layout.get("obstacles", [])
+    walls += list(scaled(obstacles, room_size).reshape(-1, 2, 2))
+    if "destinations" in layout:
+        destination = scaled(layout["destinations"], room_size)
+    wall_shear = layout.get("wall_shear", len(obstacles) > 0)
+    return Room.from_geometry(room, room_size, walls, destination, spawn_zone, door_size, wall_shear,
+                              len(obstacles))
+
+
+def load_layout(room, room_size):
+    # Get the compiled room of a built-in layout or a layout file. Rooms are cached by the content of
+    # the file and the room size, so a layout is parsed and compiled only once.
+    path = room if room.endswith(".json") else os.path.join(layout_dir, room + ".json")
+    if not os.path.isfile(path):
+        raise ValueError('Unknown room "' + room + '". The built-in rooms are: ' + ', '.join(layouts()) + '.')
+    with open(path, "rb") as layout_file:
+        content = layout_file.read()
+    key = hashlib.sha1(content + repr(float(room_size)).encode()).hexdigest()
+    if key not in compiled_rooms:
+        compiled_rooms[key] = compile_layout(json.loads(content), room, room_size)
+    return compiled_rooms[key]
@@ -0,0 +1,97 @@
+import numpy as np
+
+# Safety metrics of an evacuation, accumulated while the solver runs so that the accelerations
+# of the agents do not have to be kept for every time step.
+# The force on an agent is the norm of its acceleration times its mass; an agent whose force is above
+# crush_force is counted as crushed in that frame. Per frame, the metrics keep:
+# - "agents_escaped": the number of agents that have escaped so far (the escape curve)
+# - "crushed": the number of agents above the force threshold
+# - "tracked_force": the force on one agent (by default the middle one), as plotted by display_graph
+# Per agent:
+# - "peak_force": the largest force the agent felt
+# - "exposure_time": how long the agent was above the threshold
+# - "first_crush_step": the first frame in which the agent was above the threshold (-1: never)
+# And for the whole run "first_crush_time", the time of the first crush (nan: nobody was crushed).
+# The same metrics can be recomputed from a stored trajectory with from_trajectory.
+
+crush_force = 700  # Force at which people die (in Newton)
+
+
+class Safety_Metrics:
+    def __init__(self, masses, threshold=crush_force, tracked_agent=None):
+        """
+            Accumulates the safety metrics of a run, frame by frame. It has the interface of a
+            trajectory sink (see trajectory_sinks), so it can be fed the frames of
+            differential_equation_solver.iterate next to the sink that keeps the trajectory.
+
+            Parameters:
+            - ``masses``: 1D-array, mass of all agents
+            - ``threshold``: float, force above which an agent is crushed (in Newton)
+            - ``tracked_agent``: integer or None, agent whose force is kept for every frame (None: the middle one)
+        """
+        self.masses = np.asarray(masses, dtype=float)
+        self.threshold = threshold
+        self.tracked_agent = len(self.masses) // 2 if tracked_agent is None else tracked_agent
+        self.start(len(self.masses), None, 1.0)
+
+    def start(self, num_individuals, number_of_steps, dt):
+        self.dt = dt
+        self.frames = 0
+        self.agents_escaped = []
+        self.crushed = []
+        self.tracked_force = []
+        self.peak_force = np.zeros(num_individuals)
+        self.exposure_time = np.zeros(num_individuals)
+        self.first_crush_step = np.full(num_individuals, -1)
+
+    def record(self, frame):
+        force = np.linalg.norm(frame["a"], axis=0) * self.masses
+        self.add(force[:, None], [frame["escaped"]])
+
+    def add(self, force, agents_escaped):
+        """ adds a block of consecutive frames to the metrics
+            parameters: ``force``: 2D-array of shape (N, frames), the force on every agent in every frame
+                        ``agents_escaped``: 1D-array, the number of escaped agents in every frame
+        """
+        above = force > self.threshold
+        self.agents_escaped.append(np.asarray(agents_escaped, dtype=float))
+        self.crushed.append(np.count_nonzero(above, axis=0))
+        self.tracked_force.append(force[self.tracked_agent])
+        np.maximum(self.peak_force, np.max(force, axis=1, initial=0.0), out=self.peak_force)
+        self.exposure_time += self.dt * np.count_nonzero(above, axis=1)
+
+        # Agents crushed for the first time in this block
+        first = (self.first_crush_step < 0) & np.any(above, axis=1)
+        self.first_crush_step[first] = self.frames + np.argmax(above[first], axis=1)
+        self.frames += force.shape[1]
+
+    def finish(self):
+        crushed = self.first_crush_step >= 0
+        return {"agents_escaped": np.concatenate(self.agents_escaped or [np.zeros(0)]),
+                "crushed": np.concatenate(self.crushed or [np.zeros(0, dtype=int)]),
+                "tracked_force": np.concatenate(self.tracked_force or [np.zeros(0)]),
+                "tracked_agent": self.tracked_agent,
+                "peak_force": self.peak_force,
+                "exposure_time": self.exposure_time,
+                "first_crush_step": self.first_crush_step,
+                "first_crush_time": self.dt * np.min(self.first_crush_step[crushed]) if np.any(crushed) else np.nan,
+                "threshold": self.threshold,
+                "dt": self.dt}
+
+
+def from_trajectory(forces, masses, dt, agents_escaped, threshold=crush_force, chunk=256):
+    """ returns a dictionary, the safety metrics (see Safety_Metrics.finish) recomputed from a stored trajectory
+        parameters: ``forces``: 3D-array of shape (2, N, frames), the accelerations of the agents
+                                (may be the memory map of a stored run, it is read ``chunk`` frames at a time)
+                    ``masses``: 1D-array, mass of all agents
+                    ``dt``: float, time between two frames
+                    ``agents_escaped``: 1D-array, the number of escaped agents in every frame
+                    ``threshold``: float, force above which an agent is crushed (in Newton)
+                    ``chunk``: integer, number of frames processed at once
+    """
+    metrics = Safety_Metrics(masses, threshold)
+    metrics.start(forces.shape[1], forces.shape[2], dt)
+    for begin in range(0, forces.shape[2], chunk):
+        block = np.asarray(forces[:, :, begin:begin + chunk])
+        metrics.add(np.linalg.norm(block, axis=0) * metrics.masses[:, None], agents_escaped[begin:begin + chunk])
+    return metrics.finish()
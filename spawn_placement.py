@@ -0,0 +1,125 @@
+import numpy as np
+
+
+def wall_clearance(points, walls):
+    """ returns a 1D-array, the distance of every point to the nearest wall
+        parameters: ``points``: 2D-array of shape (2, P)
+                    ``walls``: 3D-array, the wall segments of the room
+    """
+    distance = np.full(points.shape[1], np.inf)
+    for wall in walls:
+        line_vec = wall[1] - wall[0]
+        pnt_vec = points - wall[0][:, None]
+        temp = np.clip(line_vec.dot(pnt_vec) / line_vec.dot(line_vec), 0.0, 1.0)
+        distance = np.minimum(distance, np.linalg.norm(pnt_vec - line_vec[:, None] * temp, axis=0))
+    return distance
+
+
+def jittered_lattice(spawn_zone, radii, walls, rng, gap=0.05):
+    """ returns a 2D-array of shape (2, N), positions for all agents on a randomly jittered square
+        lattice inside the spawn zone. No two agents and no agent and wall overlap.
+        parameters: ``spawn_zone``: 2D-array [[x_min, x_max], [y_min, y_max]]
+                    ``radii``: 1D-array, radius of all agents
+                    ``walls``: 3D-array, the wall segments of the room
+                    ``rng``: random generator (numpy Generator or the numpy.random module)
+                    ``gap``: float, smallest free space between two agents, and between an agent and a wall
+    """
+    num = len(radii)
+    diameter = 2 * np.max(radii) + gap
+    width = spawn_zone[0, 1] - spawn_zone[0, 0]
+    height = spawn_zone[1, 1] - spawn_zone[1, 0]
+
+    # Start with the widest spacing that could hold everybody, and make it denser until enough
+    # lattice sites are far enough from the walls
+    spacing = np.sqrt(width * height / num)
+    while spacing >= diameter:
+        nx = max(1, int(np.floor(width / spacing)))
+        ny = max(1, int(np.floor(height / spacing)))
+        # Sites are centred in their cells, so they stay half a spacing inside the zone
+        x = spawn_zone[0, 0] + (np.arange(nx) + 0.5) * width / nx
+        y = spawn_zone[1, 0] + (np.arange(ny) + 0.5) * height / ny
+        sites = np.stack(np.meshgrid(x, y, indexing='ij')).reshape(2, -1)
+        # Room around each site in which it may move without touching its neighbours; the jitter is
+        # drawn per axis, so an agent may move up to sqrt(2) * jitter towards a wall
+        jitter = 0.5 * (min(width / nx, height / ny) - diameter)
+        sites = sites[:, wall_clearance(sites, walls) >= np.max(radii) + gap + np.sqrt(2) * jitter]
+        if sites.shape[1] >= num:
+            chosen = sites[:, rng.permutation(sites.shape[1])[:num]]
+            return chosen + jitter * (2 * rng.random((2, num)) - 1)
+        spacing *= 0.95
+
+    raise ValueError('Too many people! ' + str(num) + ' agents of radius up to ' + str(round(np.max(radii), 3))
+                     + ' m do not fit into the spawn zone of ' + str(round(width, 2)) + ' m x '
+                     + str(round(height, 2)) + ' m. Please change the size of the room/spawn-zone '
+                     'or the number of people.')
+
+
+def poisson_disk(spawn_zone, radii, walls, rng, gap=0.05, attempts=30):
+    """ returns a 2D-array of shape (2, N), positions for all agents drawn by Poisson-disk sampling
+        (Bridson's algorithm on a background grid). The positions look less regular than a lattice,
+        but the placement is slower and can hold fewer agents.
+        parameters: see jittered_lattice; ``attempts``: integer, candidates tried around each point
+    """
+    num = len(radii)
+    min_distance = 2 * np.max(radii) + gap
+    clearance = np.max(radii) + gap
+    low = spawn_zone[:, 0]
+    size = spawn_zone[:, 1] - spawn_zone[:, 0]
+
+    # Background grid with cells so small that each can hold at most one point
+    cell = min_distance / np.sqrt(2)
+    shape = np.maximum(np.ceil(size / cell).astype(int), 1)
+    grid = -np.ones(shape, dtype=int)
+    points = []
+    active = []
+
+    def fits(p):
+        # p has passed the zone and wall checks; compare it with the points in the nearby grid cells
+        gx, gy = ((p - low) / cell).astype(int)
+        for i in range(max(gx - 2, 0), min(gx + 3, shape[0])):
+            for j in range(max(gy - 2, 0), min(gy + 3, shape[1])):
+                k = grid[i, j]
+                if k >= 0 and np.linalg.norm(points[k] - p) < min_distance:
+                    return False
+        return True
+
+    def add(p):
+        gx, gy = np.minimum(((p - low) / cell).astype(int), shape - 1)
+        grid[gx, gy] = len(points)
+        active.append(len(points))
+        points.append(p)
+
+    def first_fit(candidates):
+        # Add the first of the candidates (shape (attempts, 2)) that fits; the checks against the
+        # zone and the walls are done for all candidates at once
+        inside = np.all((candidates >= low) & (candidates < low + size), axis=1)
+        candidates = candidates[inside]
+        candidates = candidates[wall_clearance(candidates.T, walls) >= clearance]
+        for p in candidates:
+            if fits(p):
+                add(p)
+                return True
+        return False
+
+    first_fit(low + size * rng.random((attempts, 2)))
+    while active and len(points) < num:
+        index = active[int(rng.random() * len(active))]
+        angle = 2 * np.pi * rng.random(attempts)
+        distance = min_distance * (1 + rng.random(attempts))
+        candidates = points[index] + distance[:, None] * np.stack((np.cos(angle), np.sin(angle)), axis=1)
+        if not first_fit(candidates):
+            active.remove(index)
+
+    if len(points) < num:
+        raise ValueError('Too many people! Only ' + str(len(points)) + ' of ' + str(num)
+                         + ' agents could be placed in the spawn zone. Please change the size of the '
+                         'room/spawn-zone or the number of people.')
+    points = np.array(points).T
+    return points[:, rng.permutation(num)]
+
+
+# The placement methods that can be selected with Simulation.fill_room(method=...)
+methods = {
+    "lattice": jittered_lattice,
+    "poisson": poisson_disk,
+}
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import force_backends
+import spawn_placement
+from agent_interactions import Differential_Equation
+from room_layout import Room, layouts
+
+# Parity of the force backends: the "python" and "numba" kernels must give the accelerations of the
+# NumPy kernels of Differential_Equation, in every room layout, with and without a cutoff, and when only
+# some of the agents are still in the room.
+
+tolerance = 1e-9  # Largest difference, relative to the largest acceleration
+num_individuals = 40
+room_size = 25
+rooms = {}
+
+
+def room_for(name):
+    # One Room per layout, so its floor field and wall index are only built once
+    if name not in rooms:
+        rooms[name] = Room(name, room_size)
+    return rooms[name]
+
+
+def crowded_state(room, seed=0):
+    # Agents placed without overlaps, then pushed together a bit, with random velocities
+    rng = np.random.default_rng(seed)
+    radii = 0.25 * rng.normal(1, 0.05, num_individuals)
+    masses = 50 * radii / 0.25
+    r = spawn_placement.jittered_lattice(room.get_spawn_zone(), radii, room.walls, rng)
+    r = r + rng.normal(0, 0.1, r.shape)
+    v = rng.normal(0, 1, r.shape)
+    active = rng.random(num_individuals) < 0.6
+    return radii, masses, r, v, active
+
+
+def accelerations(room, backend, cutoff, active=None):
+    radii, masses, r, v, _ = crowded_state(room)
+    diff_equ = Differential_Equation(num_individuals, room_size, 0.1, room, radii, masses, cutoff,
+                                     backend=backend)
+    return diff_equ.f(r, v, active=active)
+
+
+def assert_parity(expected, result):
+    scale = np.max(np.abs(expected))
+    assert np.max(np.abs(result - expected)) <= tolerance * scale
+
+
+backends = [backend for backend in force_backends.available() if backend != "numpy"]
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("cutoff", [None, 2.0])
+@pytest.mark.parametrize("layout", layouts())
+def test_all_agents(layout, cutoff, backend):
+    room = room_for(layout)
+    assert_parity(accelerations(room, "numpy", cutoff), accelerations(room, backend, cutoff))
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("cutoff", [None, 2.0])
+@pytest.mark.parametrize("layout", layouts())
+def test_active_subset(layout, cutoff, backend):
+    room = room_for(layout)
+    active = crowded_state(room)[4]
+    expected = accelerations(room, "numpy", cutoff, active)
+    result = accelerations(room, backend, cutoff, active)
+    assert_parity(expected, result)
+    # The agents that left the room get no acceleration
+    assert np.all(result[:, ~active] == 0)
+
+
+def test_python_kernels_are_interpreted():
+    # The "python" backend is only a reference if it does not call compiled kernels
+    force_backends.select(force_backends.resolve("auto"))
+    for name in force_backends.kernel_names:
+        kernel = getattr(force_backends.python_kernels, name)
+        assert type(kernel).__name__ == "function"
+        for other in kernel.__code__.co_names:
+            if other in force_backends.kernel_names:
+                assert kernel.__globals__[other] is getattr(force_backends.python_kernels, other)
+
+
+def test_check_parity_fails_on_a_drifting_backend(monkeypatch):
+    force_backends.check_parity()
+    kernels = force_backends.python_kernels
+    broken = force_backends.types.SimpleNamespace(**vars(kernels))
+
+    def agent_forces(r, v, radius, A, B, k, kap, out):
+        kernels.agent_forces(r, v, radius, A, B, k, kap, out)
+        out *= 1.001
+
+    broken.agent_forces = agent_forces
+    monkeypatch.setattr(force_backends, "python_kernels", broken)
+    with pytest.raises(AssertionError):
+        force_backends.check_parity()
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from agent_interactions import Differential_Equation
+from parallel_forces import Shared_Forces
+from profiling import Phase_Profiler
+from room_layout import Room
+
+# The parallel force evaluation must give the accelerations of Differential_Equation.f, report the
+# phases timed in its workers, and raise (instead of waiting forever) when a worker fails or dies.
+
+num_individuals = 60
+
+
+def diff_equ():
+    rng = np.random.default_rng(0)
+    room = Room("square_room_with_1_exit", 25)
+    radii = 0.25 * rng.normal(1, 0.05, num_individuals)
+    masses = 50 * radii / 0.25
+    equation = Differential_Equation(num_individuals, 25, 0.1, room, radii, masses, 2.0, backend="numpy")
+    r = rng.uniform(2, 23, (2, num_individuals))
+    v = rng.normal(0, 1, (2, num_individuals))
+    return equation, r, v
+
+
+class Failing_Equation:
+    # Stands in for a Differential_Equation whose force evaluation raises
+    def __init__(self, equation):
+        self.N = equation.N
+        self.neighbor_list = equation.neighbor_list
+
+    def acceleration(self, r, v, index):
+        raise ZeroDivisionError("broken force")
+
+
+def test_same_accelerations_as_f():
+    equation, r, v = diff_equ()
+    active = np.arange(num_individuals) % 3 != 0
+    with Shared_Forces(equation, processes=2) as forces:
+        assert np.allclose(forces(r, v, active), equation.f(r, v, active))
+
+
+def test_worker_phases_reach_the_profiler():
+    equation, r, v = diff_equ()
+    profiler = Phase_Profiler()
+    with Shared_Forces(equation, processes=2, profiler=profiler) as forces:
+        forces(r, v)
+        forces(r, v)
+    assert profiler.calls["f_ag"] == 4
+
+
+def test_worker_exception_is_raised():
+    equation, r, v = diff_equ()
+    with Shared_Forces(Failing_Equation(equation), processes=2) as forces:
+        with pytest.raises(RuntimeError, match="broken force"):
+            forces(r, v)
+
+
+def test_dead_worker_is_noticed():
+    equation, r, v = diff_equ()
+    with Shared_Forces(equation, processes=2) as forces:
+        forces.workers[1].kill()
+        forces.workers[1].join()
+        with pytest.raises(RuntimeError, match="stopped"):
+            forces(r, v)
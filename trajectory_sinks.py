@@ -0,0 +1,124 @@
+import numpy as np
+
+
+# A sink receives the frames yielded by differential_equation_solver.iterate one at a time and decides
+# what to keep of them. Every sink has the methods:
+# - start(num_individuals, number_of_steps, dt): called once before the first frame
+# - record(frame): called for every frame (see iterate for the keys of a frame)
+# - finish(): returns a dictionary with the results, using the names of the Simulation attributes
+#   ("y", "agents_escaped", "forces", "escape_step", "force_evaluations")
+# A frame is only valid during the call to record, so a sink has to copy what it keeps.
+
+
+class Discard_Sink:
+    def __init__(self):
+        """
+            Keeps nothing but the final escape information of the run.
+        """
+        self.last = None
+
+    def start(self, num_individuals, number_of_steps, dt):
+        self.last = None
+
+    def record(self, frame):
+        self.last = frame
+
+    def finish(self):
+        return {"escape_step": self.last["escape_step"].copy(),
+                "force_evaluations": self.last["evaluations"],
+                "steps": self.last["step"] + 1,
+                "stop_reason": self.last.get("stop_reason", "steps")}
+
+
+class Statistics_Sink(Discard_Sink):
+    def __init__(self):
+        """
+            Keeps only aggregate statistics of the run: the number of escaped agents at every
+            time step and the largest acceleration each agent experienced.
+        """
+        super().__init__()
+        self.agents_escaped = []
+        self.peak_acceleration = None
+
+    def start(self, num_individuals, number_of_steps, dt):
+        super().start(num_individuals, number_of_steps, dt)
+        self.agents_escaped = []
+        self.peak_acceleration = None
+
+    def record(self, frame):
+        super().record(frame)
+        self.agents_escaped.append(frame["escaped"])
+        acceleration = np.linalg.norm(frame["a"], axis=-2)
+        if self.peak_acceleration is None:
+            self.peak_acceleration = acceleration
+        else:
+            np.maximum(self.peak_acceleration, acceleration, out=self.peak_acceleration)
+
+    def finish(self):
+        result = super().finish()
+        result["agents_escaped"] = np.array(self.agents_escaped, dtype=float)
+        result["peak_acceleration"] = self.peak_acceleration
+        return result
+
+
+class Full_Sink(Discard_Sink):
+    def __init__(self, every=1, chunk=1024, keep_forces=True):
+        """
+            Keeps the positions and accelerations of every ``every``-th frame in
+            (2, N, number of kept frames) arrays, as used by display_events.
+            With every=1 this is the whole trajectory.
+            If the number of steps is not known in advance, the arrays grow in chunks.
+
+            Parameters:
+            - ``every``: integer, keep one frame out of ``every``
+            - ``chunk``: integer, number of frames the arrays grow by, at least
+            - ``keep_forces``: boolean, keep the accelerations too (not needed for the safety
+                               metrics, which are accumulated during the run, see safety_metrics)
+        """
+        super().__init__()
+        self.every = every
+        self.chunk = chunk
+        self.keep_forces = keep_forces
+        self.y = None
+        self.forces = None
+        self.agents_escaped = None
+        self.kept = 0
+
+    def start(self, num_individuals, number_of_steps, dt):
+        super().start(num_individuals, number_of_steps, dt)
+        if number_of_steps is None:
+            num_frames = self.chunk
+        else:
+            num_frames = (number_of_steps - 1) // self.every + 1
+        self.y = np.zeros((2, num_individuals, num_frames))
+        self.forces = np.zeros((2, num_individuals, num_frames)) if self.keep_forces else None
+        self.agents_escaped = np.zeros(num_frames)
+        self.kept = 0
+
+    def grow(self):
+        # Add room for more frames: at least a chunk, and as many frames as are kept already
+        extra = max(self.chunk, self.kept)
+        self.y = np.concatenate((self.y, np.zeros(self.y.shape[:2] + (extra,))), axis=2)
+        if self.keep_forces:
+            self.forces = np.concatenate((self.forces, np.zeros(self.forces.shape[:2] + (extra,))), axis=2)
+        self.agents_escaped = np.concatenate((self.agents_escaped, np.zeros(extra)))
+
+    def record(self, frame):
+        super().record(frame)
+        if frame["step"] % self.every != 0:
+            return
+        if self.kept == len(self.agents_escaped):
+            self.grow()
+        self.y[:, :, self.kept] = frame["y"]
+        if self.keep_forces:
+            self.forces[:, :, self.kept] = frame["a"]
+        self.agents_escaped[self.kept] = frame["escaped"]
+        self.kept += 1
+
+    def finish(self):
+        result = super().finish()
+        result["y"] = self.y[:, :, :self.kept]
+        if self.keep_forces:
+            result["forces"] = self.forces[:, :, :self.kept]
+        result["agents_escaped"] = self.agents_escaped[:self.kept]
+        return result
@@ -0,0 +1,157 @@
+import json
+import os
+
+import numpy as np
+
+# A stored run is a directory with:
+# - header.json: the number of agents, the time step, the room, the radii and masses of the agents,
+#   the data type and the number of frames written so far (rewritten after every chunk)
+# - y.bin, forces.bin: one (2, N) block per frame, appended in chunks while the solver runs; the
+#   accelerations (forces.bin) are only stored if asked for, as they double the size of a run
+# - agents_escaped.bin: the number of escaped agents at each frame
+# - escape_step.npy: the time step at which each agent escaped, written at the end of the run
+# The binary files are opened as memory maps, so frames are only read from disk when they are used.
+
+
+class Store_Sink:
+    def __init__(self, path, room_name, room_size, radii, masses=None, every=1, chunk=256, dtype=np.float64,
+                 keep_forces=False):
+        """
+            Trajectory sink (see trajectory_sinks) that writes the frames straight to a stored run.
+
+            Parameters:
+            - ``path``: string, directory of the stored run (created if needed)
+            - ``room_name``, ``room_size``: the room of the simulation, to rebuild it for replay
+            - ``radii``, ``masses``: 1D-array, radius and mass of all agents
+            - ``every``: integer, keep one frame out of ``every``
+            - ``chunk``: integer, number of frames buffered in memory before they are written
+            - ``dtype``: data type of the stored positions and accelerations
+            - ``keep_forces``: boolean, also store the accelerations of the agents
+        """
+        self.path = path
+        self.header = {"room": room_name, "room_size": room_size,
+                       "radii": np.asarray(radii, dtype=float).tolist(),
+                       "masses": None if masses is None else np.asarray(masses, dtype=float).tolist(),
+                       "every": every, "dtype": np.dtype(dtype).str, "num_frames": 0}
+        self.every = every
+        self.chunk = chunk
+        self.dtype = np.dtype(dtype)
+        self.keep_forces = keep_forces
+        self.last = None
+
+    def start(self, num_individuals, number_of_steps, dt):
+        os.makedirs(self.path, exist_ok=True)
+        self.header["N"] = num_individuals
+        self.header["dt"] = dt * self.every
+        self.header["num_frames"] = 0
+        self.y_buffer = np.zeros((self.chunk, 2, num_individuals), dtype=self.dtype)
+        self.forces_buffer = np.zeros((self.chunk, 2, num_individuals), dtype=self.dtype) if self.keep_forces else None
+        self.escaped_buffer = np.zeros(self.chunk)
+        self.buffered = 0
+        names = ("y", "forces", "agents_escaped") if self.keep_forces else ("y", "agents_escaped")
+        # A forces.bin left over from an earlier run in the same directory would not match this one
+        if not self.keep_forces and os.path.exists(os.path.join(self.path, "forces.bin")):
+            os.remove(os.path.join(self.path, "forces.bin"))
+        self.files = {name: open(os.path.join(self.path, name + ".bin"), "wb") for name in names}
+        self.write_header()
+
+    def write_header(self):
+        # Write to a temporary file and rename it, so a reader never sees a half-written header
+        header_path = os.path.join(self.path, "header.json")
+        with open(header_path + ".tmp", "w") as header_file:
+            json.dump(self.header, header_file)
+        os.replace(header_path + ".tmp", header_path)
+
+    def flush(self):
+        # Append the buffered frames to the files, then count them in the header, so that a run that
+        # is still going on (or crashed) can be opened with the frames written so far
+        self.files["y"].write(self.y_buffer[:self.buffered].tobytes())
+        if self.keep_forces:
+            self.files["forces"].write(self.forces_buffer[:self.buffered].tobytes())
+        self.files["agents_escaped"].write(self.escaped_buffer[:self.buffered].tobytes())
+        for stored_file in self.files.values():
+            stored_file.flush()
+        self.header["num_frames"] += self.buffered
+        self.buffered = 0
+        self.write_header()
+
+    def record(self, frame):
+        self.last = frame
+        if frame["step"] % self.every != 0:
+            return
+        self.y_buffer[self.buffered] = frame["y"]
+        if self.keep_forces:
+            self.forces_buffer[self.buffered] = frame["a"]
+        self.escaped_buffer[self.buffered] = frame["escaped"]
+        self.buffered += 1
+        if self.buffered == self.chunk:
+            self.flush()
+
+    def finish(self):
+        self.flush()
+        for stored_file in self.files.values():
+            stored_file.close()
+        np.save(os.path.join(self.path, "escape_step.npy"), self.last["escape_step"])
+        self.header["force_evaluations"] = int(self.last["evaluations"])
+        self.write_header()
+
+        stored = open_trajectory(self.path)
+        return {"y": stored.y, "forces": stored.forces, "agents_escaped": stored.agents_escaped,
+                "escape_step": stored.escape_step, "force_evaluations": stored.force_evaluations,
+                "steps": self.last["step"] + 1, "stop_reason": self.last.get("stop_reason", "steps")}
+
+
+class Stored_Trajectory:
+    def __init__(self, path):
+        """
+            A stored run opened for lazy replay. Nothing but the header is read when it is opened.
+
+            Attributes:
+            - ``N``, ``dt``, ``room``, ``room_size``, ``radii``, ``masses``: values from the header
+            - ``num_frames``: integer, number of stored frames
+            - ``y``, ``forces``: (2, N, num_frames) memory-mapped positions and accelerations
+                                 (forces is None if the accelerations were not stored)
+            - ``agents_escaped``: 1D-array (memory-mapped), escaped agents at each frame
+            - ``escape_step``: 1D-array, time step at which each agent escaped (None if unfinished)
+        """
+        with open(os.path.join(path, "header.json")) as header_file:
+            header = json.load(header_file)
+        self.path = path
+        self.N = header["N"]
+        self.dt = header["dt"]
+        self.room = header["room"]
+        self.room_size = header["room_size"]
+        self.radii = np.array(header["radii"])
+        self.masses = None if header["masses"] is None else np.array(header["masses"])
+        self.num_frames = header["num_frames"]
+        self.force_evaluations = header.get("force_evaluations", 0)
+        dtype = np.dtype(header["dtype"])
+
+        # Frames are stored one after the other, so the time axis is moved to the back
+        # to get the (2, N, T) indexing of the in-memory trajectories
+        self.y = self.open_frames("y", dtype).transpose(1, 2, 0)
+        self.forces = None
+        if os.path.exists(os.path.join(path, "forces.bin")):
+            self.forces = self.open_frames("forces", dtype).transpose(1, 2, 0)
+        self.agents_escaped = self.open_map("agents_escaped", np.float64, (self.num_frames,))
+
+        escape_step_path = os.path.join(path, "escape_step.npy")
+        self.escape_step = np.load(escape_step_path) if os.path.exists(escape_step_path) else None
+
+    def open_map(self, name, dtype, shape):
+        if self.num_frames == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + ".bin"), dtype=dtype, mode="r", shape=shape)
+
+    def open_frames(self, name, dtype):
+        return self.open_map(name, dtype, (self.num_frames, 2, self.N))
+
+    def get_room(self):
+        # Rebuild the room of the stored run
+        from room_layout import Room
+        return Room(self.room, self.room_size)
+
+
+def open_trajectory(path):
+    """ returns a Stored_Trajectory, the stored run in the directory ``path`` """
+    return Stored_Trajectory(path)
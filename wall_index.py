@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class Wall_Index:
+    def __init__(self, walls, cutoff=2.0, cell_size=None):
+        """
+            Uniform grid over the wall segments of a room, for floor plans with many walls.
+
+            Every cell lists the walls that come closer than ``cutoff`` to some point of the cell,
+            so the walls near a point are found by looking up a single cell. The index is static:
+            it is built once per room and cutoff (see Room.get_wall_index).
+
+            Parameters:
+            - ``walls``: 3D-array, the wall segments [[x0, y0], [x1, y1]] of the room
+            - ``cutoff``: float, distance beyond which walls are not looked at
+            - ``cell_size``: float or None, side length of one cell (None: the cutoff)
+
+            Attributes:
+            - ``origin``: 1D-array, lower left corner of the grid
+            - ``num_cells``: 1D-array, number of cells along x and y
+            - ``cell_start``: 1D-array, where the walls of each cell start in ``cell_walls``
+            - ``cell_walls``: 1D-array, the wall numbers of all cells one after the other
+        """
+        self.cutoff = cutoff
+        self.cell_size = cutoff if cell_size is None else cell_size
+        walls = np.asarray(walls, dtype=float)
+
+        # Points further than the cutoff from the bounding box of the walls have no walls nearby,
+        # so the grid only covers the bounding box plus the cutoff
+        self.origin = walls.reshape(-1, 2).min(axis=0) - cutoff
+        top = walls.reshape(-1, 2).max(axis=0) + cutoff
+        self.num_cells = np.maximum(np.ceil((top - self.origin) / self.cell_size).astype(int), 1)
+
+        # A wall is listed in a cell if it is closer than the cutoff plus half the cell diagonal
+        # to the cell centre, i.e. possibly closer than the cutoff to some point of the cell
+        reach = cutoff + self.cell_size / np.sqrt(2)
+        cells = []
+        numbers = []
+        for j, wall in enumerate(walls):
+            low = np.floor((wall.min(axis=0) - reach - self.origin) / self.cell_size).astype(int)
+            high = np.floor((wall.max(axis=0) + reach - self.origin) / self.cell_size).astype(int)
+            low = np.clip(low, 0, self.num_cells - 1)
+            high = np.clip(high, 0, self.num_cells - 1)
+            cx, cy = np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij')
+            cx = cx.ravel()
+            cy = cy.ravel()
+            centre = self.origin[:, None] + (np.stack((cx, cy)) + 0.5) * self.cell_size
+            near = segment_distance(centre, wall) <= reach
+            cells.append(cx[near] * self.num_cells[1] + cy[near])
+            numbers.append(np.full(np.count_nonzero(near), j))
+        cells = np.concatenate(cells)
+        numbers = np.concatenate(numbers)
+
+        # Walls sorted by cell, with the start of every cell (compressed rows)
+        order = np.argsort(cells, kind='stable')
+        self.cell_walls = numbers[order]
+        counts = np.bincount(cells, minlength=self.num_cells[0] * self.num_cells[1])
+        self.cell_start = np.concatenate(([0], np.cumsum(counts)))
+
+    def cell_of(self, r):
+        """ returns a 1D-array, the cell number of every point (-1 if the point is outside the grid)
+            parameters: ``r``: 2D-array of shape (2, P)
+        """
+        c = np.floor((r - self.origin[:, None]) / self.cell_size).astype(int)
+        inside = np.all((c >= 0) & (c < self.num_cells[:, None]), axis=0)
+        return np.where(inside, c[0] * self.num_cells[1] + c[1], -1)
+
+    def candidates(self, r):
+        """ returns two 1D-arrays, the point and the wall of every (point, wall) pair that may be
+            closer than the cutoff
+            parameters: ``r``: 2D-array of shape (2, P)
+        """
+        cell = self.cell_of(r)
+        points = np.flatnonzero(cell >= 0)
+        cell = cell[points]
+        start = self.cell_start[cell]
+        counts = self.cell_start[cell + 1] - start
+        point = np.repeat(points, counts)
+        # Position of every pair within the walls of its cell
+        offset = np.arange(len(point)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return point, self.cell_walls[np.repeat(start, counts) + offset]
+
+    def along(self, a, b):
+        """ returns a 1D-array, the walls that may be closer than the cutoff to the line of sight from a to b
+            parameters: ``a``,``b``: 1D-array (xy-points)
+        """
+        steps = max(1, int(np.ceil(2 * np.linalg.norm(b - a) / self.cell_size)))
+        points = a[:, None] + (b - a)[:, None] * np.linspace(0, 1, steps + 1)
+        return np.unique(self.candidates(points)[1])
+
+
+def segment_distance(points, wall):
+    """ returns a 1D-array, the distance of every point to a wall segment
+        parameters: ``points``: 2D-array of shape (2, P)
+                    ``wall``: 2D-array [[x0, y0], [x1, y1]]
+    """
+    line_vec = wall[1] - wall[0]
+    pnt_vec = points - wall[0][:, None]
+    temp = np.clip(line_vec.dot(pnt_vec) / line_vec.dot(line_vec), 0.0, 1.0)
+    return np.linalg.norm(pnt_vec - line_vec[:, None] * temp, axis=0)